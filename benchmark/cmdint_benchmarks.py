@@ -0,0 +1,309 @@
+""" Offline benchmarks of the cmdint hot paths: run log construction, logfile loading and updating, output capture of
+command line tools, file hashing and concurrent logging of several worker processes. All fixtures are synthetic and
+created in a temporary folder.
+
+Usage:
+    python benchmark/cmdint_benchmarks.py                  # quick scale, compare to stored baselines
+    python benchmark/cmdint_benchmarks.py --scale full     # 100k commands, 1 GB output, multi-GB files
+    python benchmark/cmdint_benchmarks.py --save-baseline  # store results as new baselines of the scale
+    python benchmark/cmdint_benchmarks.py --filter hash    # only run the benchmarks bench_*hash*
+
+Baselines are stored per scale in benchmark/baselines.json. They are machine dependent and should be recreated
+(--save-baseline) before comparing changes on another machine. If --fail-on-regression is set, the exit code is 1 if
+a result is worse than its baseline by more than the tolerance.
+"""
+import os
+import sys
+import io
+import json
+import time
+import copy
+import argparse
+import tempfile
+import contextlib
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cmdint import CmdInterface
+from cmdint.Utils import RunLog, CmdLog, LogWriteMode
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+SCALES = {
+    'quick': {
+        'repeats': 3,
+        'log_commands': [10, 1000, 10000],
+        'output_bytes': [64 * 1024, 256 * 1024],
+        'hash_bytes': [64 * MB],
+        'writers': [4],
+        'commands_per_writer': 8,
+    },
+    'full': {
+        'repeats': 5,
+        'log_commands': [10, 1000, 10000, 100000],
+        'output_bytes': [1 * MB, 64 * MB, 1 * GB],
+        'hash_bytes': [256 * MB, 1 * GB, 4 * GB],
+        'writers': [4, 16],
+        'commands_per_writer': 32,
+    },
+}
+
+
+class Result(dict):
+    """
+    Result of a single benchmark. Throughputs are better if higher, latencies are better if lower.
+    """
+
+    def __init__(self, name: str, value: float, unit: str, higher_is_better: bool):
+        super().__init__()
+        self['name'] = name
+        self['value'] = value
+        self['unit'] = unit
+        self['higher_is_better'] = higher_is_better
+
+
+def measure(func, repeats: int, setup=None) -> float:
+    """
+    Call func repeatedly and return the median wall time in seconds. setup is called before each repetition and is
+    not timed. Output of cmdint printed to stdout is discarded.
+    """
+    times = []
+    for i in range(repeats):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def format_size(num_bytes: int) -> str:
+    if num_bytes >= GB:
+        return str(num_bytes // GB) + 'GB'
+    if num_bytes >= MB:
+        return str(num_bytes // MB) + 'MB'
+    return str(num_bytes // 1024) + 'kB'
+
+
+def synthetic_run_log(num_commands: int, run_id: str = 'benchmark') -> dict:
+    """
+    Return run log with num_commands synthetic command logs of a few lines of text output each.
+    """
+    run_log = json.loads(json.dumps(RunLog(run_id=run_id)))
+    cmd_log = json.loads(json.dumps(CmdLog()))
+    cmd_log['name'] = 'synthetic'
+    cmd_log['run_string'] = 'synthetic --input in.nii.gz --output out.nii.gz'
+    cmd_log['text_output'] = ['line ' + str(i) + ' of synthetic command output' for i in range(10)]
+    cmd_log['return_code'] = 1
+    cmd_log['return_code_meaning'] = 'run successful'
+    cmd_log['options']['no_key'] = []
+    cmd_log['options']['key_val'] = {'--input': 'in.nii.gz', '--output': 'out.nii.gz'}
+    cmd_log['time']['start'] = '2020-01-01 00:00:00'
+    cmd_log['time']['end'] = '2020-01-01 00:00:01'
+    cmd_log['time']['duration'] = '0:00:01'
+    cmd_log['time']['duration_s'] = 1.0
+    cmd_log['time']['utc_offset'] = 3600
+    cmd_log['time']['phases'] = {'check_input': 0.0001, 'hash_input': 0.05, 'execution': 0.9, 'check_output': 0.0001,
+                                 'hash_output': 0.05}
+    cmd_log['input']['expected'] = ['in.nii.gz']
+    cmd_log['input']['found'] = [['in.nii.gz', 'd41d8cd98f00b204e9800998ecf8427e']]
+    cmd_log['output']['expected'] = ['out.nii.gz']
+    cmd_log['output']['found'] = [['out.nii.gz', 'd41d8cd98f00b204e9800998ecf8427e']]
+    run_log['commands'] = [copy.deepcopy(cmd_log) for i in range(num_commands)]
+    return run_log
+
+
+def write_synthetic_logfile(logfile: str, num_commands: int):
+    with open(logfile, 'w') as f:
+        json.dump([synthetic_run_log(num_commands)], f, indent=2)
+
+
+def bench_run_log(tmp: str, scale: dict) -> list:
+    seconds = measure(lambda: RunLog(run_id='benchmark'), scale['repeats'])
+    return [Result('run_log_construction', seconds * 1000, 'ms', False)]
+
+
+def bench_load_log(tmp: str, scale: dict) -> list:
+    results = []
+    for num_commands in scale['log_commands']:
+        logfile = os.path.join(tmp, 'load_' + str(num_commands) + '.json')
+        write_synthetic_logfile(logfile, num_commands)
+        seconds = measure(lambda: CmdInterface.load_log(logfile), scale['repeats'])
+        results.append(Result('load_log_' + str(num_commands), num_commands / seconds, 'commands/s', True))
+    return results
+
+
+def bench_update_log(tmp: str, scale: dict) -> list:
+    """
+    Latency of logging one more command of the current run to a logfile that already contains N commands of this run.
+    """
+    results = []
+    for num_commands in scale['log_commands']:
+        logfile = os.path.join(tmp, 'update_' + str(num_commands) + '.json')
+        CmdInterface.set_static_logfile(logfile, delete_existing=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            CmdInterface('true').run()
+        run_logs = CmdInterface.load_log(logfile)
+        run_logs[-1]['commands'] = run_logs[-1]['commands'] * num_commands
+        with open(logfile, 'w') as f:
+            json.dump(run_logs, f, indent=2)
+        seconds = measure(lambda: CmdInterface('true').run(), scale['repeats'])
+        results.append(Result('update_log_' + str(num_commands), seconds * 1000, 'ms', False))
+    return results
+
+
+def bench_capture(tmp: str, scale: dict) -> list:
+    """
+    Throughput of capturing the line based output of a command line tool into the log.
+    """
+    results = []
+    for num_bytes in scale['output_bytes']:
+        logfile = os.path.join(tmp, 'capture_' + str(num_bytes) + '.json')
+
+        def setup():
+            CmdInterface.set_static_logfile(logfile, delete_existing=True)
+
+        def run():
+            runner = CmdInterface('yes')
+            runner.add_arg('"progress line of synthetic command output" | head -c ' + str(num_bytes))
+            runner.run()
+
+        seconds = measure(run, scale['repeats'], setup)
+        results.append(Result('capture_' + format_size(num_bytes), num_bytes / MB / seconds, 'MB/s', True))
+    return results
+
+
+def bench_hash(tmp: str, scale: dict) -> list:
+    """
+    Throughput of hashing output files. The files are written right before, so they are read from the page cache.
+    """
+    results = []
+    chunk = os.urandom(MB)
+    for num_bytes in scale['hash_bytes']:
+        file = os.path.join(tmp, 'hash_' + str(num_bytes) + '.bin')
+        with open(file, 'wb') as f:
+            for i in range(num_bytes // MB):
+                f.write(chunk)
+        mtimes = iter(range(1, scale['repeats'] + 1))
+
+        def touch():
+            # new modification time, otherwise the unchanged file is not read again
+            mtime_ns = next(mtimes) * 1000000000
+            os.utime(file, ns=(mtime_ns, mtime_ns))
+
+        seconds = measure(lambda: CmdInterface.get_file_hashes([file]), scale['repeats'], setup=touch)
+        results.append(Result('hash_' + format_size(num_bytes), num_bytes / MB / seconds, 'MB/s', True))
+        os.remove(file)
+    return results
+
+
+def bench_parallel_writers(tmp: str, scale: dict) -> list:
+    """
+    Throughput of N worker processes logging short commands to the same logfile.
+    """
+    results = []
+    for mode in [LogWriteMode.FILE_LOCK, LogWriteMode.SEGMENTS]:
+        for writers in scale['writers']:
+            num_commands = writers * scale['commands_per_writer']
+            logfile = os.path.join(tmp, 'parallel_' + mode.name.lower() + '_' + str(writers) + '.json')
+
+            def setup():
+                CmdInterface.set_static_logfile(logfile, delete_existing=True)
+                CmdInterface.set_log_write_mode(mode)
+
+            def run():
+                CmdInterface.run_parallel([CmdInterface('true') for i in range(num_commands)], num_workers=writers)
+
+            seconds = measure(run, scale['repeats'], setup)
+            name = 'parallel_' + mode.name.lower() + '_' + str(writers)
+            results.append(Result(name, num_commands / seconds, 'commands/s', True))
+    CmdInterface.set_log_write_mode(LogWriteMode.SINGLE_PROCESS)
+    return results
+
+
+BENCHMARKS = [bench_run_log, bench_load_log, bench_update_log, bench_capture, bench_hash, bench_parallel_writers]
+
+
+def load_baselines() -> dict:
+    if not os.path.isfile(BASELINE_FILE):
+        return dict()
+    with open(BASELINE_FILE) as f:
+        return json.load(f)
+
+
+def save_baselines(baselines: dict):
+    with open(BASELINE_FILE, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare(result: Result, baseline: dict) -> float:
+    """
+    Return ratio of result and baseline, oriented such that values above 1 are improvements.
+    """
+    if baseline is None or baseline['value'] <= 0 or result['value'] <= 0:
+        return None
+    if result['higher_is_better']:
+        return result['value'] / baseline['value']
+    return baseline['value'] / result['value']
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the cmdint hot paths.')
+    parser.add_argument('--scale', choices=sorted(SCALES.keys()), default='quick', help='size of the fixtures')
+    parser.add_argument('--filter', default=None, help='only run the benchmark functions whose name contains this string')
+    parser.add_argument('--save-baseline', action='store_true', help='store results as baselines of the scale')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='accepted relative slowdown (default 0.25)')
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with 1 if a regression is found')
+    parser.add_argument('--json', default=None, help='write results to this json file')
+    args = parser.parse_args(argv)
+
+    scale = SCALES[args.scale]
+    baselines = load_baselines()
+    scale_baselines = baselines.get(args.scale, dict())
+
+    results = []
+    regressions = []
+    print('{:<32}{:>14} {:<12}{:>14}{:>9}'.format('benchmark', 'value', 'unit', 'baseline', 'ratio'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for benchmark in BENCHMARKS:
+            if args.filter is not None and args.filter not in benchmark.__name__:
+                continue
+            for result in benchmark(tmp, scale):
+                baseline = scale_baselines.get(result['name'])
+                ratio = compare(result, baseline)
+                baseline_text = '{:.3f}'.format(baseline['value']) if baseline is not None else '-'
+                ratio_text = '{:.2f}'.format(ratio) if ratio is not None else '-'
+                if ratio is not None and ratio < 1.0 - args.tolerance:
+                    regressions.append(result['name'])
+                    ratio_text += ' !'
+                print('{:<32}{:>14.3f} {:<12}{:>14}{:>9}'.format(result['name'], result['value'], result['unit'],
+                                                                   baseline_text, ratio_text))
+                sys.stdout.flush()
+                results.append(result)
+    CmdInterface.set_static_logfile(None)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'scale': args.scale, 'results': results}, f, indent=2)
+
+    if args.save_baseline:
+        for result in results:
+            scale_baselines[result['name']] = result
+        baselines[args.scale] = scale_baselines
+        save_baselines(baselines)
+        print('Baselines saved to ' + BASELINE_FILE)
+
+    if len(regressions) > 0:
+        print('Regressions (worse than baseline by more than ' + str(args.tolerance) + '): ' + ', '.join(regressions))
+        if args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
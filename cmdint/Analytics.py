@@ -0,0 +1,416 @@
+""" Streaming statistics over CmdInterface logfiles: duration percentiles, failure rates and counts per command name and
+tool version as well as detection of significant slowdowns between two time windows or git revisions.
+"""
+import os
+import re
+import json
+import math
+import random
+
+
+class JsonStreamReader:
+    """
+    Incrementally reads a CmdInterface logfile (list of run logs) and yields the command logs one by one. Only one
+    command log and one chunk of the file are held in memory at a time, so arbitrarily large logfiles can be processed
+    in bounded memory. The keys of the run log preceding the command list (e.g. run_id and tracked_repositories) are
+    passed along with each command log.
+    """
+
+    def __init__(self, file: str, chunk_size: int = 1024 * 1024):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.__decoder = json.JSONDecoder()
+        self.__f = None
+        self.__buffer = ''
+        self.__pos = 0
+        self.__eof = False
+
+    def __read(self, size: int) -> bool:
+        """
+        Append up to size characters to the buffer. Return False if the end of the file is reached.
+        """
+        chunk = self.__f.read(size)
+        if len(chunk) == 0:
+            self.__eof = True
+            return False
+        self.__buffer = self.__buffer[self.__pos:] + chunk
+        self.__pos = 0
+        return True
+
+    def __peek(self) -> str:
+        while True:
+            while self.__pos < len(self.__buffer) and self.__buffer[self.__pos] in ' \t\r\n':
+                self.__pos += 1
+            if self.__pos < len(self.__buffer) or not self.__read(self.chunk_size):
+                break
+        return self.__buffer[self.__pos] if self.__pos < len(self.__buffer) else ''
+
+    def __next_char(self) -> str:
+        c = self.__peek()
+        if c == '':
+            raise ValueError('Unexpected end of logfile ' + self.file)
+        self.__pos += 1
+        return c
+
+    def __expect(self, expected: str):
+        c = self.__next_char()
+        if c != expected:
+            raise ValueError('Invalid logfile ' + self.file + ': expected "' + expected + '" but found "' + c + '"')
+
+    def __value(self):
+        """
+        Decode the next json value. If it is not completely contained in the buffer, more data is read with doubling
+        chunk size until it is.
+        """
+        self.__peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.__decoder.raw_decode(self.__buffer, self.__pos)
+                # numbers at the end of the buffer may be incomplete
+                if end < len(self.__buffer) or self.__eof:
+                    self.__pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.__eof:
+                    raise
+            self.__read(size)
+            size *= 2
+
+    def __iter_list(self, read_element):
+        """
+        Yield from read_element() for each element of the top level list of the file.
+        """
+        with open(self.file, 'r', encoding='utf-8') as self.__f:
+            self.__buffer = ''
+            self.__pos = 0
+            self.__eof = False
+            self.__expect('[')
+            if self.__peek() == ']':
+                return
+            while True:
+                yield from read_element()
+                if self.__next_char() == ']':
+                    return
+
+    def __iter__(self):
+        return self.__iter_list(self.__iter_run_log)
+
+    def __iter_run_log(self):
+        self.__expect('{')
+        header = dict()
+        if self.__peek() == '}':
+            self.__pos += 1
+            return
+        while True:
+            key = self.__value()
+            self.__expect(':')
+            if key == 'commands' and self.__peek() == '[':
+                self.__pos += 1
+                if self.__peek() == ']':
+                    self.__pos += 1
+                else:
+                    while True:
+                        yield header, self.__value()
+                        if self.__next_char() == ']':
+                            break
+            else:
+                header[key] = self.__value()
+            if self.__next_char() == '}':
+                return
+
+    def iter_run_logs(self, select=None):
+        """
+        Yield tuples (run log, selected) of all run logs in the file. select(header) decides, based on the keys
+        preceding the command list (e.g. run_id), if the commands of the run are kept. The commands of runs that are
+        not selected are skipped one by one and the run log is returned without commands. Without select all commands
+        are kept.
+        """
+        return self.__iter_list(lambda: self.__read_run_log(select))
+
+    def __read_run_log(self, select):
+        self.__expect('{')
+        run_log = dict()
+        selected = None
+        while self.__peek() != '}':
+            key = self.__value()
+            self.__expect(':')
+            if key == 'commands' and self.__peek() == '[':
+                if selected is None:
+                    selected = select is None or select(run_log)
+                self.__pos += 1
+                commands = []
+                if self.__peek() == ']':
+                    self.__pos += 1
+                else:
+                    while True:
+                        cmd_log = self.__value()
+                        if selected:
+                            commands.append(cmd_log)
+                        if self.__next_char() == ']':
+                            break
+                run_log['commands'] = commands
+            else:
+                run_log[key] = self.__value()
+            if self.__peek() == ',':
+                self.__pos += 1
+        self.__pos += 1
+        if selected is None:
+            selected = select is None or select(run_log)
+        yield run_log, selected
+
+
+def get_logfiles(logfile: str) -> list:
+    """
+    Return the logfile together with the per-process segments logged with LogWriteMode.SEGMENTS.
+    """
+    files = []
+    if os.path.isfile(logfile):
+        files.append(logfile)
+    segment_folder = os.path.splitext(logfile)[0] + '_segments'
+    if os.path.isdir(segment_folder):
+        files += sorted(os.path.join(segment_folder, f) for f in os.listdir(segment_folder) if f.endswith('.json'))
+    return files
+
+
+def iter_commands(logfiles: list):
+    """
+    Yield tuples (run log header, command log) of all commands in the logfiles and their segments.
+    """
+    for logfile in logfiles:
+        for file in get_logfiles(logfile):
+            yield from JsonStreamReader(file)
+
+
+_version_pattern = re.compile(r'version|revision|git commit hash|git hash', re.IGNORECASE)
+
+
+def get_tool_version(cmd_log: dict) -> str:
+    """
+    Return the version of the tool that ran the command: the first line of the version output (run with
+    version_arg) or, e.g. for MITK cmdapps called with --version, the first line of the text output that mentions a
+    version, revision or commit hash. None if no version is found.
+    """
+    if cmd_log.get('version') is not None:
+        return cmd_log['version']
+    if cmd_log.get('is_py_function'):
+        return None
+    for line in cmd_log.get('text_output', [])[:20]:
+        if _version_pattern.search(line) is not None:
+            return line.strip()[:80]
+    return None
+
+
+def get_git_revision(header: dict) -> str:
+    """
+    Return the commit hashes of all repositories tracked by the run, joined by "+". None if no repository is tracked.
+    """
+    repos = header.get('tracked_repositories')
+    if not repos:
+        return None
+    hashes = [str(repo.get('hash')) for path, repo in sorted(repos.items()) if repo.get('hash') is not None]
+    return '+'.join(hashes) if len(hashes) > 0 else None
+
+
+def get_duration(cmd_log: dict) -> float:
+    """
+    Return the duration of the command in seconds. Logs of older cmdint versions only contain the H:MM:SS string.
+    """
+    times = cmd_log.get('time', dict())
+    if times.get('duration_s') is not None:
+        return times['duration_s']
+    try:
+        hours, minutes, seconds = str(times.get('duration')).split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except ValueError:
+        return None
+
+
+def _percentile(values: list, p: float) -> float:
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lower = math.floor(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+class CommandStats:
+    """
+    Counts, failure rate and duration distribution of one command. Durations of successful runs are kept in a
+    reservoir sample of at most max_samples values, so memory stays bounded for any number of runs. Percentiles are
+    exact as long as fewer durations than max_samples have been added.
+    """
+
+    def __init__(self, max_samples: int = 10000):
+        self.max_samples = max_samples
+        self.count = 0
+        self.failed = 0
+        self.skipped = 0
+        self.duration_count = 0
+        self.duration_sum = 0.0
+        self.samples = []
+        self.__random = random.Random(0)
+
+    def add(self, return_code: int, duration: float):
+        self.count += 1
+        if return_code is not None and return_code <= 0:
+            self.failed += 1
+        elif return_code in (2, 3):
+            self.skipped += 1
+        elif return_code == 1 and duration is not None:
+            self.duration_count += 1
+            self.duration_sum += duration
+            if len(self.samples) < self.max_samples:
+                self.samples.append(duration)
+            else:
+                i = self.__random.randrange(self.duration_count)
+                if i < self.max_samples:
+                    self.samples[i] = duration
+
+    def percentile(self, p: float) -> float:
+        return _percentile(self.samples, p)
+
+    def to_dict(self) -> dict:
+        return {'count': self.count,
+                'failed': self.failed,
+                'skipped': self.skipped,
+                'failure_rate': self.failed / self.count if self.count > 0 else None,
+                'mean_s': self.duration_sum / self.duration_count if self.duration_count > 0 else None,
+                'p50_s': self.percentile(50),
+                'p90_s': self.percentile(90),
+                'p99_s': self.percentile(99)}
+
+
+def aggregate(logfiles: list, get_window=None, max_samples: int = 10000) -> dict:
+    """
+    Stream the logfiles and return dict (window, command name, tool version) -> CommandStats. get_window(header,
+    cmd_log) assigns each command to a window (e.g. "baseline" or "candidate"); commands assigned to None are ignored.
+    Without get_window all commands are assigned to window None.
+    """
+    stats = dict()
+    for header, cmd_log in iter_commands(logfiles):
+        window = None
+        if get_window is not None:
+            window = get_window(header, cmd_log)
+            if window is None:
+                continue
+        key = (window, str(cmd_log.get('name')), get_tool_version(cmd_log))
+        if key not in stats:
+            stats[key] = CommandStats(max_samples)
+        stats[key].add(cmd_log.get('return_code'), get_duration(cmd_log))
+    return stats
+
+
+def mann_whitney_greater(baseline: list, candidate: list) -> float:
+    """
+    One-sided Mann-Whitney U test (normal approximation with tie and continuity correction). Return the p-value of
+    the hypothesis that the candidate values tend to be larger than the baseline values.
+    """
+    n1 = len(baseline)
+    n2 = len(candidate)
+    if n1 == 0 or n2 == 0:
+        return 1.0
+    values = sorted([(v, 0) for v in baseline] + [(v, 1) for v in candidate])
+    ranks = [0.0] * len(values)
+    tie_term = 0.0
+    i = 0
+    while i < len(values):
+        j = i
+        while j + 1 < len(values) and values[j + 1][0] == values[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2.0 + 1
+        t = j - i + 1
+        tie_term += t ** 3 - t
+        i = j + 1
+    rank_sum = sum(rank for rank, (v, group) in zip(ranks, values) if group == 1)
+    u = rank_sum - n2 * (n2 + 1) / 2.0
+    n = n1 + n2
+    variance = n1 * n2 / 12.0 * ((n + 1) - tie_term / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (u - n1 * n2 / 2.0 - 0.5) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def detect_regressions(stats: dict, alpha: float = 0.01, min_slowdown: float = 0.1, min_runs: int = 5) -> list:
+    """
+    Compare the "baseline" and "candidate" windows of each command name (see aggregate). The durations of all tool
+    versions in a window are pooled, so a slowdown caused by a new tool version is detected as well; the versions seen
+    in each window are reported. Return list of dicts for all commands whose candidate durations are significantly
+    larger (p-value below alpha) and whose median is at least min_slowdown (relative) above the baseline median. Both
+    windows need at least min_runs successful runs.
+    """
+    windows = dict()
+    for (window, name, version), command_stats in stats.items():
+        if window not in ('baseline', 'candidate'):
+            continue
+        samples, versions = windows.setdefault((window, name), ([], set()))
+        samples.extend(command_stats.samples)
+        if version is not None and len(command_stats.samples) > 0:
+            versions.add(version)
+
+    regressions = []
+    for (window, name), (candidate, candidate_versions) in sorted(windows.items(), key=lambda item: str(item[0])):
+        if window != 'candidate' or ('baseline', name) not in windows:
+            continue
+        baseline, baseline_versions = windows[('baseline', name)]
+        if len(baseline) < min_runs or len(candidate) < min_runs:
+            continue
+        baseline_median = _percentile(baseline, 50)
+        candidate_median = _percentile(candidate, 50)
+        if baseline_median <= 0:
+            continue
+        slowdown = candidate_median / baseline_median - 1.0
+        p_value = mann_whitney_greater(baseline, candidate)
+        if p_value < alpha and slowdown >= min_slowdown:
+            regressions.append({'name': name,
+                                'baseline_versions': sorted(baseline_versions),
+                                'candidate_versions': sorted(candidate_versions),
+                                'baseline_p50_s': baseline_median,
+                                'candidate_p50_s': candidate_median,
+                                'slowdown': slowdown,
+                                'p_value': p_value})
+    return regressions
+
+
+def _format_seconds(seconds: float) -> str:
+    return '-' if seconds is None else '%.3f' % seconds
+
+
+def format_stats(stats: dict) -> str:
+    """
+    Return the output of aggregate() as text table.
+    """
+    lines = ['{:<10} {:<32} {:<32} {:>7} {:>7} {:>8} {:>10} {:>10} {:>10}'.format(
+        'window', 'command', 'version', 'runs', 'failed', 'fail %', 'p50 [s]', 'p90 [s]', 'p99 [s]')]
+    for (window, name, version), command_stats in sorted(stats.items(), key=lambda item: str(item[0])):
+        row = command_stats.to_dict()
+        lines.append('{:<10} {:<32} {:<32} {:>7} {:>7} {:>8} {:>10} {:>10} {:>10}'.format(
+            str(window) if window is not None else '-', name[:32], str(version)[:32] if version is not None else '-',
+            row['count'], row['failed'], '%.1f' % (100 * row['failure_rate']),
+            _format_seconds(row['p50_s']), _format_seconds(row['p90_s']), _format_seconds(row['p99_s'])))
+    return '\n'.join(lines)
+
+
+def format_regressions(regressions: list) -> str:
+    """
+    Return the output of detect_regressions() as text.
+    """
+    if len(regressions) == 0:
+        return 'No significant slowdowns found.'
+    lines = ['Significant slowdowns:']
+    for regression in regressions:
+        version = ''
+        if regression['baseline_versions'] != regression['candidate_versions']:
+            version = ' (' + ', '.join(regression['baseline_versions']) + ' -> ' + \
+                      ', '.join(regression['candidate_versions']) + ')'
+        elif len(regression['candidate_versions']) > 0:
+            version = ' (' + ', '.join(regression['candidate_versions']) + ')'
+        lines.append('  ' + regression['name'] + version + ': median ' +
+                     _format_seconds(regression['baseline_p50_s']) + 's -> ' +
+                     _format_seconds(regression['candidate_p50_s']) + 's (+' +
+                     '%.0f' % (100 * regression['slowdown']) + '%, p=' + '%.2g' % regression['p_value'] + ')')
+    return '\n'.join(lines)
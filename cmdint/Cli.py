@@ -0,0 +1,324 @@
+""" Command line interface of cmdint ("cmdint <subcommand>" or "python -m cmdint <subcommand>").
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from collections import deque
+from cmdint import Analytics
+from cmdint import Diff
+
+
+def stats(args) -> int:
+    get_window = None
+    if args.split is not None:
+        def get_window(header, cmd_log):
+            start = cmd_log.get('time', dict()).get('start')
+            if start is None:
+                return None
+            return 'baseline' if start < args.split else 'candidate'
+    elif args.baseline_git is not None or args.candidate_git is not None:
+        if args.baseline_git is None or args.candidate_git is None:
+            print('--baseline-git and --candidate-git have to be specified together')
+            return 2
+
+        def get_window(header, cmd_log):
+            revision = Analytics.get_git_revision(header)
+            if revision is None:
+                return None
+            hashes = revision.split('+')
+            if any(h.startswith(args.baseline_git) for h in hashes):
+                return 'baseline'
+            if any(h.startswith(args.candidate_git) for h in hashes):
+                return 'candidate'
+            return None
+
+    command_stats = Analytics.aggregate(args.logfiles, get_window=get_window, max_samples=args.max_samples)
+    regressions = []
+    if get_window is not None:
+        regressions = Analytics.detect_regressions(command_stats,
+                                                   alpha=args.alpha,
+                                                   min_slowdown=args.min_slowdown,
+                                                   min_runs=args.min_runs)
+
+    if args.json:
+        rows = []
+        for (window, name, version), s in sorted(command_stats.items(), key=lambda item: str(item[0])):
+            row = {'window': window, 'name': name, 'version': version}
+            row.update(s.to_dict())
+            rows.append(row)
+        print(json.dumps({'stats': rows, 'regressions': regressions}, indent=2))
+    else:
+        print(Analytics.format_stats(command_stats))
+        if get_window is not None:
+            print()
+            print(Analytics.format_regressions(regressions))
+    return 1 if len(regressions) > 0 else 0
+
+
+def diff(args) -> int:
+    logfile_b = args.logfile_b if args.logfile_b is not None else args.logfile
+    try:
+        if logfile_b == args.logfile:
+            run_a, run_b = Diff.load_runs(args.logfile, [args.run_a, args.run_b])
+        else:
+            run_a = Diff.load_runs(args.logfile, [args.run_a])[0]
+            run_b = Diff.load_runs(logfile_b, [args.run_b])[0]
+    except ValueError as err:
+        print(str(err))
+        return 2
+    run_diff = Diff.diff_runs(run_a, run_b, match=args.match, duration_tolerance=args.duration_tolerance)
+    if args.json:
+        print(json.dumps(run_diff, indent=2))
+    else:
+        print(Diff.format_diff(run_diff))
+    return 1 if Diff.is_different(run_diff) else 0
+
+
+def _get_exit_code(err: Exception) -> int:
+    """
+    Exit code of a failed run: the return value of the command line tool if it exited with an error (CmdInterface
+    raises OSError(return value, ...) in this case), 1 otherwise. Like in a shell, tools killed by a signal yield
+    128 + signal number and tools that cannot be found 127.
+    """
+    if isinstance(err, FileNotFoundError):
+        return 127
+    if type(err) is OSError and isinstance(err.errno, int) and err.errno != 0:
+        return err.errno if err.errno > 0 else 128 - err.errno
+    return 1
+
+
+def run(args) -> int:
+    # CmdInterface is only needed here, the reading subcommands start without it
+    from cmdint.CmdInterface import CmdInterface
+
+    command = args.command[1:] if len(args.command) > 0 and args.command[0] == '--' else args.command
+    if args.shell and len(command) > 0:
+        # a whole command line given in one argument is passed to the shell unchanged after its tool
+        command = command[0].split(None, 1) + command[1:]
+    if len(command) == 0:
+        print('No command specified, e.g. "cmdint run -- ls -l"')
+        return 2
+
+    CmdInterface.set_static_logfile(args.logfile)
+    CmdInterface.set_use_shell(args.shell)
+    CmdInterface.set_background_environment_capture()
+    if args.tail:
+        CmdInterface.set_live_tail()
+
+    runner = None
+    try:
+        runner = CmdInterface(command[0], description=args.description)
+        for arg in command[1:]:
+            runner.add_arg(arg=arg)
+        return_code = runner.run(version_arg=args.version_arg,
+                                 check_input=args.inputs,
+                                 check_output=args.outputs)
+    except OSError as err:
+        if runner is None:
+            # the command was not found, CmdInterface already printed the error
+            return 127
+        return _get_exit_code(err)
+    except Exception as err:
+        return _get_exit_code(err)
+    return 0 if return_code > 0 else 1
+
+
+def _iter_runs(logfile: str, selectors: list):
+    if len(selectors) > 0:
+        yield from Diff.load_runs(logfile, selectors)
+        return
+    files = Analytics.get_logfiles(logfile)
+    if len(files) == 0:
+        raise ValueError('Logfile not found: ' + logfile)
+    for file in files:
+        for run_log, selected in Analytics.JsonStreamReader(file).iter_run_logs():
+            yield run_log
+
+
+def _format_run(run_log: dict, output: bool) -> str:
+    lines = ['run ' + str(run_log.get('run_id'))]
+    for cmd_log in run_log.get('commands', []):
+        cmd_time = cmd_log.get('time', dict())
+        duration = cmd_time.get('duration_s')
+        lines.append('  {} {:<32} {:<24} {:>10}'.format(
+            cmd_time.get('start') or '-', str(cmd_log.get('name'))[:32],
+            str(cmd_log.get('return_code_meaning'))[:24], '%.3f s' % duration if duration is not None else '-'))
+        lines.append('      ' + str(cmd_log.get('run_string')))
+        if output:
+            for line in cmd_log.get('text_output') or []:
+                lines.append('      | ' + str(line))
+    return '\n'.join(lines)
+
+
+def show(args) -> int:
+    try:
+        runs = _iter_runs(args.logfile, args.runs)
+        if args.json:
+            print(json.dumps(list(runs), indent=2))
+        else:
+            for run_log in runs:
+                print(_format_run(run_log, output=args.output))
+    except ValueError as err:
+        print(str(err))
+        return 2
+    return 0
+
+
+def _format_tail_record(line: str) -> str:
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return line.rstrip('\n')
+    text = time.strftime('%H:%M:%S', time.localtime(record.get('time', 0))) + ' ' + str(record.get('name'))
+    event = record.get('event')
+    if event == 'output':
+        return text + ' | ' + str(record.get('text'))
+    if event == 'start':
+        return text + ' START ' + str(record.get('run_string'))
+    if event == 'end':
+        return text + ' END ' + str(record.get('meaning'))
+    return text + ' ' + str(event)
+
+
+def tail(args) -> int:
+    from cmdint.Utils import LiveTail
+
+    file = args.file if args.file is not None else LiveTail.get_tail_file(args.logfile)
+    if not os.path.isfile(file) and not args.follow:
+        print('Live tail file not found: ' + file + ' (enabled with CmdInterface.set_live_tail() or cmdint run --tail)')
+        return 2
+    while not os.path.isfile(file):
+        time.sleep(args.interval)
+
+    with open(file) as f:
+        for line in deque(f, maxlen=args.lines):
+            print(_format_tail_record(line), flush=True)
+        if not args.follow:
+            return 0
+        # records are written as complete lines, but a line may be read while it is still written
+        partial = ''
+        try:
+            while True:
+                line = f.readline()
+                if len(line) == 0:
+                    time.sleep(args.interval)
+                    continue
+                partial += line
+                if partial.endswith('\n'):
+                    print(_format_tail_record(partial), flush=True)
+                    partial = ''
+        except KeyboardInterrupt:
+            return 0
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='cmdint', description='Run command line tools with CmdInterface and analyze, '
+                                                                'compare and follow CmdInterface logfiles.')
+    subparsers = parser.add_subparsers(dest='subcommand')
+
+    stats_parser = subparsers.add_parser('stats',
+                                         help='duration percentiles, failure rates and slowdowns per command',
+                                         description='Stream the logfiles and aggregate duration percentiles, failure '
+                                                     'rates and counts per command name and tool version. If two '
+                                                     'windows are specified (--split or --baseline-git and '
+                                                     '--candidate-git), significant slowdowns of the candidate window '
+                                                     'are reported and the exit code is 1 if any are found.')
+    stats_parser.add_argument('logfiles', nargs='+', help='json logfiles (segments are included automatically)')
+    stats_parser.add_argument('--split', default=None,
+                              help='commands started before this time (e.g. "2020-06-01" or "2020-06-01 12:00:00") '
+                                   'are the baseline, later commands the candidate')
+    stats_parser.add_argument('--baseline-git', default=None, help='commit hash (prefix) of the baseline runs')
+    stats_parser.add_argument('--candidate-git', default=None, help='commit hash (prefix) of the candidate runs')
+    stats_parser.add_argument('--alpha', type=float, default=0.01, help='significance level (default 0.01)')
+    stats_parser.add_argument('--min-slowdown', type=float, default=0.1,
+                              help='minimum relative increase of the median duration (default 0.1)')
+    stats_parser.add_argument('--min-runs', type=int, default=5,
+                              help='minimum number of successful runs per window (default 5)')
+    stats_parser.add_argument('--max-samples', type=int, default=10000,
+                              help='durations kept per command and window for percentiles (default 10000)')
+    stats_parser.add_argument('--json', action='store_true', help='print results as json')
+    stats_parser.set_defaults(func=stats)
+
+    diff_parser = subparsers.add_parser('diff',
+                                        help='differences between two runs',
+                                        description='Compare environment, tracked repositories, command parameters, '
+                                                    'tool versions, input and output hashes and durations of two runs. '
+                                                    'Runs are selected by run id, unique run id prefix or index '
+                                                    '(e.g. -1 for the last run, @0 for the first run; all-digit '
+                                                    'values are run id prefixes if a run id starts with them). The '
+                                                    'exit code is 1 if the runs differ.')
+    diff_parser.add_argument('run_a', help='run id, run id prefix or index of the first run')
+    diff_parser.add_argument('run_b', help='run id, run id prefix or index of the second run')
+    diff_parser.add_argument('-l', '--logfile', default='CmdInterface.json', help='logfile (default CmdInterface.json)')
+    diff_parser.add_argument('--logfile-b', default=None, help='logfile of the second run (default is --logfile)')
+    diff_parser.add_argument('--match', choices=['position', 'output'], default='position',
+                             help='match commands by name and position or by expected output files')
+    diff_parser.add_argument('--duration-tolerance', type=float, default=0.1,
+                             help='report unchanged commands whose duration ratio deviates more (default 0.1)')
+    diff_parser.add_argument('--json', action='store_true', help='print differences as json')
+    diff_parser.set_defaults(func=diff)
+
+    run_parser = subparsers.add_parser('run',
+                                       help='run a command line tool and log it',
+                                       description='Run the command following "--" with CmdInterface and append its '
+                                                   'log to the logfile. The command is executed directly without '
+                                                   'shell unless --shell is given. The exit code is 0 if the command '
+                                                   'succeeded or did not have to run (all outputs present), the exit '
+                                                   'code of the tool if it failed and 1 for all other errors.')
+    run_parser.add_argument('-l', '--log', '--logfile', dest='logfile', default='CmdInterface.json',
+                            help='logfile (default CmdInterface.json)')
+    run_parser.add_argument('--in', dest='inputs', action='append', default=[], metavar='PATH',
+                            help='input file that has to exist before the run, hashed in the log (repeatable)')
+    run_parser.add_argument('--out', dest='outputs', action='append', default=[], metavar='PATH',
+                            help='output file that has to exist after the run, hashed in the log. The run is skipped '
+                                 'if all outputs are already present (repeatable)')
+    run_parser.add_argument('--version-arg', default=None,
+                            help='argument to print the version of the tool (e.g. "--version"), logged with the run')
+    run_parser.add_argument('--description', default=None, help='description of the run')
+    run_parser.add_argument('--shell', action='store_true',
+                            help='run the command line in a shell, e.g. for pipes or redirections. The command line '
+                                 'can also be given as one argument (e.g. "cmdint run --shell -- \'ls | wc -l\'")')
+    run_parser.add_argument('--tail', action='store_true',
+                            help='write the live tail file next to the logfile (see "cmdint tail")')
+    run_parser.add_argument('command', nargs=argparse.REMAINDER, help='-- tool [args ...]')
+    run_parser.set_defaults(func=run)
+
+    show_parser = subparsers.add_parser('show',
+                                        help='runs and commands of a logfile',
+                                        description='Print the commands of all runs or of the selected runs (run '
+                                                    'id, unique run id prefix or index, e.g. -1 for the last run or '
+                                                    '@0 for the first run).')
+    show_parser.add_argument('runs', nargs='*', help='run ids, run id prefixes or indices (default all runs)')
+    show_parser.add_argument('-l', '--logfile', '--log', default='CmdInterface.json',
+                             help='logfile (default CmdInterface.json)')
+    show_parser.add_argument('--output', action='store_true', help='include the text output of the commands')
+    show_parser.add_argument('--json', action='store_true', help='print run logs as json')
+    show_parser.set_defaults(func=show)
+
+    tail_parser = subparsers.add_parser('tail',
+                                        help='output of running commands',
+                                        description='Print the last records of the live tail file (start, output '
+                                                    'lines and end of the commands) and optionally follow it.')
+    tail_parser.add_argument('-l', '--logfile', '--log', default='CmdInterface.json',
+                             help='logfile, the tail file is located next to it (default CmdInterface.json)')
+    tail_parser.add_argument('--file', default=None, help='live tail file (default derived from --logfile)')
+    tail_parser.add_argument('-n', '--lines', type=int, default=10, help='number of records (default 10)')
+    tail_parser.add_argument('-f', '--follow', action='store_true', help='wait for new records until interrupted')
+    tail_parser.add_argument('--interval', type=float, default=0.5, help=argparse.SUPPRESS)
+    tail_parser.set_defaults(func=tail)
+    return parser
+
+
+def main(argv: list = None) -> int:
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.subcommand is None:
+        parser.print_help()
+        return 2
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
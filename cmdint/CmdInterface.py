@@ -1,19 +1,31 @@
 import os
 import subprocess
+import shlex
 from datetime import datetime
 import time
-import git
 import hashlib
 import inspect
 import json
 import io
-import chardet
+import codecs
 from pathlib import Path
-from shutil import which, move
+from shutil import which, move, rmtree
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
 from cmdint.Utils import *
 from cmdint import MessageLogger
+from cmdint import Parallel
+from cmdint import Trace
+from cmdint import Diff
 import tarfile
 import uuid
+import copy
+import atexit
+
+try:
+    import fcntl
+except ImportError:  # not available on windows
+    fcntl = None
 
 
 class CmdInterface:
@@ -30,6 +42,7 @@ class CmdInterface:
     __return_code_meanings: dict = {0: 'not run',
                                     1: 'run successful',
                                     2: 'run not necessary',
+                                    3: 'cached result',
                                     -1: 'output missing after run',
                                     -2: 'input missing',
                                     -3: 'exception'}
@@ -43,9 +56,35 @@ class CmdInterface:
     __installer_command_suffix: str = '.sh'
     __print_messages: bool = True
     __cmdint_text_output: list = []
-    __called: bool = False  # check for recursion
+    __called: ContextVar = ContextVar('cmdint_called', default=False)  # check for recursion
     __logfile_access_lost: bool = False
     __run_id: str = ''
+    __run_id_pid: int = None
+    __log_write_mode: LogWriteMode = LogWriteMode.SINGLE_PROCESS
+    __log_thread_lock: threading.RLock = threading.RLock()
+    __resource_sampling_interval: float = None
+    __resource_sampling_max_samples: int = 256
+    __profiler: OverheadProfiler = OverheadProfiler()
+    __profiler_print_registered: bool = False
+    __metrics: MetricsExporter = MetricsExporter()
+    __metrics_flush_registered: bool = False
+    __progress_interval: float = None
+    __log_update_interval: float = 5.0
+    __output_timestamps: bool = False
+    __process_pool_size: int = None
+    __memo_cache: MemoCache = None
+    # md5 state after hashing a file, keyed by (state before, path, size, modification time), see get_file_hashes
+    __hash_cache: dict = dict()
+    __hash_cache_size: int = 100000
+    __argument_encoder: ArgumentEncoder = ArgumentEncoder()
+    __use_shell: bool = True
+    __executables: dict = dict()  # (command, PATH) -> resolved executable
+    __version_cache: VersionCache = VersionCache()
+    __background_environment_capture: bool = False
+    __shell_operators: set = {'>', '>>', '<', '<<', '|', '||', '&', '&&', ';', '1>', '2>', '2>>', '&>', '2>&1'}
+    __live_tail: LiveTail = None
+    # tuple of [span, nested spans] of the currently running (possibly nested) commands
+    __span_stack: ContextVar = ContextVar('cmdint_span_stack', default=())
 
     # messenger logging
     __message_logger: MessageLogger.MessageLogger = None
@@ -72,27 +111,139 @@ class CmdInterface:
 
         self.__nested = False
         self.__no_new_log = False
+        self.__log_index = None
+        self.__sweep = None
+        self.__resources = (1, None)
+        self.__start_ns = None
         self.__ignore_cmd_retval = False
         self.__silent = False
+        self.__run_in_process = False
+        self.__last_log_update = None
         self.__log['description'] = description
 
         if not self.__is_py_function:
             command = command.strip()
             if CmdInterface.__use_installer:
                 command += CmdInterface.__installer_command_suffix
-            if len(command) == 0 or which(command) is None:
+            if len(command) == 0 or CmdInterface.__which(command) is None:
                 print('Command not found: ' + command)
                 raise OSError('Command not found: ' + command)
 
         if not self.__is_py_function and self.__no_key_options[0][:4] == 'Mitk':
             self.add_arg('--version')
 
+    @staticmethod
+    def __which(command: str) -> str:
+        """
+        Return the executable of the command found in PATH (shutil.which). Found executables are cached per PATH.
+        """
+        if os.sep in command:
+            return which(command)
+        key = (command, os.environ.get('PATH'))
+        if key not in CmdInterface.__executables:
+            executable = which(command)
+            if executable is None:
+                return None
+            CmdInterface.__executables[key] = executable
+        return CmdInterface.__executables[key]
+
+    @staticmethod
+    def set_version_cache(enable: bool = True, file: str = None):
+        """
+        The output of the version probe (run(version_arg=...)) is cached per executable, so every tool is only run
+        once with the version argument as long as it is not replaced (same path, size and modification time).
+        If file is given, the cache is stored in this json file and shared between processes and runs. Otherwise it
+        is kept for the lifetime of the process. Default is enabled without file.
+        """
+        CmdInterface.__version_cache = VersionCache(file) if enable else None
+
+    @staticmethod
+    def set_background_environment_capture(enable: bool = True):
+        """
+        Capture the local ip and the installed python packages (pip freeze) in a background thread instead of before
+        the first command is started. The first log write of a run then contains neither ("ip" and "pip_freeze" are
+        null), they are added by the first log write after the capture finished, at the latest when the command ends.
+        Default is False.
+        """
+        CmdInterface.__background_environment_capture = enable
+        if enable:
+            RunLog.capture_slow_environment()
+
     def set_ignore_cmd_retval(self, do_ignore: bool):
         """ if True, the return value of command line calls is ignored. Default is False. In this case,
         an exception is triggered if the return value is not 0.
         """
         self.__ignore_cmd_retval = do_ignore
 
+    def set_run_in_process(self, run_in_process: bool = True):
+        """ if True, the python function is run in a worker process of a reusable pool instead of a thread of this
+        process, e.g. to use several cores for CPU-bound functions run in parallel threads. The output is streamed
+        back, return value and exceptions are passed back by pickling. Function, arguments and return value therefore
+        need to be picklable (module level functions). Nested calls and commands run in the workers of run_parallel
+        are always run in threads. If the function exits (sys.exit) or the worker process ends while the function is
+        running (os._exit, killed), the run fails with return code -1. Default is False.
+        """
+        self.__run_in_process = run_in_process
+
+    @staticmethod
+    def set_process_pool_size(num_workers: int = None):
+        """
+        Set the number of worker processes for python functions run in processes (see set_run_in_process). Default is
+        None (number of available cores).
+        """
+        CmdInterface.__process_pool_size = num_workers
+
+    @staticmethod
+    def set_memo_cache(directory: str = None, max_size_gb: float = 1.0):
+        """
+        If directory is set, the return values of successfully run python functions are cached on disk. A function is
+        not run again if it is called with the same arguments, unchanged source code and unchanged input files
+        (check_input) and all of its expected output files (check_output) exist. Its cached return value is returned
+        by get_py_function_return() instead and the run is returned and logged with return code 3 (cached result),
+        also if the existing outputs would otherwise make the run unnecessary (return code 2). Functions with missing
+        outputs are run again to recreate them. The least recently used entries are removed if the cache exceeds
+        max_size_gb. Default is None (no caching).
+        """
+        if directory is None:
+            CmdInterface.__memo_cache = None
+        else:
+            CmdInterface.__memo_cache = MemoCache(directory, int(max_size_gb * 1024 ** 3))
+
+    def __get_memo_key(self) -> str:
+        """
+        Return the key of this python function call in the memo cache or None if caching is disabled.
+        """
+        if not self.__is_py_function or CmdInterface.__memo_cache is None:
+            return None
+        return MemoCache.get_key(self.__no_key_options[0],
+                                 self.__no_key_options[1:],
+                                 self.__options,
+                                 self.__log['input']['found'])
+
+    @staticmethod
+    def set_nested_context():
+        """
+        Treat all following runs in the current context as nested calls, i.e. they do not create own log entries and
+        print their output instead. Used in worker processes running the python function of a logged command.
+        """
+        CmdInterface.__called.set(True)
+        # forked workers inherit the span stack of the thread that created them
+        CmdInterface.__span_stack.set(())
+
+    @staticmethod
+    @contextmanager
+    def collect_nested_spans(parent_span: dict):
+        """
+        Collect the spans of the commands run nested in the with block as children of parent_span, the span of a
+        command running in another process. The spans are appended to the yielded list.
+        """
+        frame = [parent_span, list()]
+        token = CmdInterface.__span_stack.set((frame,))
+        try:
+            yield frame[1]
+        finally:
+            CmdInterface.__span_stack.reset(token)
+
     @staticmethod
     def set_print_messages(do_print: bool):
         """ if True, every logged message (log_message()) is also printed to stdout. Default is True.
@@ -118,6 +269,166 @@ class CmdInterface:
         """
         CmdInterface.__immediate_return_on_run_not_necessary = do_return
 
+    @staticmethod
+    def set_resource_sampling(interval: float = None, max_samples: int = 256):
+        """
+        If interval (in seconds) is set, the cpu usage, memory and I/O rates of each command are sampled periodically
+        in a separate thread and stored in the log (['resource_samples']). The number of stored samples is bounded by
+        max_samples. Longer running commands are sampled with a correspondingly increased interval. Default is None
+        (no sampling).
+        """
+        CmdInterface.__resource_sampling_interval = interval
+        CmdInterface.__resource_sampling_max_samples = max_samples
+
+    @staticmethod
+    def set_progress_interval(interval: float = None):
+        """
+        Progress output that overwrites the current line (carriage return, e.g. progress bars) is collapsed in the
+        logged text output, only the final state of the line is kept. If interval (in seconds) is set, the intermediate
+        states are additionally kept at most once per interval. Default is None (final state only).
+        """
+        CmdInterface.__progress_interval = interval
+
+    @staticmethod
+    def set_output_timestamps(enable: bool = True):
+        """
+        If enabled, the time of each line of the command output is logged as integer milliseconds since the start of
+        the command (['text_output_ms'], same length as ['text_output']). Default is False.
+        """
+        CmdInterface.__output_timestamps = enable
+
+    @staticmethod
+    def set_log_update_interval(interval: float = 5.0):
+        """
+        While a command is running, the logfile is rewritten at most every interval seconds to show the output produced
+        so far. If interval is None, the logfile is only written at the start and end of each command. Default is 5
+        seconds.
+        """
+        CmdInterface.__log_update_interval = interval
+
+    @staticmethod
+    def set_live_tail(enable: bool = True, file: str = None, log_update_interval: float = None):
+        """Write the start, output lines and end of every command to an append-only json lines file as they occur.
+        Following this file is much cheaper than rereading the json logfile, which is therefore by default only written
+        at the start and end of each command while the tail is enabled.
+
+        Keyword arguments:
+        enable -- enable or disable the live tail
+        file -- tail file (default is the logfile name with suffix _tail.jsonl, e.g. CmdInterface_tail.jsonl)
+        log_update_interval -- see set_log_update_interval; restored to the default of 5 seconds if disabled
+        """
+        if CmdInterface.__live_tail is not None:
+            CmdInterface.__live_tail.close()
+        if enable:
+            CmdInterface.__live_tail = LiveTail(file)
+            CmdInterface.set_log_update_interval(log_update_interval)
+        else:
+            CmdInterface.__live_tail = None
+            CmdInterface.set_log_update_interval()
+
+    def __tail(self, event: str, **values):
+        """
+        Write a record of this command to the live tail file if enabled (see set_live_tail).
+        """
+        if CmdInterface.__live_tail is None or self.__nested:
+            return
+        record = {'time': round(time.time(), 3),
+                  'run_id': CmdInterface.__run_id,
+                  'span_id': self.__log['span']['span_id'] if self.__log['span'] is not None else None,
+                  'name': self.__log['name'],
+                  'event': event}
+        record.update(values)
+        CmdInterface.__live_tail.write(record, CmdInterface.__logfile_name)
+
+    def __tail_line(self, line: str):
+        self.__tail('output', text=line)
+
+    def __update_log_if_due(self):
+        """
+        Write the running command to the logfile if the update interval has passed (see set_log_update_interval).
+        """
+        if self.__log_update_due(self.__last_log_update):
+            self.__last_log_update = time.monotonic()
+            self.update_log()
+
+    def __log_update_due(self, last_update: float) -> bool:
+        """
+        Check if the running command should be written to the logfile again (see set_log_update_interval).
+        """
+        return CmdInterface.__log_update_interval is not None and \
+            time.monotonic() - last_update >= CmdInterface.__log_update_interval
+
+    def __start_resource_sampler(self, pid: int) -> ResourceSampler:
+        """
+        Start sampling the resources of the process if enabled (see set_resource_sampling).
+        """
+        if CmdInterface.__resource_sampling_interval is None or self.__nested:
+            return None
+        sampler = ResourceSampler(pid,
+                                  interval=CmdInterface.__resource_sampling_interval,
+                                  max_samples=CmdInterface.__resource_sampling_max_samples)
+        sampler.start()
+        return sampler
+
+    def __stop_resource_sampler(self, sampler: ResourceSampler):
+        """
+        Stop sampling and store the samples in the log.
+        """
+        if sampler is not None:
+            self.__log['resource_samples'] = sampler.stop()
+
+    @staticmethod
+    def set_profiling(enabled: bool, print_at_exit: bool = True):
+        """
+        If True, the time cmdint itself spends on logfile access, json serialization, hashing, file checks, git and
+        environment capture, call stack inspection and messaging is measured and compared to the time spent in the
+        logged commands. The times are logged per command (['profile']) and per run (['cmdint']['profile']). If
+        print_at_exit is True, a summary of the run is printed when python exits. Default is False.
+        """
+        CmdInterface.__profiler.enabled = enabled
+        if enabled and print_at_exit and not CmdInterface.__profiler_print_registered:
+            atexit.register(CmdInterface.__print_profile)
+            CmdInterface.__profiler_print_registered = True
+
+    @staticmethod
+    def __print_profile():
+        if CmdInterface.__profiler.enabled:
+            print(CmdInterface.__profiler.format_run())
+
+    @staticmethod
+    def set_metrics_file(file: str, min_interval: float = 15.0):
+        """
+        Keep a Prometheus text file (e.g. "/var/lib/node_exporter/cmdint.prom" for the node_exporter textfile
+        collector) up to date with the number of commands per name and return code, command duration histograms, the
+        number of hashed bytes and the time spent on logfile updates. The counters are kept in memory and the file is
+        replaced atomically at most once per min_interval seconds and when python exits. Commands run in worker
+        processes (run_parallel, run_scheduled, run_shard) are counted by the calling process without duration.
+        None disables the export. Default is None.
+        """
+        CmdInterface.__metrics = MetricsExporter(file, min_interval)
+        if file is None:
+            return
+        if os.path.dirname(file) != '':
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+        if not CmdInterface.__metrics_flush_registered:
+            atexit.register(CmdInterface.write_metrics)
+            CmdInterface.__metrics_flush_registered = True
+
+    @staticmethod
+    def write_metrics():
+        """
+        Write the metrics file now, independent of the minimum interval (see set_metrics_file).
+        """
+        CmdInterface.__metrics.write(force=True)
+
+    @staticmethod
+    def get_profile() -> dict:
+        """
+        Return the times cmdint spent in its own sections and in the logged commands during the current run
+        (see set_profiling).
+        """
+        return CmdInterface.__profiler.get_run()
+
     @staticmethod
     def set_telegram_logger(token: str,
                             chat_id: str,
@@ -162,7 +473,8 @@ class CmdInterface:
         Send message to the specified service (currently slack or telegram is possible)
         """
         if CmdInterface.__message_logger is not None:
-            CmdInterface.__message_logger.send_message(message)
+            with CmdInterface.__profiler.section('messenger'):
+                CmdInterface.__message_logger.send_message(message)
 
     @staticmethod
     def send_logfile(message: str = None):
@@ -170,7 +482,8 @@ class CmdInterface:
         Send logfile to the specified service (currently slack or telegram is possible)
         """
         if CmdInterface.__message_logger is not None and os.path.isfile(CmdInterface.__logfile_name):
-            CmdInterface.__message_logger.send_file(file=CmdInterface.get_static_logfile(), message=message)
+            with CmdInterface.__profiler.section('messenger'):
+                CmdInterface.__message_logger.send_file(file=CmdInterface.get_static_logfile(), message=message)
 
     @staticmethod
     def get_static_logfile() -> str:
@@ -189,7 +502,7 @@ class CmdInterface:
         If pack_source_files is True, CmdInterface creates a tarball containing the touched python scripts excluding
         the files in "site-packages".
         """
-        if CmdInterface.__called:
+        if CmdInterface.__called.get():
             print('Nested CmdInterface usage. Logfile not set.')
             return
         CmdInterface.__logfile_name = file
@@ -207,22 +520,21 @@ class CmdInterface:
 
         if delete_existing and os.path.isfile(CmdInterface.__logfile_name):
             os.remove(CmdInterface.__logfile_name)
+        if delete_existing and os.path.isdir(CmdInterface.get_segment_folder()):
+            rmtree(CmdInterface.get_segment_folder())
 
         if os.path.dirname(file) != '':
             os.makedirs(os.path.dirname(file), exist_ok=True)
 
     @staticmethod
-    def check_exist(expected_files_folders: list) -> list:
+    def check_exist(expected_files_folders: list, snapshot: FileSystemSnapshot = None) -> list:
         """
         Check if the file paths in the input list indicate existing files.  Return list of missing files.
+        If no snapshot is given, a new FileSystemSnapshot of the input list is created.
         """
-        missing = list()
-        for f in expected_files_folders:
-            if isinstance(f, list):
-                missing += CmdInterface.check_exist(f)
-            elif not os.path.isfile(str(f)) and not os.path.isdir(str(f)):
-                missing.append(str(f))
-        return missing
+        if snapshot is None:
+            snapshot = FileSystemSnapshot()
+        return snapshot.missing(expected_files_folders)
 
     @staticmethod
     def set_autocommit_mainfile_repo(do_autocommit: bool):
@@ -241,7 +553,12 @@ class CmdInterface:
         """
         if CmdInterface.__autocommit_mainfile_repo_done:
             return
-        path = os.path.dirname(os.path.abspath(inspect.stack()[-1][1]))
+        import git  # git and chardet are imported on use to keep the import of cmdint fast
+        with CmdInterface.__profiler.section('call_stack'):
+            frame = inspect.currentframe()
+            while frame.f_back is not None:
+                frame = frame.f_back
+            path = os.path.dirname(os.path.abspath(frame.f_code.co_filename))
         try:
             git.Repo(path=path, search_parent_directories=True)
             CmdInterface.add_repo_path(path, autocommit=CmdInterface.__autocommit_mainfile_repo)
@@ -265,10 +582,12 @@ class CmdInterface:
         sensible since the logged commit hash otherwise does not capture the full state of the repository.
         """
         if os.path.isdir(path):
+            import git
             git.Repo(path=path, search_parent_directories=True)
             CmdInterface.__git_repos[path] = dict()
             CmdInterface.__git_repos[path]['autocommit'] = autocommit
-            CmdInterface.__check_repo(path)
+            with CmdInterface.__profiler.section('git'):
+                CmdInterface.__check_repo(path)
         else:
             print('"' + path + '" is not a directory')
             raise NotADirectoryError('"' + path + '" is not a directory')
@@ -287,6 +606,7 @@ class CmdInterface:
         Automatically called when a git repository path is set.
         Check if the repository is dirty and commit if necessary.
         """
+        import git
         try:
             CmdInterface.__git_repos[repo_path]['dirty_files'] = []
             repo = git.Repo(path=repo_path, search_parent_directories=True)
@@ -375,6 +695,33 @@ class CmdInterface:
             arg = ' ' + arg
         return arg
 
+    def get_argv(self) -> list:
+        """
+        Assemble and return the argument list of the command line tool (see set_use_shell). Lists are passed as
+        separate arguments, all other arguments unchanged as single argument. Returns None if the command is a python
+        function or needs a shell, i.e. if a key or argument is a shell operator such as '>' or '|'.
+        """
+        if self.__is_py_function:
+            return None
+        argv = [str(self.__no_key_options[0])]
+        if CmdInterface.__use_installer:
+            argv[0] += CmdInterface.__installer_command_suffix
+
+        for key, arg in [(None, el) for el in self.__no_key_options[1:]] + list(self.__options.items()):
+            if key is not None:
+                argv.append(key)
+            if isinstance(arg, list):
+                argv += [str(x) for x in arg]
+            elif arg is not None or key is None:
+                argv.append(str(arg))
+
+        if CmdInterface.__use_installer:
+            for rep in CmdInterface.__installer_replacements:
+                argv = [el.replace(rep[0], rep[1]) for el in argv]
+        if any(el in CmdInterface.__shell_operators for el in argv):
+            return None
+        return argv
+
     def get_run_string(self) -> str:
         """
         Assemble and return the command string that is going to be passed as shell command to subprocess.
@@ -383,7 +730,7 @@ class CmdInterface:
             run_string = str(self.__no_key_options[0].__name__) + '('
             keys = list(self.__options.keys())
             for key in keys:
-                run_string += str(key) + '=' + str(self.__options[key])
+                run_string += str(key) + '=' + CmdInterface.__argument_encoder.format(self.__options[key])
                 if key != keys[-1]:
                     run_string += ', '
             run_string += ')'
@@ -408,22 +755,26 @@ class CmdInterface:
         return run_string
 
     @staticmethod
-    def __jsonable(input):
+    def set_argument_encoder(encoder: ArgumentEncoder = None):
         """
-        Stringify everything that is not dict or list.
+        Set the ArgumentEncoder that converts the command arguments into their logged representation (['options'],
+        ['sweep']['parameters'] and the run string of python functions). Large arguments such as arrays or long lists
+        are logged as summary with their type, size and content hash. Default is ArgumentEncoder() (None restores the
+        default).
         """
-        if isinstance(input, dict):
-            out = dict()
-            for key in input.keys():
-                out[str(key)] = CmdInterface.__jsonable(input[key])
-            return out
-        elif isinstance(input, list):
-            out = list()
-            for el in input:
-                out.append(CmdInterface.__jsonable(el))
-            return out
-        else:
-            return str(input)
+        if encoder is None:
+            encoder = ArgumentEncoder()
+        CmdInterface.__argument_encoder = encoder
+
+    @staticmethod
+    def set_use_shell(use_shell: bool = True):
+        """
+        If False, command line tools are started directly with the argument list assembled by get_argv instead of a
+        shell command string, which saves starting a shell for every command. Arguments are then passed unchanged,
+        without word splitting, quote removal or globbing by the shell. Commands with pre_command or shell operators
+        (e.g. the key '>' to redirect the output into a file) are still run in a shell. Default is True.
+        """
+        CmdInterface.__use_shell = use_shell
 
     @staticmethod
     def set_use_installer(use_installer: bool, command_suffix: str = '.sh'):
@@ -445,28 +796,45 @@ class CmdInterface:
         CmdInterface.__installer_replacements.append((str(v1), str(v2)))
 
     @staticmethod
-    def get_file_hashes(files: list) -> list:
+    def get_file_hashes(files: list, snapshot: FileSystemSnapshot = None) -> list:
         """
         Iterate over the input list of filen paths and obtain MD5 hashes of these files.
         Return list of tuples (file path, hash).
+        Files whose size and modification time in the snapshot are unchanged since they were last hashed by this
+        process are not read again.
         """
+        if snapshot is None:
+            snapshot = FileSystemSnapshot(files)
         blocksize = 65536
         hasher = hashlib.md5()
         out = list()
         for file in files:
             if isinstance(file, list):
-                out += CmdInterface.get_file_hashes(file)
+                out += CmdInterface.get_file_hashes(file, snapshot)
                 continue
-            if not os.path.isfile(file):
-                if os.path.isdir(file):
+            if not snapshot.isfile(file):
+                if snapshot.isdir(file):
                     out.append((file, 'folder'))
                 continue
+            # the hash of a file also depends on the files hashed before it
+            key = (hasher.hexdigest(), os.path.abspath(file), snapshot.stat(file))
+            cached = CmdInterface.__hash_cache.get(key)
+            if cached is not None:
+                hasher = cached.copy()
+                out.append((file, hasher.hexdigest()))
+                continue
+            num_bytes = 0
             with open(file, 'rb') as afile:
                 buf = afile.read(blocksize)
                 while len(buf) > 0:
                     hasher.update(buf)
+                    num_bytes += len(buf)
                     buf = afile.read(blocksize)
                 out.append((file, hasher.hexdigest()))
+            CmdInterface.__metrics.add_hashed_bytes(num_bytes)
+            if len(CmdInterface.__hash_cache) >= CmdInterface.__hash_cache_size:
+                CmdInterface.__hash_cache.clear()
+            CmdInterface.__hash_cache[key] = hasher.copy()
         return out
 
     def __log_start(self) -> datetime:
@@ -476,8 +844,7 @@ class CmdInterface:
         ['time']['utc_offset']
         Return start time.
         """
-        if len(CmdInterface.__run_id) == 0:
-            CmdInterface.__run_id = str(uuid.uuid4())
+        CmdInterface.__get_run_id()
 
         tar = None
         packed_files = []
@@ -487,19 +854,23 @@ class CmdInterface:
             for i in range(len(packed_files)):
                 packed_files[i] = '/' + packed_files[i]
 
-        self.__log['call_stack'] = list()
-        for frame in inspect.stack()[1:]:
-            el = dict()
-            el['file'] = os.path.abspath(str(frame[1]))
-            el['line'] = str(frame[2])
-            el['function'] = str(frame[3])
-            self.__log['call_stack'].append(el)
-
-            if tar is not None and not el['file'].__contains__('site-packages') and el['file'] not in packed_files:
-                packed_files.append(el['file'])
-                file_name = os.path.basename(el['file'])
-                if file_name != 'CmdInterface.py':
-                    tar.add(name=el['file'], arcname=el['file'])
+        with CmdInterface.__profiler.section('call_stack'):
+            self.__log['call_stack'] = list()
+            # walk the frames directly, inspect.stack() also reads the source code context of every frame
+            frame = inspect.currentframe().f_back
+            while frame is not None:
+                el = dict()
+                el['file'] = os.path.abspath(frame.f_code.co_filename)
+                el['line'] = str(frame.f_lineno)
+                el['function'] = frame.f_code.co_name
+                self.__log['call_stack'].append(el)
+
+                if tar is not None and not el['file'].__contains__('site-packages') and el['file'] not in packed_files:
+                    packed_files.append(el['file'])
+                    file_name = os.path.basename(el['file'])
+                    if file_name != 'CmdInterface.py':
+                        tar.add(name=el['file'], arcname=el['file'])
+                frame = frame.f_back
 
         if tar is not None:
             tar.close()
@@ -507,6 +878,9 @@ class CmdInterface:
         start_time = datetime.now()
         self.__log['time']['start'] = start_time.strftime("%Y-%m-%d %H:%M:%S")
         self.__log['time']['utc_offset'] = time.localtime().tm_gmtoff
+        self.__start_ns = time.perf_counter_ns()
+        self.__start_span()
+        self.__tail('start', run_string=self.__log['run_string'])
         if self.__log['description'] is not None:
             CmdInterface.log_message('START: ' + self.__log['name'] + ', ' + self.__log['description'])
         else:
@@ -520,12 +894,15 @@ class CmdInterface:
         Log end time and duration of command execution:
         ['time']['end']
         ['time']['duration']
+        ['time']['duration_s'] (seconds measured with the monotonic performance counter)
         Return end time.
         """
 
         # set times
         end_time = datetime.now()
         self.__log['time']['end'] = end_time.strftime("%Y-%m-%d %H:%M:%S")
+        if self.__start_ns is not None:
+            self.__log['time']['duration_s'] = (time.perf_counter_ns() - self.__start_ns) / 1e9
 
         if start_time is None:
             return
@@ -545,7 +922,16 @@ class CmdInterface:
             print('EXCEPTION:', self.__log['name'], self.__log['description'])
             CmdInterface.log_message('Exiting due to error: ' + self.__return_code_meanings[return_code])
         self.__log['return_code'] = return_code
+        self.__end_span(return_code)
+        self.__tail('end', return_code=return_code, meaning=self.__return_code_meanings[return_code])
+        if CmdInterface.__profiler.enabled and not self.__nested:
+            self.__log['profile'] = CmdInterface.__profiler.pop_command()
         self.update_log()
+        if CmdInterface.__metrics.enabled() and not self.__nested:
+            CmdInterface.__metrics.add_command(self.__log['name'], return_code,
+                                               self.__return_code_meanings[return_code],
+                                               self.__log['time']['duration_s'])
+            CmdInterface.__metrics.write()
 
         if not self.__silent and \
                 CmdInterface.__message_log_level > MessageLogLevel.ONLY_ERRORS or \
@@ -559,6 +945,108 @@ class CmdInterface:
 
         return end_time
 
+    def __add_phase(self, name: str, start_ns: int):
+        """
+        Add the time since start_ns (time.perf_counter_ns) in seconds to the phase of this command
+        (['time']['phases'][name]). Phases are check_input, hash_input, version_probe, execution, check_output and
+        hash_output.
+        """
+        phases = self.__log['time']['phases']
+        phases[name] = phases.get(name, 0.0) + (time.perf_counter_ns() - start_ns) / 1e9
+
+    @contextmanager
+    def __phase(self, name: str):
+        """
+        Measure the enclosed block as phase of this command (see __add_phase).
+        """
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.__add_phase(name, start_ns)
+
+    def __start_span(self):
+        """
+        Open the span of this command (['span']) as child of the span of the enclosing command if run nested.
+        Start and end are monotonic clock values in nanoseconds. start_unix_ns is the start on the wall clock.
+        """
+        start_ns = time.monotonic_ns()
+        span = dict()
+        span['span_id'] = uuid.uuid4().hex[:16]
+        span['parent_id'] = None
+        span['name'] = self.__log['name']
+        span['start_ns'] = start_ns
+        span['end_ns'] = None
+        span['start_unix_ns'] = time.time_ns()
+        span_stack = CmdInterface.__span_stack.get()
+        if len(span_stack) > 0:
+            # derive wall clock start from the parent to keep the nesting exact
+            parent = span_stack[-1][0]
+            span['parent_id'] = parent['span_id']
+            span['start_unix_ns'] = parent['start_unix_ns'] + start_ns - parent['start_ns']
+        span['pid'] = os.getpid()
+        span['tid'] = threading.get_ident()
+        span['return_code'] = None
+        CmdInterface.__span_stack.set(span_stack + ([span, list()],))
+        self.__log['span'] = span
+
+    def __end_span(self, return_code: int):
+        """
+        Close the span of this command. Spans of nested commands are passed on to the enclosing command and logged
+        there (['nested_spans']), since nested commands do not create log entries themselves.
+        """
+        span_stack = CmdInterface.__span_stack.get()
+        if len(span_stack) == 0 or span_stack[-1][0] is not self.__log['span']:
+            return
+        span, nested_spans = span_stack[-1]
+        span_stack = span_stack[:-1]
+        CmdInterface.__span_stack.set(span_stack)
+        span['end_ns'] = time.monotonic_ns()
+        span['return_code'] = return_code
+        if len(span_stack) > 0:
+            span_stack[-1][1] += [span] + nested_spans
+        else:
+            self.__log['nested_spans'] = nested_spans
+
+    @staticmethod
+    def export_trace(out_file: str, logfile_name: str = None, trace_format: str = 'chrome'):
+        """Export the command spans of all runs in the logfile as trace file.
+
+        Keyword arguments:
+        out_file -- output json file
+        logfile_name -- logfile to export (default is the current logfile)
+        trace_format -- 'chrome' for the Chrome Trace Event format (chrome://tracing, Perfetto) or 'otlp' for the
+                        OpenTelemetry protocol json format
+        """
+        run_logs = CmdInterface.load_log(logfile_name)
+        if run_logs is None:
+            run_logs = []
+        if trace_format == 'chrome':
+            trace = Trace.to_chrome_trace(run_logs)
+        elif trace_format == 'otlp':
+            trace = Trace.to_otlp(run_logs)
+        else:
+            print('Unknown trace format: ' + str(trace_format))
+            raise ValueError('Unknown trace format: ' + str(trace_format))
+        if os.path.dirname(out_file) != '':
+            os.makedirs(os.path.dirname(out_file), exist_ok=True)
+        with open(out_file, 'w') as f:
+            json.dump(trace, f, indent=2)
+
+    @staticmethod
+    def diff_runs(run_a, run_b, logfile_name: str = None, match: str = 'position') -> dict:
+        """Compare two runs of the logfile and return their differences (see Diff.diff_runs and Diff.format_diff).
+
+        Keyword arguments:
+        run_a, run_b -- run id, unique run id prefix or index of the runs (e.g. -1 for the last run)
+        logfile_name -- logfile containing both runs (default is the current logfile)
+        match -- 'position' to match commands by name and position, 'output' to match by expected output files
+        """
+        if logfile_name is None:
+            logfile_name = CmdInterface.__logfile_name
+        run_a, run_b = Diff.load_runs(logfile_name, [run_a, run_b])
+        return Diff.diff_runs(run_a, run_b, match=match)
+
     @staticmethod
     def log_message(message: str, via_messenger: bool = False, add_time: bool = True):
         """
@@ -587,147 +1075,281 @@ class CmdInterface:
         """
         Run python function and store terminal output in log (['text_output']).
         """
-        original_stdout = sys.stdout
-        original_stderr = sys.stderr
-        sys.stdout = sys.stderr = out_string = io.StringIO()
+        assembler = None
+        if self.__nested or self.__silent:
+            out_stream = io.StringIO()
+        else:
+            assembler = self.__get_line_assembler()
+            out_stream = AssemblingStream(assembler, self.__get_output_time)
 
         exception = None
+        usage = ResourceUsage()
+        sampler = self.__start_resource_sampler(os.getpid())
+        phase_start = time.perf_counter_ns()
         try:
-            if self.__nested or self.__silent:
-                self.__py_function_return = self.__no_key_options[0](*self.__no_key_options[1:], **self.__options)
-            else:
-                proc = ThreadWithReturn(target=self.__no_key_options[0],
-                                        args=self.__no_key_options[1:],
-                                        kwargs=self.__options)
-                proc.start()
-                while proc.is_alive():
-                    text_output = list()
-                    for line in out_string.getvalue().split('\n'):
-                        text_output.append(line.split('\r')[-1])
-
-                    self.__log['text_output'] = text_output
-                    self.update_log()
-                    time.sleep(5)
-                self.__py_function_return, exception = proc.get_retval()
+            # only the output of this function (and its thread) is routed to the log
+            with OutputRouter.route(out_stream):
+                if self.__run_in_process and not self.__nested and Parallel.function_pool_available():
+                    self.__last_log_update = time.monotonic()
+                    self.__py_function_return, exception, resources, nested_spans = \
+                        Parallel.run_function(self.__no_key_options[0],
+                                              self.__no_key_options[1:],
+                                              self.__options,
+                                              out_stream,
+                                              num_workers=CmdInterface.__process_pool_size,
+                                              on_poll=self.__update_log_if_due,
+                                              parent_span=self.__log['span'])
+                    span_stack = CmdInterface.__span_stack.get()
+                    if len(span_stack) > 0 and span_stack[-1][0] is self.__log['span']:
+                        span_stack[-1][1] += nested_spans
+                    if resources is not None:
+                        usage = None
+                        self.__log['resources'].update(resources)
+                elif self.__nested or self.__silent:
+                    self.__py_function_return = self.__no_key_options[0](*self.__no_key_options[1:],
+                                                                         **self.__options)
+                else:
+                    proc = ThreadWithReturn(target=self.__no_key_options[0],
+                                            args=self.__no_key_options[1:],
+                                            kwargs=self.__options,
+                                            context=copy_context())
+                    proc.start()
+                    while proc.is_alive():
+                        proc.join(CmdInterface.__log_update_interval)
+                        if proc.is_alive():
+                            self.update_log()
+                    self.__py_function_return, exception = proc.get_retval()
 
         except Exception as err:
             exception = err
-        sys.stdout = original_stdout
-        sys.stderr = original_stderr
-
-        if not self.__silent:
-            if self.__nested:
-                print(out_string.getvalue(), end='')
-            else:
-                self.__log['text_output'] = out_string.getvalue().split('\n')
-                self.update_log()
+        self.__add_phase('execution', phase_start)
+        if usage is not None:
+            self.__log['resources'].update(usage.stop())
+        self.__stop_resource_sampler(sampler)
+
+        if self.__nested and not self.__silent:
+            print(out_stream.getvalue(), end='')
+        elif assembler is not None:
+            assembler.close()
+            self.update_log()
 
         if exception is not None:
             raise exception
 
-    def __cmd_to_log(self, run_string: str, version_arg: str = None):
+    def __get_line_assembler(self) -> LineAssembler:
+        """
+        Return LineAssembler that adds the command output to the log (['text_output'] and, if enabled,
+        ['text_output_ms']) and the live tail.
+        """
+        line_callback = self.__tail_line if CmdInterface.__live_tail is not None else None
+        times = None
+        if CmdInterface.__output_timestamps:
+            if self.__log['text_output_ms'] is None:
+                self.__log['text_output_ms'] = list()
+            times = self.__log['text_output_ms']
+        return LineAssembler(self.__log['text_output'], CmdInterface.__progress_interval, line_callback, times)
+
+    def __get_output_time(self) -> int:
+        """
+        Return the milliseconds since the start of this command.
+        """
+        return (time.perf_counter_ns() - self.__start_ns) // 1000000
+
+    def __capture_output(self, proc: subprocess.Popen):
         """
-        Run command line tool and store output in log.
+        Read the output of the subprocess in chunks until it is closed and add it to the log (['text_output']) as
+        assembled terminal lines (see LineAssembler). In nested mode the output is printed instead. The output is
+        decoded as utf-8; chunks that are not valid utf-8 are decoded with the detected encoding.
         """
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        assembler = None
+        if not self.__nested:
+            assembler = self.__get_line_assembler()
+        last_update = time.monotonic()
+        while True:
+            chunk = proc.stdout.read1(65536)
+            final = len(chunk) == 0
+            buffered = decoder.getstate()[0]
+            try:
+                text = decoder.decode(chunk, final=final)
+            except UnicodeDecodeError:
+                import chardet
+                chunk = buffered + chunk
+                encoding = chardet.detect(chunk)['encoding']
+                text = chunk.decode(encoding if encoding is not None else 'utf-8', errors='replace')
+                decoder.reset()
+            if self.__nested:
+                print(text, end='', flush=True)
+            else:
+                assembler.feed(text, self.__get_output_time())
+                if self.__log_update_due(last_update):
+                    last_update = time.monotonic()
+                    self.update_log()
+            if final:
+                break
+        if not self.__nested:
+            assembler.close()
+            self.update_log()
+
+    def __cmd_to_log(self, run_string: str, version_arg: str = None, argv: list = None):
+        """
+        Run command line tool and store output in log. If argv is given, the tool is started directly with this
+        argument list instead of running run_string in a shell.
+        """
+        command = argv if argv is not None else run_string
         if self.__silent:
-            retval = subprocess.call(run_string,
-                                     shell=True,
+            phase_start = time.perf_counter_ns()
+            retval = subprocess.call(command,
+                                     shell=argv is None,
                                      stdout=open(os.devnull, 'wb'),
                                      stderr=open(os.devnull, 'wb'))
+            self.__add_phase('execution', phase_start)
             if retval != 0:
                 raise OSError(retval, 'Command line subprocess return value is ' + str(retval))
             return
 
         # print version argument if using MITK cmd app or if version arg is specified explicitely
         if version_arg is not None:
-            self.__log['text_output'].append('')
-            start_time = datetime.now()
-            proc = subprocess.Popen(self.__no_key_options[0] + ' ' + version_arg,
-                                    shell=True,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.STDOUT)
-            while proc.poll() is None:
-                c = proc.stdout.read(1)
-                if c is None:
-                    continue
-                encoding = chardet.detect(c)['encoding']
-                if encoding is None:
-                    continue
-                c = str(c.decode(encoding))
+            phase_start = time.perf_counter_ns()
+            first_version_line = len(self.__log['text_output'])
+            executable = argv[0] if argv is not None else self.__no_key_options[0]
+            version_key = None
+            cached_lines = None
+            if CmdInterface.__version_cache is not None:
+                version_key = VersionCache.get_key(CmdInterface.__which(executable), version_arg, shell=argv is None)
+                if version_key is not None:
+                    cached_lines = CmdInterface.__version_cache.get(version_key)
+
+            if cached_lines is not None:
                 if self.__nested:
-                    print(c, end='')
+                    # the last cached line is the open line after the final line break, as printed live
+                    print('\n'.join(cached_lines), end='', flush=True)
                 else:
-                    if c == os.linesep or c == '\r':
-                        self.__log['text_output'].append('')
-                    else:
-                        self.__log['text_output'][-1] += c
-                        if (datetime.now() - start_time).seconds > 5:
-                            start_time = datetime.now()
-                            self.update_log()
-            res_out = proc.stdout.read()
-            encoding = chardet.detect(res_out)['encoding']
-            if encoding is not None:
-                res_out = str(res_out.decode(encoding))
-                if self.__nested:
-                    print(res_out, end='')
+                    self.__log['text_output'] += cached_lines
+            else:
+                self.__log['text_output'].append('')
+                if argv is not None:
+                    version_command = argv[:1] + shlex.split(version_arg)
                 else:
-                    if res_out[:2] != os.linesep:
-                        temp = res_out.splitlines()
-                        self.__log['text_output'][-1] += temp[0]
-                        if len(temp) > 1:
-                            self.__log['text_output'] += temp[1:]
-                    else:
-                        self.__log['text_output'] += res_out.splitlines()
-                    self.update_log()
-
+                    version_command = executable + ' ' + version_arg
+                proc = subprocess.Popen(version_command,
+                                        shell=argv is None,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+                self.__capture_output(proc)
+                # failed probes (e.g. missing display or license) are probed again on the next run
+                if proc.wait() == 0 and version_key is not None and not self.__nested:
+                    CmdInterface.__version_cache.put(version_key, self.__log['text_output'][first_version_line:])
+            self.__add_phase('version_probe', phase_start)
+            version_lines = [line.strip() for line in self.__log['text_output'][first_version_line:] if line.strip()]
+            if len(version_lines) > 0:
+                self.__log['version'] = version_lines[0]
+
+        phase_start = time.perf_counter_ns()
         self.__log['text_output'].append('')
-        start_time = datetime.now()
-        proc = subprocess.Popen(run_string,
-                                shell=True,
+        proc = subprocess.Popen(command,
+                                shell=argv is None,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.STDOUT)
-        while proc.poll() is None:
-            c = proc.stdout.read(1)
-            if c is None:
-                continue
-            encoding = chardet.detect(c)['encoding']
-            if encoding is None:
-                continue
-            c = str(c.decode(encoding))
-            if self.__nested:
-                print(c, end='')
-            else:
-                if c == os.linesep or c == '\r':
-                    self.__log['text_output'].append('')
-                else:
-                    self.__log['text_output'][-1] += c
-                    if (datetime.now() - start_time).seconds > 5:
-                        start_time = datetime.now()
-                        self.update_log()
-
-        res_out = proc.stdout.read()
-        if res_out is None:
-            return
-        encoding = chardet.detect(res_out)['encoding']
-        if encoding is None:
-            return
-        res_out = str(res_out.decode(encoding))
-
-        if self.__nested:
-            print(res_out, end='')
-        else:
-            if res_out[:2] != os.linesep:
-                temp = res_out.splitlines()
-                self.__log['text_output'][-1] += temp[0]
-                if len(temp) > 1:
-                    self.__log['text_output'] += temp[1:]
-            else:
-                self.__log['text_output'] += res_out.splitlines()
-            self.update_log()
+        sampler = self.__start_resource_sampler(proc.pid)
+        self.__capture_output(proc)
+        self.__stop_resource_sampler(sampler)
+        resources = ResourceUsage.wait(proc)
+        self.__add_phase('execution', phase_start)
+        if resources is not None:
+            self.__log['resources'].update(resources)
 
         if proc.returncode != 0 and not self.__ignore_cmd_retval:
             raise OSError(proc.returncode, 'Command line subprocess return value is ' + str(proc.returncode))
 
+    @staticmethod
+    def set_log_write_mode(mode: LogWriteMode):
+        """
+        Set how the logfile is written (see LogWriteMode). Use LogWriteMode.FILE_LOCK or LogWriteMode.SEGMENTS if
+        several processes or cluster jobs log to the same logfile concurrently. Default is LogWriteMode.SINGLE_PROCESS.
+        """
+        if mode == LogWriteMode.FILE_LOCK and fcntl is None:
+            print('File locking is not supported on this platform. Concurrent writes of multiple processes are not safe.')
+        CmdInterface.__log_write_mode = mode
+
+    @staticmethod
+    def get_segment_folder(logfile_name: str = None) -> str:
+        """
+        Return the folder containing the per-process segments of the current or the specified logfile.
+        """
+        if logfile_name is None:
+            logfile_name = CmdInterface.__logfile_name
+        return os.path.splitext(logfile_name)[0] + '_segments'
+
+    @staticmethod
+    def __get_run_id() -> str:
+        """
+        Return id of the current run. A new run id is created in each process, e.g. after forking.
+        """
+        if len(CmdInterface.__run_id) == 0 or CmdInterface.__run_id_pid != os.getpid():
+            if len(CmdInterface.__run_id) > 0:
+                # messages of the parent process are logged by the parent
+                CmdInterface.__cmdint_text_output = []
+            CmdInterface.__run_id = str(uuid.uuid4())
+            CmdInterface.__run_id_pid = os.getpid()
+        return CmdInterface.__run_id
+
+    @staticmethod
+    def __get_write_file() -> str:
+        """
+        Return the file the run log of the current process is written to.
+        """
+        if CmdInterface.__log_write_mode == LogWriteMode.SEGMENTS:
+            return os.path.join(CmdInterface.get_segment_folder(), CmdInterface.__get_run_id() + '.json')
+        return CmdInterface.__logfile_name
+
+    @staticmethod
+    def __find_run_log(run_logs: list) -> dict:
+        """
+        Return the run log of the current run or None if it is not contained in the list.
+        """
+        for run_log in reversed(run_logs):
+            if run_log['run_id'] == CmdInterface.__run_id:
+                return run_log
+        return None
+
+    @staticmethod
+    @contextmanager
+    def __logfile_lock(logfile_name: str, use_file_lock: bool = False):
+        """
+        Lock the logfile against concurrent writes of other threads and, in LogWriteMode.FILE_LOCK, other processes.
+        The inter-process lock is an advisory fcntl lock on logfile_name + '.lock' (also works on NFS).
+        """
+        with CmdInterface.__log_thread_lock:
+            use_file_lock = use_file_lock or CmdInterface.__log_write_mode == LogWriteMode.FILE_LOCK
+            if not use_file_lock or fcntl is None:
+                yield
+                return
+            with open(logfile_name + '.lock', 'a') as lock_file:
+                fcntl.lockf(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def __write_json(file: str, data: list, atomic: bool):
+        """
+        Write data as json. If atomic is True, the data is written to a temporary file that replaces the target
+        afterwards, so readers never encounter a partially written file.
+        """
+        with CmdInterface.__profiler.section('serialize_log'):
+            j = json.dumps(data, indent=2, sort_keys=False)
+        with CmdInterface.__profiler.section('write_log'):
+            if not atomic:
+                with open(file, 'w') as f:
+                    f.write(j)
+                return
+            temp_file = file + '.' + str(os.getpid()) + '.tmp'
+            with open(temp_file, 'w') as f:
+                f.write(j)
+            os.replace(temp_file, file)
+
     def get_runlogs(self) -> list:
         """
         Load list of run logs and append new run id if necessary.
@@ -736,22 +1358,23 @@ class CmdInterface:
         if CmdInterface.__logfile_name is None or self.__no_new_log:
             return None
 
-        if len(CmdInterface.__run_id) == 0:
-            CmdInterface.__run_id = str(uuid.uuid4())
+        run_id = CmdInterface.__get_run_id()
+        logfile_name = CmdInterface.__get_write_file()
 
         run_logs = []
-        if os.path.isfile(CmdInterface.__logfile_name):
+        if os.path.isfile(logfile_name):
             try:
-                with open(CmdInterface.__logfile_name) as f:
-                    run_logs = json.load(f)
+                with CmdInterface.__profiler.section('read_log'):
+                    with open(logfile_name) as f:
+                        run_logs = json.load(f)
 
                 if CmdInterface.__logfile_access_lost:
-                    CmdInterface.log_message('Logfile access regained: ' + CmdInterface.__logfile_name, True)
+                    CmdInterface.log_message('Logfile access regained: ' + logfile_name, True)
                 CmdInterface.__logfile_access_lost = False
 
             except Exception as err:
                 if not CmdInterface.__logfile_access_lost:
-                    error_string = 'Error accessing logfile: ' + CmdInterface.__logfile_name
+                    error_string = 'Error accessing logfile: ' + logfile_name
                     error_string += '\n\nException: ' + str(err)
                     error_string += '\n\nArgs: ' + str(err.args)
                     error_string += '\nProceeding ...'
@@ -759,91 +1382,153 @@ class CmdInterface:
                 CmdInterface.__logfile_access_lost = True
                 run_logs = None
 
-        if run_logs is not None and (len(run_logs) == 0 or run_logs[-1]['run_id'] != CmdInterface.__run_id):
-            run_logs.append(RunLog(run_id=CmdInterface.__run_id))
+        if run_logs is not None and CmdInterface.__find_run_log(run_logs) is None:
+            with CmdInterface.__profiler.section('environment_capture'):
+                run_logs.append(RunLog(run_id=run_id,
+                                       wait_for_slow_environment=not CmdInterface.__background_environment_capture))
 
         return run_logs
 
-    def update_log(self):
+    def __write_log(self, append: bool):
         """
-        Replace last entry of the command log list in the current run log and write to json.
+        Read the logfile, add or replace the log of this command in the run log of the current run and write the
+        logfile. The whole read-modify-write cycle is protected by __logfile_lock.
         """
-        run_logs = self.get_runlogs()
-        if run_logs is None:
+        if CmdInterface.__logfile_name is None or self.__no_new_log:
             return
 
-        run_logs[-1]['tracked_repositories'] = CmdInterface.__git_repos
-        if CmdInterface.__pack_source_files:
-            run_logs[-1]['source_tarball'] = CmdInterface.__logfile_name.replace('.json', '_' + CmdInterface.__run_id + '.tar')
-        run_logs[-1]['cmdint']['output'] += CmdInterface.__cmdint_text_output
-
         self.__log['return_code_meaning'] = self.__return_code_meanings[self.__log['return_code']]
-        self.__log['options']['no_key'] = CmdInterface.__jsonable(self.__no_key_options[1:])
-        self.__log['options']['key_val'] = CmdInterface.__jsonable(self.__options)
 
+        logfile_name = CmdInterface.__get_write_file()
+        start = time.perf_counter()
         try:
-            if len(run_logs[-1]['commands']) == 0:
-                run_logs[-1]['commands'].append(self.__log)
-            else:
-                run_logs[-1]['commands'][-1] = self.__log
-            with open(CmdInterface.__logfile_name, 'w') as f:
-                j = json.dumps(run_logs, indent=2, sort_keys=False)
-                f.write(j)
+            with CmdInterface.__logfile_lock(CmdInterface.__logfile_name):
+                run_logs = self.get_runlogs()
+                if run_logs is None:
+                    return
+
+                run_log = CmdInterface.__find_run_log(run_logs)
+                run_log['tracked_repositories'] = CmdInterface.__git_repos
+                if run_log['environment']['python']['pip_freeze'] is None:
+                    RunLog.add_slow_environment(run_log, wait=self.__log['time']['end'] is not None)
+                if CmdInterface.__pack_source_files:
+                    run_log['source_tarball'] = CmdInterface.__logfile_name.replace('.json', '_' + CmdInterface.__run_id + '.tar')
+                run_log['cmdint']['output'] += CmdInterface.__cmdint_text_output
+                if CmdInterface.__profiler.enabled:
+                    run_log['cmdint']['profile'] = CmdInterface.__profiler.get_run()
+
+                commands = run_log['commands']
+                if append or len(commands) == 0:
+                    commands.append(self.__log)
+                    self.__log_index = len(commands) - 1
+                elif self.__log_index is not None and self.__log_index < len(commands):
+                    commands[self.__log_index] = self.__log
+                else:
+                    commands[-1] = self.__log
+
+                if CmdInterface.__log_write_mode == LogWriteMode.SEGMENTS:
+                    os.makedirs(os.path.dirname(logfile_name), exist_ok=True)
+                CmdInterface.__write_json(logfile_name, run_logs,
+                                          atomic=CmdInterface.__log_write_mode != LogWriteMode.SINGLE_PROCESS)
+            CmdInterface.__metrics.add_log_write(time.perf_counter() - start)
             CmdInterface.__cmdint_text_output = []
             if CmdInterface.__logfile_access_lost:
-                CmdInterface.log_message('Logfile access regained: ' + CmdInterface.__logfile_name, True)
+                CmdInterface.log_message('Logfile access regained: ' + logfile_name, True)
             CmdInterface.__logfile_access_lost = False
         except Exception as err:
             if not CmdInterface.__logfile_access_lost:
-                error_string = 'Error accessing logfile: ' + CmdInterface.__logfile_name
+                error_string = 'Error accessing logfile: ' + logfile_name
                 error_string += '\n\nException: ' + str(err)
                 error_string += '\n\nArgs: ' + str(err.args)
                 error_string += '\nProceeding ...'
                 CmdInterface.log_message(error_string, True)
             CmdInterface.__logfile_access_lost = True
 
+    def update_log(self):
+        """
+        Replace the entry of this command in the command log list of the current run log and write to json.
+        """
+        self.__write_log(append=False)
+
     def append_log(self):
         """
         Append command log to the list held in the run log and write to file. Creates new json if it does not exist.
         """
-        run_logs = self.get_runlogs()
-        if run_logs is None:
-            return
+        self.__write_log(append=True)
 
-        run_logs[-1]['tracked_repositories'] = CmdInterface.__git_repos
-        if CmdInterface.__pack_source_files:
-            run_logs[-1]['source_tarball'] = CmdInterface.__logfile_name.replace('.json', '_' + CmdInterface.__run_id + '.tar')
-        run_logs[-1]['cmdint']['output'] += CmdInterface.__cmdint_text_output
+    @staticmethod
+    def __load_segments(logfile_name: str, log: list) -> list:
+        """
+        Merge the per-process segments of the logfile into the list of run logs. Runs that are contained in the list
+        are replaced by the version found in the segment. Return list of tuples (segment file, modification time) of
+        all merged segments.
+        """
+        segment_folder = CmdInterface.get_segment_folder(logfile_name)
+        if not os.path.isdir(segment_folder):
+            return []
 
-        self.__log['return_code_meaning'] = self.__return_code_meanings[self.__log['return_code']]
-        self.__log['options']['no_key'] = CmdInterface.__jsonable(self.__no_key_options[1:])
-        self.__log['options']['key_val'] = CmdInterface.__jsonable(self.__options)
+        merged = list()
+        new_runs = list()
+        run_index = {run_log['run_id']: i for i, run_log in enumerate(log)}
+        for segment in sorted(os.listdir(segment_folder)):
+            if not segment.endswith('.json'):
+                continue
+            segment = os.path.join(segment_folder, segment)
+            try:
+                mtime = os.stat(segment).st_mtime
+                with open(segment) as f:
+                    runs = json.load(f)
+            except Exception as err:
+                print('Error reading logfile segment: ' + segment)
+                print('Exception: ' + str(err))
+                continue
+            for run_log in runs:
+                if run_log['run_id'] in run_index:
+                    log[run_index[run_log['run_id']]] = run_log
+                else:
+                    new_runs.append(run_log)
+            merged.append((segment, mtime))
 
-        try:
-            run_logs[-1]['commands'].append(self.__log)
-            with open(CmdInterface.__logfile_name, 'w') as f:
-                j = json.dumps(run_logs, indent=2, sort_keys=False)
-                f.write(j)
-            CmdInterface.__cmdint_text_output = []
-            if CmdInterface.__logfile_access_lost:
-                CmdInterface.log_message('Logfile access regained: ' + CmdInterface.__logfile_name, True)
-            CmdInterface.__logfile_access_lost = False
-        except Exception as err:
-            if not CmdInterface.__logfile_access_lost:
-                error_string = 'Error accessing logfile: ' + CmdInterface.__logfile_name
-                error_string += '\n\nException: ' + str(err)
-                error_string += '\n\nArgs: ' + str(err.args)
-                error_string += '\nProceeding ...'
-                CmdInterface.log_message(error_string, True)
-            CmdInterface.__logfile_access_lost = True
+        def start_time(run_log):
+            if len(run_log['commands']) == 0 or run_log['commands'][0]['time']['start'] is None:
+                return ''
+            return run_log['commands'][0]['time']['start']
+
+        log += sorted(new_runs, key=start_time)
+        return merged
+
+    @staticmethod
+    def merge_log_segments(logfile_name: str = None):
+        """
+        Merge the per-process segments written in LogWriteMode.SEGMENTS into the logfile and remove the merged
+        segments. Segments that are modified during merging are kept and merged again next time.
+        """
+        if logfile_name is None:
+            logfile_name = CmdInterface.__logfile_name
+        with CmdInterface.__logfile_lock(logfile_name, use_file_lock=True):
+            log = list()
+            if os.path.isfile(logfile_name):
+                log = CmdInterface.load_log(logfile_name, merge_segments=False)
+            merged = CmdInterface.__load_segments(logfile_name, log)
+            if len(merged) == 0:
+                return
+            CmdInterface.__write_json(logfile_name, log, atomic=True)
+            for segment, mtime in merged:
+                if os.stat(segment).st_mtime == mtime:
+                    os.remove(segment)
 
     @staticmethod
-    def load_log(logfile_name: str = None) -> list:
+    def load_log(logfile_name: str = None, merge_segments: bool = True) -> list:
         """
-        Load the current or the specified json logfile and return as list of dicts.
+        Load the current or the specified json logfile and return as list of dicts. If merge_segments is True, the
+        runs logged to per-process segments of this logfile (LogWriteMode.SEGMENTS) are included.
         """
-        if logfile_name is None or not os.path.isfile(logfile_name):
-            if CmdInterface.__logfile_name is not None and os.path.isfile(CmdInterface.__logfile_name):
+        def log_exists(name):
+            return name is not None and (os.path.isfile(name) or
+                                         (merge_segments and os.path.isdir(CmdInterface.get_segment_folder(name))))
+
+        if not log_exists(logfile_name):
+            if log_exists(CmdInterface.__logfile_name):
                 logfile_name = CmdInterface.__logfile_name
             else:
                 return None
@@ -873,8 +1558,269 @@ class CmdInterface:
             print('Exception: ' + str(err))
             print(err.args)
 
+        if merge_segments:
+            CmdInterface.__load_segments(logfile_name, log)
+
         return log
 
+    @staticmethod
+    def get_shard(items: list, shard_index: int = None, shard_count: int = None) -> list:
+        """
+        Deterministically select the part of the list (e.g. CmdInterface instances or parameter combinations obtained
+        via Parallel.expand_grid) that belongs to the specified shard. If not specified, shard index and count are
+        read from the array job environment variables (SLURM_ARRAY_TASK_ID, SGE_TASK_ID, CMDINT_SHARD_INDEX, ...).
+        """
+        shard_index, shard_count = Parallel.get_shard_index_and_count(shard_index, shard_count)
+        return Parallel.select_shard(items, shard_index, shard_count)
+
+    @staticmethod
+    def get_shard_logfile(shard_index: int = None, shard_count: int = None, logfile_name: str = None) -> str:
+        """
+        Return name of the logfile of the specified shard derived from the current or the specified logfile name.
+        """
+        shard_index, shard_count = Parallel.get_shard_index_and_count(shard_index, shard_count)
+        if logfile_name is None:
+            logfile_name = CmdInterface.__logfile_name
+        base, ext = os.path.splitext(logfile_name)
+        return base + '_shard' + str(shard_index) + 'of' + str(shard_count) + ext
+
+    @staticmethod
+    def run_parallel(commands: list, num_workers: int = None, logfile_name: str = None) -> list:
+        """Run the CmdInterface instances in a pool of local worker processes and return the list of return codes.
+
+        Python functions have to be defined at module level. If errors occur, the exception or exit (see
+        set_throw_on_error and set_exit_on_error) is triggered after all commands are finished.
+
+        Keyword arguments:
+        commands -- list of CmdInterface instances
+        num_workers -- number of worker processes (default is the number of available cpu cores)
+        logfile_name -- logfile of the workers (default is the current logfile)
+        """
+        if logfile_name is None:
+            logfile_name = CmdInterface.__logfile_name
+        return_codes = Parallel.run_pool(commands, num_workers, logfile_name, CmdInterface.__log_write_mode)
+        CmdInterface.__check_batch_return_codes(commands, return_codes)
+        return return_codes
+
+    @staticmethod
+    def __check_batch_return_codes(commands: list, return_codes: list):
+        """
+        Log failed commands of a batch and throw or exit if set (see set_throw_on_error and set_exit_on_error).
+        """
+        if CmdInterface.__metrics.enabled():
+            for cmd, return_code in zip(commands, return_codes):
+                CmdInterface.__metrics.add_command(cmd.get_name(), return_code,
+                                                   CmdInterface.__return_code_meanings[return_code])
+            CmdInterface.__metrics.write()
+        failed = [cmd.get_run_string() for cmd, return_code in zip(commands, return_codes) if return_code <= 0]
+        if len(failed) > 0:
+            CmdInterface.log_message(str(len(failed)) + ' of ' + str(len(commands)) + ' commands failed: ' + str(failed))
+            if CmdInterface.__throw_on_error:
+                raise Exception(str(len(failed)) + ' of ' + str(len(commands)) + ' commands failed')
+            elif CmdInterface.__exit_on_error:
+                exit()
+
+    def set_resources(self, cores: float = 1, memory_gb: float = None):
+        """
+        Declare the number of cpu cores and the memory (in GB) this command is expected to use. The declared resources
+        are used by run_scheduled() to decide when the command can be started. Default is one core and no memory.
+        """
+        self.__resources = (cores, memory_gb)
+
+    def get_resources(self) -> tuple:
+        """
+        Return tuple (cores, memory in GB) declared for this command. Undeclared memory is returned as 0.
+        """
+        cores, memory_gb = self.__resources
+        if memory_gb is None:
+            memory_gb = 0.0
+        return cores, memory_gb
+
+    @staticmethod
+    def __estimate_memory(commands: list):
+        """
+        Set the memory of commands without declared memory to the maximum peak memory of previous successful runs with
+        the same run string or, if not available, with the same command name found in the current logfile.
+        """
+        by_run_string, by_name = CmdInterface.__get_past_values(
+            lambda cmd_log: cmd_log.get('resources', dict()).get('max_rss_bytes', None))
+        for cmd in commands:
+            if cmd.__resources[1] is not None:
+                continue
+            peaks = by_run_string.get(cmd.get_run_string(), by_name.get(cmd.get_name(), None))
+            if peaks is not None:
+                cmd.set_resources(cores=cmd.__resources[0], memory_gb=max(peaks) / (1024 ** 3))
+
+    @staticmethod
+    def run_scheduled(commands: list,
+                      max_cores: float = None,
+                      max_memory_gb: float = None,
+                      reserved_memory_gb: float = 1.0,
+                      logfile_name: str = None,
+                      estimate_memory: bool = True) -> list:
+        """Run the CmdInterface instances in parallel worker processes without overcommitting cpu cores or memory.
+
+        A command is started as soon as its declared resources (see set_resources) fit into the unused cores and the
+        free memory reported by psutil. All other commands are queued. Python functions have to be defined at module
+        level. If errors occur, the exception or exit (see set_throw_on_error and set_exit_on_error) is triggered
+        after all commands are finished.
+
+        Keyword arguments:
+        commands -- list of CmdInterface instances
+        max_cores -- number of cores to use (default is the number of available cpu cores)
+        max_memory_gb -- memory to use in GB (default is the total memory)
+        reserved_memory_gb -- memory in GB that is always kept free
+        logfile_name -- logfile of the workers (default is the current logfile)
+        estimate_memory -- use the peak memory of previous runs logged in the current logfile for commands without
+                           declared memory
+
+        Returns the list of return codes.
+        """
+        if logfile_name is None:
+            logfile_name = CmdInterface.__logfile_name
+        if estimate_memory:
+            CmdInterface.__estimate_memory(commands)
+        return_codes = Parallel.run_scheduled(commands,
+                                              logfile_name=logfile_name,
+                                              log_write_mode=CmdInterface.__log_write_mode,
+                                              max_cores=max_cores,
+                                              max_memory_gb=max_memory_gb,
+                                              reserved_memory_gb=reserved_memory_gb)
+        CmdInterface.__check_batch_return_codes(commands, return_codes)
+        return return_codes
+
+    @staticmethod
+    def run_shard(commands: list,
+                  shard_index: int = None,
+                  shard_count: int = None,
+                  num_workers: int = None,
+                  shard_logfile: str = None) -> list:
+        """Select the part of the command list that belongs to this shard (see get_shard) and run it in a pool of
+        local worker processes (see run_parallel). Use this to distribute commands over the tasks of a cluster array
+        job. Each shard is logged to its own logfile, which can be combined later on using merge_logs.
+
+        Keyword arguments:
+        commands -- list of CmdInterface instances (the same list in all shards)
+        shard_index -- index of this shard (default is read from the array job environment)
+        shard_count -- number of shards (default is read from the array job environment)
+        num_workers -- number of local worker processes (default is the number of available cpu cores)
+        shard_logfile -- logfile of this shard (default is the current logfile name with suffix _shard[index]of[count])
+
+        Returns the list of return codes of the commands in this shard.
+        """
+        shard_index, shard_count = Parallel.get_shard_index_and_count(shard_index, shard_count)
+        if shard_logfile is None:
+            shard_logfile = CmdInterface.get_shard_logfile(shard_index, shard_count)
+        return CmdInterface.run_parallel(CmdInterface.get_shard(commands, shard_index, shard_count),
+                                         num_workers=num_workers,
+                                         logfile_name=shard_logfile)
+
+    @staticmethod
+    def __fill_placeholders(arg, placeholders: dict):
+        """
+        Replace the placeholders ({name}) in all strings contained in the (nested) argument.
+        """
+        if isinstance(arg, list):
+            return [CmdInterface.__fill_placeholders(el, placeholders) for el in arg]
+        if isinstance(arg, str) and '{' in arg:
+            for name, value in placeholders.items():
+                arg = arg.replace('{' + name + '}', str(value))
+        return arg
+
+    @staticmethod
+    def expand_sweep(template, grid: dict, zipped: bool = False) -> list:
+        """Create one copy of the template CmdInterface instance per parameter combination of the grid.
+
+        The grid maps argument keys (as used in add_arg) to lists of values. The values replace the arguments of the
+        template or are added as new arguments. String arguments of the template, e.g. output paths, may contain
+        placeholders {name} where name is the argument key without leading dashes, e.g. {num_trees} for the key
+        --num_trees. The placeholder {sweep_index} is replaced by the index of the parameter combination.
+
+        Keyword arguments:
+        template -- CmdInterface instance
+        grid -- dict of argument keys and lists of argument values
+        zipped -- combine the i-th values of all lists instead of using all combinations (Cartesian product)
+
+        Each instance logs the sweep id, its index and its parameters (['sweep']), see load_sweep().
+        """
+        sweep_id = str(uuid.uuid4())
+        commands = list()
+        for index, parameters in enumerate(Parallel.expand_grid(grid, zipped=zipped)):
+            cmd = copy.deepcopy(template)
+            placeholders = {'sweep_index': index}
+            for key, value in parameters.items():
+                key = str(key)
+                if key in cmd.__options.keys():
+                    old_value = cmd.__options[key]
+                    cmd.__check_input = [value if el is old_value else el for el in cmd.__check_input]
+                    cmd.__check_output = [value if el is old_value else el for el in cmd.__check_output]
+                cmd.__options[key] = value
+                placeholders[key.lstrip('-').replace('-', '_')] = value
+
+            cmd.__no_key_options[1:] = CmdInterface.__fill_placeholders(cmd.__no_key_options[1:], placeholders)
+            for key in cmd.__options.keys():
+                cmd.__options[key] = CmdInterface.__fill_placeholders(cmd.__options[key], placeholders)
+            cmd.__check_input = CmdInterface.__fill_placeholders(cmd.__check_input, placeholders)
+            cmd.__check_output = CmdInterface.__fill_placeholders(cmd.__check_output, placeholders)
+
+            cmd.__sweep = dict()
+            cmd.__sweep['id'] = sweep_id
+            cmd.__sweep['index'] = index
+            cmd.__sweep['parameters'] = CmdInterface.__argument_encoder.encode(parameters)
+            commands.append(cmd)
+        return commands
+
+    @staticmethod
+    def sweep(template, grid: dict, zipped: bool = False, num_workers: int = None) -> list:
+        """
+        Expand the template CmdInterface instance over the parameter grid (see expand_sweep) and run all parameter
+        combinations in a pool of local worker processes (see run_parallel). Return the list of return codes.
+        """
+        return CmdInterface.run_parallel(CmdInterface.expand_sweep(template, grid, zipped=zipped), num_workers)
+
+    @staticmethod
+    def load_sweep(sweep_id: str = None, logfile_name: str = None) -> list:
+        """
+        Return the command logs of all commands run as part of the specified parameter sweep (default is the last
+        sweep found in the logfile), sorted by the index of the parameter combination.
+        """
+        run_logs = CmdInterface.load_log(logfile_name)
+        if run_logs is None:
+            return []
+        cmd_logs = [cmd_log for run_log in run_logs for cmd_log in run_log['commands']
+                    if cmd_log.get('sweep', None) is not None]
+        if len(cmd_logs) == 0:
+            return []
+        if sweep_id is None:
+            sweep_id = cmd_logs[-1]['sweep']['id']
+        cmd_logs = [cmd_log for cmd_log in cmd_logs if cmd_log['sweep']['id'] == sweep_id]
+        return sorted(cmd_logs, key=lambda cmd_log: cmd_log['sweep']['index'])
+
+    @staticmethod
+    def merge_logs(logfiles: list, out_logfile: str):
+        """
+        Combine the run logs of multiple logfiles (e.g. the logfiles of all shards) into one logfile. Runs already
+        contained in the output logfile are replaced.
+        """
+        with CmdInterface.__logfile_lock(out_logfile, use_file_lock=True):
+            log = list()
+            if os.path.isfile(out_logfile):
+                log = CmdInterface.load_log(out_logfile)
+            run_index = {run_log['run_id']: i for i, run_log in enumerate(log)}
+            for logfile in logfiles:
+                if not os.path.isfile(logfile) and not os.path.isdir(CmdInterface.get_segment_folder(logfile)):
+                    print('Logfile not found: ' + logfile)
+                    continue
+                for run_log in CmdInterface.load_log(logfile):
+                    if run_log['run_id'] in run_index:
+                        log[run_index[run_log['run_id']]] = run_log
+                    else:
+                        run_index[run_log['run_id']] = len(log)
+                        log.append(run_log)
+            if os.path.dirname(out_logfile) != '':
+                os.makedirs(os.path.dirname(out_logfile), exist_ok=True)
+            CmdInterface.__write_json(out_logfile, log, atomic=True)
+
     @staticmethod
     def anonymize_log(out_log_name: str = None,
                       clear_strings: str = None,
@@ -970,6 +1916,182 @@ class CmdInterface:
                     print('Exception: ' + str(err))
                     print(err.args)
 
+    def get_name(self) -> str:
+        """
+        Return the name of the command or python function as it is stored in the log (['name']).
+        """
+        if self.__is_py_function:
+            return str(self.__no_key_options[0].__name__)
+        return str(self.__no_key_options[0])
+
+    @staticmethod
+    def __flatten_paths(paths: list) -> list:
+        """
+        Flatten (nested) list of file paths and convert all entries to strings.
+        """
+        out = list()
+        for p in paths:
+            if isinstance(p, list):
+                out += CmdInterface.__flatten_paths(p)
+            else:
+                out.append(str(p))
+        return out
+
+    @staticmethod
+    def __duration_to_seconds(duration: str) -> float:
+        """
+        Convert a logged duration string (H:MM:SS) to seconds. Returns None if the string can't be parsed.
+        """
+        try:
+            hours, minutes, seconds = str(duration).split(':')
+            return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def __get_past_values(get_value, logfile_name: str = None) -> tuple:
+        """
+        Collect a value (obtained by calling get_value with the command log) of all successful runs found in the
+        logfile. Return two dicts mapping run string and command name to lists of values. None values are skipped.
+        """
+        by_run_string = dict()
+        by_name = dict()
+        run_logs = CmdInterface.load_log(logfile_name)
+        if run_logs is None:
+            return by_run_string, by_name
+        for run_log in run_logs:
+            for cmd_log in run_log['commands']:
+                if cmd_log['return_code'] != 1:
+                    continue
+                value = get_value(cmd_log)
+                if value is None:
+                    continue
+                by_run_string.setdefault(cmd_log['run_string'], list()).append(value)
+                by_name.setdefault(cmd_log['name'], list()).append(value)
+        return by_run_string, by_name
+
+    @staticmethod
+    def __get_past_durations(logfile_name: str = None) -> tuple:
+        """
+        Collect the durations in seconds of all successful runs found in the logfile (see __get_past_values).
+        """
+        def get_duration(cmd_log: dict) -> float:
+            # logs of older cmdint versions only contain the H:MM:SS string
+            if cmd_log['time'].get('duration_s') is not None:
+                return cmd_log['time']['duration_s']
+            return CmdInterface.__duration_to_seconds(cmd_log['time']['duration'])
+
+        return CmdInterface.__get_past_values(get_duration, logfile_name)
+
+    def plan(self, check_input: list = None, check_output: list = None, logfile_name: str = None) -> dict:
+        """
+        Dry run: evaluate the input and output checks of this command without executing it.
+        See plan_pipeline() for a description of the returned row.
+        """
+        return CmdInterface.plan_pipeline([self],
+                                          check_input=[check_input],
+                                          check_output=[check_output],
+                                          logfile_name=logfile_name)[0]
+
+    @staticmethod
+    def plan_pipeline(commands: list,
+                      check_input: list = None,
+                      check_output: list = None,
+                      logfile_name: str = None,
+                      print_table: bool = False) -> list:
+        """Dry run of a list of CmdInterface instances in the given order. Nothing is executed and nothing is logged.
+
+        The same rules as in run() are applied: a command is skipped if all of its outputs are present and it fails if
+        one of its inputs is missing. Outputs of commands that are planned to run count as present for all following
+        commands. The existence of all declared files is checked only once for the whole list.
+
+        Keyword arguments:
+        commands -- list of CmdInterface instances
+        check_input -- optional list (one entry per command) of additional input files, as passed to run()
+        check_output -- optional list (one entry per command) of additional output files, as passed to run()
+        logfile_name -- logfile used to estimate the durations (default is the current logfile)
+        print_table -- print the plan as table to stdout
+
+        Returns one dict per command with the keys name, run_string, action ('run', 'skip' or 'fail'),
+        return_code (the code run() is expected to return), missing_input, missing_output and estimated_duration
+        (mean duration in seconds of previous successful runs with the same run string or, if not available, with
+        the same command name; None if the command was never logged).
+        """
+        if check_input is None:
+            check_input = [None] * len(commands)
+        if check_output is None:
+            check_output = [None] * len(commands)
+
+        inputs = list()
+        outputs = list()
+        for cmd, cin, cout in zip(commands, check_input, check_output):
+            inputs.append(CmdInterface.__flatten_paths(cmd.__check_input + (cin if cin is not None else [])))
+            outputs.append(CmdInterface.__flatten_paths(cmd.__check_output + (cout if cout is not None else [])))
+
+        # bulk existence check of all declared files
+        missing = set(CmdInterface.check_exist(inputs + outputs))
+
+        by_run_string, by_name = CmdInterface.__get_past_durations(logfile_name)
+
+        plan = list()
+        planned_outputs = set()
+        for cmd, cmd_inputs, cmd_outputs in zip(commands, inputs, outputs):
+            row = dict()
+            row['name'] = cmd.get_name()
+            row['run_string'] = cmd.get_run_string()
+            row['missing_input'] = [p for p in cmd_inputs if p in missing and p not in planned_outputs]
+            row['missing_output'] = [p for p in cmd_outputs if p in missing and p not in planned_outputs]
+
+            if len(cmd_outputs) > 0 and len(row['missing_output']) == 0:
+                row['action'] = 'skip'
+                row['return_code'] = 2
+            elif len(row['missing_input']) > 0:
+                row['action'] = 'fail'
+                row['return_code'] = -2
+            else:
+                row['action'] = 'run'
+                row['return_code'] = 1
+                planned_outputs.update(cmd_outputs)
+
+            durations = by_run_string.get(row['run_string'], by_name.get(row['name'], None))
+            row['estimated_duration'] = None
+            if durations is not None:
+                row['estimated_duration'] = sum(durations) / len(durations)
+            plan.append(row)
+
+        if print_table:
+            print(CmdInterface.format_plan(plan))
+
+        return plan
+
+    @staticmethod
+    def format_plan(plan: list) -> str:
+        """
+        Format the output of plan_pipeline() as text table including the total estimated duration of all commands
+        that are going to run.
+        """
+        lines = ['%-6s %-6s %-12s %s' % ('#', 'ACTION', 'EST. TIME', 'COMMAND')]
+        total = 0.0
+        unknown = 0
+        for i, row in enumerate(plan):
+            estimate = '?'
+            if row['estimated_duration'] is not None:
+                estimate = '%.1fs' % row['estimated_duration']
+            if row['action'] == 'run':
+                if row['estimated_duration'] is None:
+                    unknown += 1
+                else:
+                    total += row['estimated_duration']
+            line = '%-6d %-6s %-12s %s' % (i, row['action'], estimate, row['run_string'])
+            if row['action'] == 'fail':
+                line += '  (missing input: ' + ', '.join(row['missing_input']) + ')'
+            lines.append(line)
+        counts = [sum(1 for row in plan if row['action'] == a) for a in ['run', 'skip', 'fail']]
+        lines.append('run: %d, skip: %d, fail: %d, estimated time: %.1fs' % (counts[0], counts[1], counts[2], total))
+        if unknown > 0:
+            lines[-1] += ' (+ %d commands without previous runs)' % unknown
+        return '\n'.join(lines)
+
     def run(self, version_arg: str = None,
             pre_command: str = None,
             check_input: list = None,
@@ -987,8 +2109,9 @@ class CmdInterface:
                         (optional, list of strings)
         silent -- don't creat log entry for this command
 
-        Return codes: 0=not run, 1=run successful, 2=run not necessary,
-                      -1=output missing after run, -2=input missing, -3=exception
+        Return codes: 0=not run, 1=run successful, 2=run not necessary, 3=cached result (see set_memo_cache),
+                      -1=output missing after run or worker process exited (see set_run_in_process),
+                      -2=input missing, -3=exception
         """
         return_code = 0
         if check_input is None:
@@ -1003,64 +2126,100 @@ class CmdInterface:
         self.__nested = False
         self.__no_new_log = silent
         self.__silent = silent
-        if CmdInterface.__called:
+        if CmdInterface.__called.get():
             self.__no_new_log = True
             self.__nested = True
-        CmdInterface.__called = True
+        CmdInterface.__called.set(True)
 
         # check if run is necessary or if output is already present
+        with self.__phase('check_output'), CmdInterface.__profiler.section('check_output'):
+            snapshot = FileSystemSnapshot([check_output, check_input])
+            missing_outputs = CmdInterface.check_exist(check_output, snapshot)
         run_necessary = False
-        if len(check_output) == 0 or len(CmdInterface.check_exist(check_output)) > 0:
+        memo_key = None
+        if len(check_output) == 0 or len(missing_outputs) > 0:
             run_necessary = True
         else:
             return_code = 2
-            if CmdInterface.__immediate_return_on_run_not_necessary:
+            # memoized python functions return their cached value even if the run is not necessary
+            if self.__is_py_function and CmdInterface.__memo_cache is not None:
+                with self.__phase('hash_input'), CmdInterface.__profiler.section('file_hashes'):
+                    self.__log['input']['found'] = CmdInterface.get_file_hashes(check_input, snapshot)
+                memo_key = self.__get_memo_key()
+                cached, self.__py_function_return = CmdInterface.__memo_cache.load(memo_key)
+                if cached:
+                    return_code = 3
+            if return_code == 2 and CmdInterface.__immediate_return_on_run_not_necessary:
                 self.__log = CmdLog()
                 if not self.__nested:
-                    CmdInterface.__called = False
+                    CmdInterface.__called.set(False)
                 return return_code
 
         # check if run is prossible or if input is missing
         run_possible = True
-        missing_inputs = CmdInterface.check_exist(check_input)
+        with self.__phase('check_input'), CmdInterface.__profiler.section('check_input'):
+            missing_inputs = CmdInterface.check_exist(check_input, snapshot)
         self.__log['input']['missing'] = missing_inputs
         if len(missing_inputs) > 0:
             run_possible = False
             return_code = -2
+            self.__py_function_return = None
 
         # create actual command string
-        if pre_command is not None:
+        argv = None
+        if not CmdInterface.__use_shell and pre_command is None:
+            argv = self.get_argv()
+        if argv is not None:
+            run_string = ' '.join(shlex.quote(a) for a in argv)
+        elif pre_command is not None:
             run_string = pre_command + os.linesep + self.get_run_string()
         else:
             run_string = self.get_run_string()
 
         # start logging
         self.__log['is_py_function'] = self.__is_py_function
-        if self.__is_py_function:
-            self.__log['name'] = str(self.__no_key_options[0].__name__)
-        else:
-            self.__log['name'] = str(self.__no_key_options[0])
+        self.__log['name'] = self.get_name()
         self.__log['input']['expected'] = check_input
         self.__log['output']['expected'] = check_output
         self.__log['run_string'] = run_string
+        self.__log['sweep'] = self.__sweep
+        # arguments are encoded once per run and not on every log update
+        self.__log['options']['no_key'] = CmdInterface.__argument_encoder.encode(self.__no_key_options[1:])
+        self.__log['options']['key_val'] = CmdInterface.__argument_encoder.encode(self.__options)
 
         start_time = self.__log_start()
         self.append_log()
 
         exception = None
         if run_necessary and run_possible:
-            self.__log['input']['found'] = CmdInterface.get_file_hashes(check_input)
-
+            with self.__phase('hash_input'), CmdInterface.__profiler.section('file_hashes'):
+                self.__log['input']['found'] = CmdInterface.get_file_hashes(check_input, snapshot)
+            memo_key = self.__get_memo_key()
+            if memo_key is not None and len(missing_outputs) == 0:
+                cached, self.__py_function_return = CmdInterface.__memo_cache.load(memo_key)
+                if cached:
+                    return_code = 3
+
+        if return_code == 3:
+            CmdInterface.log_message('Skipping execution. Cached result of identical call found.')
+            with self.__phase('hash_output'), CmdInterface.__profiler.section('file_hashes'):
+                self.__log['output']['found'] = CmdInterface.get_file_hashes(check_output, snapshot)
+
+        elif run_necessary and run_possible:
             try:
                 # run command
-                if self.__is_py_function:
-                    self.__pyfunction_to_log()  # command is python function
-                else:
-                    self.__cmd_to_log(run_string=run_string,
-                                      version_arg=version_arg)  # command is external tool
+                with CmdInterface.__profiler.section('command'):
+                    if self.__is_py_function:
+                        self.__pyfunction_to_log()  # command is python function
+                    else:
+                        self.__cmd_to_log(run_string=run_string,
+                                          version_arg=version_arg,
+                                          argv=argv)  # command is external tool
 
                 # check if output was produced as expected
-                missing_output = CmdInterface.check_exist(check_output)
+                with self.__phase('check_output'), CmdInterface.__profiler.section('check_output'):
+                    snapshot = FileSystemSnapshot(check_output)
+                    missing_output = CmdInterface.check_exist(check_output, snapshot)
                 if len(missing_output) > 0:
                     CmdInterface.log_message('Something went wrong! Expected output files are missing: ' + str(missing_output))
                     self.__log['output']['missing'] = missing_output
@@ -1068,9 +2227,10 @@ class CmdInterface:
                     exception = MissingOutputError(missing_output)
                 else:
                     # everything went as expected
-                    self.__log['output']['found'] = CmdInterface.get_file_hashes(check_output)
+                    with self.__phase('hash_output'), CmdInterface.__profiler.section('file_hashes'):
+                        self.__log['output']['found'] = CmdInterface.get_file_hashes(check_output, snapshot)
                     return_code = 1
-            except MissingOutputError as err:
+            except (MissingOutputError, ProcessExitError) as err:
                 return_code = -1
                 exception = err
 
@@ -1104,6 +2264,9 @@ class CmdInterface:
                 error_string += '\nLine: ' + str(exc_tb.tb_lineno)
                 CmdInterface.log_message(error_string)
 
+            if return_code == 1 and memo_key is not None:
+                CmdInterface.__memo_cache.store(memo_key, self.__py_function_return)
+
         elif not run_necessary:
             CmdInterface.log_message('Skipping execution. All output files already present.')
 
@@ -1112,7 +2275,7 @@ class CmdInterface:
             exception = MissingInputError(missing_inputs)
 
         if not self.__nested:
-            CmdInterface.__called = False
+            CmdInterface.__called.set(False)
 
         # end logging
         self.__log_end(start_time, return_code=return_code)
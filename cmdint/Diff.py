@@ -0,0 +1,244 @@
+""" Structural comparison of two run logs: environment, tracked repositories, command parameters, input and output
+hashes, return codes, tool versions and durations.
+"""
+from collections import deque
+from cmdint import Analytics
+
+# run log keys that differ between any two runs and are not compared
+IGNORED_RUN_KEYS = ('run_id', 'commands', 'cmdint', 'source_tarball')
+
+# compared command log keys
+COMMAND_KEYS = ('run_string', 'version', 'options', 'return_code', 'sweep')
+
+
+def load_runs(logfile: str, selectors: list) -> list:
+    """
+    Stream the logfile (including its segments) and return the run logs matching the selectors in the order of the
+    selectors. A selector is a run id, a unique run id prefix or an index into the list of runs: an integer, a string
+    with a leading "@" (e.g. "@3") or a negative number string (e.g. "-1", counting from the end). Run ids are hex
+    strings, so an all-digit string (e.g. "1234") is matched against the run ids first and only used as index if no
+    run id starts with it. Only the selected runs are kept in memory. Raises ValueError if a run is not found.
+    """
+    indices = dict()
+    prefixes = dict()
+    for i, selector in enumerate(selectors):
+        if isinstance(selector, int):
+            indices[i] = selector
+            continue
+        selector = str(selector)
+        try:
+            if selector.startswith('@'):
+                indices[i] = int(selector[1:])
+                continue
+            if selector.startswith('-'):
+                indices[i] = int(selector)
+                continue
+        except ValueError:
+            raise ValueError('Invalid run index: ' + selector)
+        prefixes[i] = selector
+        if selector.isdigit():
+            indices[i] = int(selector)  # used if no run id starts with the selector
+
+    # runs at negative indices are only known at the end, so the last ones are kept
+    keep_last = max([-index for index in indices.values() if index < 0] + [0])
+    last_runs = deque(maxlen=keep_last)
+    by_index = dict()
+    by_prefix = dict()
+    count = 0
+
+    def select(header: dict) -> bool:
+        return keep_last > 0 or count in indices.values() or \
+            any(str(header.get('run_id')).startswith(prefix) for prefix in prefixes.values())
+
+    for file in Analytics.get_logfiles(logfile):
+        for run_log, selected in Analytics.JsonStreamReader(file).iter_run_logs(select):
+            if selected:
+                by_index[count] = run_log
+                for i, prefix in prefixes.items():
+                    if str(run_log.get('run_id')).startswith(prefix):
+                        if i in by_prefix:
+                            raise ValueError('Run id prefix ' + prefix + ' is not unique in ' + logfile)
+                        by_prefix[i] = run_log
+                if keep_last > 0:
+                    last_runs.append(run_log)
+                    by_index = {index: run for index, run in by_index.items() if index in indices.values()}
+            count += 1
+
+    runs = []
+    for i, selector in enumerate(selectors):
+        if i in by_prefix or i not in indices:
+            run_log = by_prefix.get(i)
+        elif indices[i] < 0:
+            run_log = last_runs[indices[i]] if -indices[i] <= len(last_runs) else None
+        else:
+            run_log = by_index.get(indices[i])
+        if run_log is None:
+            raise ValueError('Run ' + str(selector) + ' not found in ' + logfile)
+        runs.append(run_log)
+    return runs
+
+
+def diff_values(a, b, path: str = '') -> list:
+    """
+    Return list of tuples (path, value a, value b) of all differences between the two json values. Dicts are
+    compared key by key, all other values as a whole. Missing keys are reported as None.
+    """
+    if isinstance(a, dict) and isinstance(b, dict):
+        differences = []
+        for key in sorted(set(a.keys()) | set(b.keys()), key=str):
+            sub_path = path + '/' + str(key) if path != '' else str(key)
+            differences += diff_values(a.get(key), b.get(key), sub_path)
+        return differences
+    if a != b:
+        return [(path, a, b)]
+    return []
+
+
+def _file_hashes(cmd_log: dict, key: str) -> dict:
+    """
+    Return the hashes of the found input or output files as dict file -> hash.
+    """
+    return {str(file): str(file_hash) for file, file_hash in cmd_log.get(key, dict()).get('found', [])}
+
+
+def _output_key(cmd_log: dict):
+    expected = cmd_log.get('output', dict()).get('expected', [])
+    flat = []
+    stack = list(expected)
+    while len(stack) > 0:
+        el = stack.pop()
+        if isinstance(el, list):
+            stack += el
+        else:
+            flat.append(str(el))
+    return tuple(sorted(flat)) if len(flat) > 0 else None
+
+
+def match_commands(commands_a: list, commands_b: list, by: str = 'position') -> list:
+    """
+    Line up the commands of two runs. Return list of tuples (index in a, index in b); unmatched commands have None
+    as index of the other run.
+
+    by -- 'position': the i-th command with a certain name in a is matched with the i-th command with this name in b.
+          'output': commands with the same expected output files are matched, the remaining commands by position.
+    """
+    pairs = []
+    matched_a = set()
+    matched_b = set()
+    if by == 'output':
+        by_output = dict()
+        for j, cmd_log in enumerate(commands_b):
+            key = _output_key(cmd_log)
+            if key is not None:
+                by_output.setdefault(key, deque()).append(j)
+        for i, cmd_log in enumerate(commands_a):
+            key = _output_key(cmd_log)
+            if key is not None and len(by_output.get(key, [])) > 0:
+                j = by_output[key].popleft()
+                pairs.append((i, j))
+                matched_a.add(i)
+                matched_b.add(j)
+    elif by != 'position':
+        raise ValueError('Unknown matching: ' + str(by))
+
+    by_name = dict()
+    for j, cmd_log in enumerate(commands_b):
+        if j not in matched_b:
+            by_name.setdefault(cmd_log.get('name'), deque()).append(j)
+    for i, cmd_log in enumerate(commands_a):
+        if i in matched_a:
+            continue
+        candidates = by_name.get(cmd_log.get('name'))
+        if candidates is not None and len(candidates) > 0:
+            j = candidates.popleft()
+            pairs.append((i, j))
+            matched_b.add(j)
+        else:
+            pairs.append((i, None))
+    pairs += [(None, j) for j in range(len(commands_b)) if j not in matched_b]
+    pairs.sort(key=lambda pair: (pair[0] if pair[0] is not None else float('inf'),
+                                 pair[1] if pair[1] is not None else float('inf')))
+    return pairs
+
+
+def diff_commands(cmd_a: dict, cmd_b: dict) -> list:
+    """
+    Return the differences (see diff_values) of the parameters, tool versions, return codes and input and output
+    file hashes of two command logs.
+    """
+    differences = []
+    for key in COMMAND_KEYS:
+        differences += diff_values(cmd_a.get(key), cmd_b.get(key), key)
+    differences += diff_values(_file_hashes(cmd_a, 'input'), _file_hashes(cmd_b, 'input'), 'input')
+    differences += diff_values(_file_hashes(cmd_a, 'output'), _file_hashes(cmd_b, 'output'), 'output')
+    return differences
+
+
+def diff_runs(run_a: dict, run_b: dict, match: str = 'position', duration_tolerance: float = 0.1) -> dict:
+    """
+    Compare two run logs and return dict with the differences of the run (environment, tracked repositories) and a
+    list of the commands that differ. Matched commands are listed if their parameters, versions, return codes or
+    file hashes differ or if the ratio of their durations (b / a) deviates from 1 by more than duration_tolerance.
+    """
+    run_differences = []
+    for key in sorted(set(run_a.keys()) | set(run_b.keys())):
+        if key not in IGNORED_RUN_KEYS:
+            run_differences += diff_values(run_a.get(key), run_b.get(key), key)
+
+    commands_a = run_a.get('commands', [])
+    commands_b = run_b.get('commands', [])
+    commands = []
+    for i, j in match_commands(commands_a, commands_b, match):
+        if i is None or j is None:
+            cmd_log = commands_a[i] if i is not None else commands_b[j]
+            commands.append({'name': cmd_log.get('name'), 'index_a': i, 'index_b': j,
+                             'differences': [], 'duration_ratio': None})
+            continue
+        duration_a = Analytics.get_duration(commands_a[i])
+        duration_b = Analytics.get_duration(commands_b[j])
+        ratio = None
+        if duration_a is not None and duration_b is not None and duration_a > 0:
+            ratio = duration_b / duration_a
+        differences = diff_commands(commands_a[i], commands_b[j])
+        if len(differences) > 0 or (ratio is not None and abs(ratio - 1.0) > duration_tolerance):
+            commands.append({'name': commands_a[i].get('name'), 'index_a': i, 'index_b': j,
+                             'differences': differences, 'duration_ratio': ratio})
+
+    return {'run_a': run_a.get('run_id'),
+            'run_b': run_b.get('run_id'),
+            'run': run_differences,
+            'commands': commands}
+
+
+def is_different(diff: dict) -> bool:
+    return len(diff['run']) > 0 or len(diff['commands']) > 0
+
+
+def _shorten(value, length: int = 60) -> str:
+    text = str(value)
+    return text if len(text) <= length else text[:length - 3] + '...'
+
+
+def format_diff(diff: dict) -> str:
+    """
+    Return the output of diff_runs() as text.
+    """
+    lines = ['--- run ' + str(diff['run_a']), '+++ run ' + str(diff['run_b'])]
+    for path, a, b in diff['run']:
+        lines.append('  ' + path + ': ' + _shorten(a) + ' -> ' + _shorten(b))
+    for command in diff['commands']:
+        if command['index_b'] is None:
+            lines.append('- command ' + str(command['index_a']) + ' ' + str(command['name']) + ' only in run a')
+            continue
+        if command['index_a'] is None:
+            lines.append('+ command ' + str(command['index_b']) + ' ' + str(command['name']) + ' only in run b')
+            continue
+        header = '~ command ' + str(command['index_a']) + '/' + str(command['index_b']) + ' ' + str(command['name'])
+        if command['duration_ratio'] is not None:
+            header += ' (duration x%.2f)' % command['duration_ratio']
+        lines.append(header)
+        for path, a, b in command['differences']:
+            lines.append('    ' + path + ': ' + _shorten(a) + ' -> ' + _shorten(b))
+    if not is_different(diff):
+        lines.append('No differences.')
+    return '\n'.join(lines)
@@ -1,5 +1,3 @@
-from slack import WebClient
-import telegram
 from abc import ABC, abstractmethod
 
 
@@ -26,6 +24,7 @@ class SlackMessageLogger(MessageLogger):
     def __init__(self, token: str, channel_or_user: str, caption: str = None):
         super().__init__()
 
+        from slack import WebClient  # imported on use to keep the import of cmdint fast
         self.slack_client = WebClient(token=token)
         self.cid = None
         self.caption = caption
@@ -81,6 +80,7 @@ class TelegramMessageLogger(MessageLogger):
     def __init__(self, token: str, chat_id: str, caption: str = None):
         super().__init__()
 
+        import telegram
         self.bot = telegram.Bot(token=token)
         self.cid = chat_id
         self.caption = caption
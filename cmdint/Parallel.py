@@ -0,0 +1,357 @@
+""" Helpers to distribute lists of CmdInterface instances over cluster array jobs and local worker processes.
+"""
+import os
+import atexit
+import itertools
+import threading
+import multiprocessing
+import multiprocessing.connection
+import pickle
+from multiprocessing.reduction import ForkingPickler
+import psutil
+from cmdint.Utils import LogWriteMode, ResourceUsage, OutputRouter, ProcessExitError
+
+# pool of worker processes for python functions (see get_function_pool)
+_function_pool = None
+_function_pool_key = None
+_function_pool_lock = threading.Lock()
+
+
+def get_shard_from_environment() -> tuple:
+    """
+    Return tuple (shard index, shard count) of the current array job task read from the environment variables
+    CMDINT_SHARD_INDEX/CMDINT_SHARD_COUNT, the SLURM array variables or the SGE task variables. The index starts at 0,
+    independent of the first task id and step size of the array. Values that are not available are None.
+    """
+    env = os.environ
+    if 'CMDINT_SHARD_INDEX' in env:
+        count = int(env['CMDINT_SHARD_COUNT']) if 'CMDINT_SHARD_COUNT' in env else None
+        return int(env['CMDINT_SHARD_INDEX']), count
+    if 'SLURM_ARRAY_TASK_ID' in env:
+        first = int(env.get('SLURM_ARRAY_TASK_MIN', 0))
+        step = int(env.get('SLURM_ARRAY_TASK_STEP', 1))
+        count = int(env['SLURM_ARRAY_TASK_COUNT']) if 'SLURM_ARRAY_TASK_COUNT' in env else None
+        return (int(env['SLURM_ARRAY_TASK_ID']) - first) // step, count
+    if env.get('SGE_TASK_ID', 'undefined') != 'undefined':
+        first = int(env.get('SGE_TASK_FIRST', 1))
+        step = int(env.get('SGE_TASK_STEPSIZE', 1))
+        count = None
+        if env.get('SGE_TASK_LAST', 'undefined') != 'undefined':
+            count = (int(env['SGE_TASK_LAST']) - first) // step + 1
+        return (int(env['SGE_TASK_ID']) - first) // step, count
+    return None, None
+
+
+def get_shard_index_and_count(shard_index: int = None, shard_count: int = None) -> tuple:
+    """
+    Return tuple (shard index, shard count). Values that are not specified explicitly are read from the environment
+    (see get_shard_from_environment). Without array job a single shard (0, 1) is returned.
+    """
+    env_index, env_count = get_shard_from_environment()
+    if shard_index is None:
+        shard_index = env_index if env_index is not None else 0
+    if shard_count is None:
+        shard_count = env_count if env_count is not None else 1
+    if shard_count < 1 or shard_index < 0 or shard_index >= shard_count:
+        print('Invalid shard index ' + str(shard_index) + ' for ' + str(shard_count) + ' shards')
+        raise ValueError('Invalid shard index ' + str(shard_index) + ' for ' + str(shard_count) + ' shards')
+    return shard_index, shard_count
+
+
+def select_shard(items: list, shard_index: int, shard_count: int) -> list:
+    """
+    Deterministically select the part of the list that belongs to the specified shard (every shard_count-th item,
+    starting at shard_index). Neighbouring items, e.g. of a parameter grid, are thereby spread over all shards.
+    """
+    return list(items[shard_index::shard_count])
+
+
+def expand_grid(grid: dict, zipped: bool = False) -> list:
+    """
+    Expand dict of parameter lists into the list of all parameter combinations (Cartesian product), each represented
+    as dict. If zipped is True, the i-th values of all lists are combined instead (all lists need the same length).
+    The order is deterministic and given by the order of the keys and values in the grid.
+    """
+    keys = list(grid.keys())
+    if zipped:
+        lengths = set(len(grid[key]) for key in keys)
+        if len(lengths) > 1:
+            print('All parameter lists of a zipped grid need the same length')
+            raise ValueError('All parameter lists of a zipped grid need the same length')
+        return [dict(zip(keys, values)) for values in zip(*[grid[key] for key in keys])]
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+
+
+def get_num_workers() -> int:
+    """
+    Return the number of CPU cores available to this process.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+
+def _init_worker(logfile_name: str, log_write_mode: LogWriteMode):
+    from cmdint.CmdInterface import CmdInterface
+    CmdInterface.set_static_logfile(logfile_name)
+    CmdInterface.set_log_write_mode(log_write_mode)
+    CmdInterface.set_throw_on_error(False)
+    CmdInterface.set_exit_on_error(False)
+
+
+def _run_command(command) -> int:
+    try:
+        return command.run()
+    except Exception as err:
+        print('Exception: ' + str(err))
+        return -3
+
+
+def run_pool(commands: list, num_workers: int, logfile_name: str, log_write_mode: LogWriteMode) -> list:
+    """
+    Run the CmdInterface instances in a pool of worker processes and return the list of return codes in the order
+    of the input list. Python functions must be defined at module level to be transferable to the workers.
+    Since multiple processes log concurrently, LogWriteMode.SINGLE_PROCESS is replaced by LogWriteMode.FILE_LOCK.
+    """
+    if log_write_mode == LogWriteMode.SINGLE_PROCESS:
+        log_write_mode = LogWriteMode.FILE_LOCK
+    if num_workers is None:
+        num_workers = get_num_workers()
+    num_workers = max(1, min(num_workers, len(commands)))
+    if len(commands) == 0:
+        return []
+
+    with multiprocessing.Pool(processes=num_workers,
+                              initializer=_init_worker,
+                              initargs=(logfile_name, log_write_mode)) as pool:
+        return pool.map(_run_command, commands, chunksize=1)
+
+
+def _run_command_to_queue(command, index: int, result_queue, logfile_name: str, log_write_mode: LogWriteMode):
+    _init_worker(logfile_name, log_write_mode)
+    result_queue.put((index, _run_command(command)))
+
+
+def _get_rss(pid: int) -> int:
+    """
+    Return resident memory in bytes of the process and all of its children.
+    """
+    try:
+        proc = psutil.Process(pid)
+        rss = proc.memory_info().rss
+        for child in proc.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+    except psutil.Error:
+        return 0
+
+
+def run_scheduled(commands: list,
+                  logfile_name: str,
+                  log_write_mode: LogWriteMode,
+                  max_cores: float = None,
+                  max_memory_gb: float = None,
+                  reserved_memory_gb: float = 1.0,
+                  poll_interval: float = 0.5) -> list:
+    """
+    Run the CmdInterface instances in separate worker processes. A command is only started if its declared cores
+    (CmdInterface.set_resources) fit into the unused cores and its declared memory fits into the free memory. The free
+    memory is the available memory reported by psutil minus the reserved memory and minus the part of the declared
+    memory that running commands do not use yet. Commands that do not fit are queued. Queued commands that fit are
+    started even if earlier commands are still waiting (backfilling). A command that does not fit at all is run
+    alone. Return the list of return codes in the order of the input list.
+    """
+    if log_write_mode == LogWriteMode.SINGLE_PROCESS:
+        log_write_mode = LogWriteMode.FILE_LOCK
+    if max_cores is None:
+        max_cores = get_num_workers()
+    if max_memory_gb is None:
+        max_memory_gb = psutil.virtual_memory().total / (1024 ** 3)
+    gb = 1024 ** 3
+
+    result_queue = multiprocessing.Queue()
+    return_codes = [0] * len(commands)
+    queued = list(range(len(commands)))
+    running = dict()  # index -> process
+
+    while len(queued) > 0 or len(running) > 0:
+
+        # collect finished commands
+        for index, proc in list(running.items()):
+            if not proc.is_alive():
+                proc.join()
+                del running[index]
+                if proc.exitcode != 0:
+                    return_codes[index] = -3
+        while not result_queue.empty():
+            index, return_code = result_queue.get()
+            return_codes[index] = return_code
+
+        # start queued commands that fit
+        used_cores = sum(commands[index].get_resources()[0] for index in running.keys())
+        used_memory = sum(commands[index].get_resources()[1] for index in running.keys())
+        unused_declared = sum(max(0.0, commands[index].get_resources()[1] * gb - _get_rss(proc.pid))
+                              for index, proc in running.items())
+        free_memory = (psutil.virtual_memory().available - unused_declared) / gb - reserved_memory_gb
+        for index in list(queued):
+            cores, memory_gb = commands[index].get_resources()
+            fits = used_cores + cores <= max_cores and \
+                used_memory + memory_gb <= max_memory_gb and \
+                memory_gb <= free_memory
+            if not fits and len(running) > 0:
+                continue
+            proc = multiprocessing.Process(target=_run_command_to_queue,
+                                           args=(commands[index], index, result_queue, logfile_name, log_write_mode))
+            proc.start()
+            running[index] = proc
+            queued.remove(index)
+            used_cores += cores
+            used_memory += memory_gb
+            free_memory -= memory_gb
+
+        if len(running) > 0:
+            multiprocessing.connection.wait([proc.sentinel for proc in running.values()], timeout=poll_interval)
+
+    while not result_queue.empty():
+        index, return_code = result_queue.get()
+        return_codes[index] = return_code
+    return return_codes
+
+
+def _init_function_worker():
+    from cmdint.CmdInterface import CmdInterface
+    CmdInterface.set_nested_context()
+
+
+def function_pool_available() -> bool:
+    """
+    Daemonic processes, e.g. the workers of run_pool, cannot start the pool of worker processes for python functions.
+    """
+    return not multiprocessing.current_process().daemon
+
+
+def get_function_pool(num_workers: int = None):
+    """
+    Return the pool of worker processes that runs the python functions of CmdInterface instances (see
+    CmdInterface.set_run_in_process). The pool is created on first use, reused by all following calls and terminated
+    at exit. The default number of workers is the number of available cores.
+    """
+    global _function_pool, _function_pool_key
+    if num_workers is None:
+        num_workers = get_num_workers()
+    with _function_pool_lock:
+        if _function_pool is None or _function_pool_key != (os.getpid(), num_workers):
+            if _function_pool is not None and _function_pool_key[0] == os.getpid():
+                _function_pool.terminate()
+            elif _function_pool is None:
+                atexit.register(shutdown_function_pool)
+            _function_pool = multiprocessing.Pool(processes=num_workers, initializer=_init_function_worker)
+            _function_pool_key = (os.getpid(), num_workers)
+        return _function_pool
+
+
+def shutdown_function_pool():
+    """
+    Terminate the pool of worker processes for python functions if it has been created by this process.
+    """
+    global _function_pool, _function_pool_key
+    with _function_pool_lock:
+        if _function_pool is not None and _function_pool_key[0] == os.getpid():
+            _function_pool.terminate()
+            _function_pool.join()
+        _function_pool = None
+        _function_pool_key = None
+
+
+class _PipeWriter:
+    """
+    Text stream that sends the written text line-wise through the connection.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.__buffer = ''
+
+    def write(self, text: str) -> int:
+        self.__buffer += text
+        if '\n' in text or len(self.__buffer) >= 8192:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if len(self.__buffer) > 0:
+            self.connection.send(self.__buffer)
+            self.__buffer = ''
+
+
+def _call_function(function, args: list, kwargs: dict, pickled_connection: bytes, parent_span: dict) -> tuple:
+    """
+    Run the function in a worker process and send its stdout and stderr through the connection, followed by None.
+    Spans of commands run nested in the function are collected as children of parent_span. Return tuple (return
+    value, exception, resources, nested spans).
+    """
+    from cmdint.CmdInterface import CmdInterface
+    connection = pickle.loads(pickled_connection)
+    writer = _PipeWriter(connection)
+    usage = ResourceUsage()
+    result = None
+    exception = None
+    nested_spans = []
+    try:
+        with OutputRouter.route(writer), CmdInterface.collect_nested_spans(parent_span) as nested_spans:
+            result = function(*args, **kwargs)
+    except Exception as err:
+        exception = err
+    except BaseException as err:
+        # e.g. sys.exit() in the function, which would otherwise end the task without result
+        exception = ProcessExitError('Function exited with ' + repr(err))
+    finally:
+        resources = usage.stop()
+        writer.flush()
+        connection.send(None)
+        connection.close()
+    return result, exception, resources, nested_spans
+
+
+def run_function(function, args: list, kwargs: dict, out_stream, num_workers: int = None, on_poll=None,
+                 parent_span: dict = None) -> tuple:
+    """
+    Run the python function in the pool of worker processes (see get_function_pool) and write its output to
+    out_stream while it is running. on_poll is called regularly while waiting. Return tuple (return value, exception,
+    resources used by the function, spans of the commands run nested in the function with parent_span as root).
+    If the worker process exits while running the function (e.g. os._exit or killed), the exception is a
+    ProcessExitError. Function, arguments, return value and exception need to be picklable, i.e. functions must be
+    defined at module level.
+    """
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    try:
+        # the write end is pickled (duplicated for the worker) and closed here right away, so the reader gets EOF
+        # as soon as the worker process exits
+        pickled_writer = bytes(ForkingPickler.dumps(writer))
+    finally:
+        writer.close()
+    result = get_function_pool(num_workers).apply_async(_call_function,
+                                                        (function, args, kwargs, pickled_writer, parent_span))
+    try:
+        while True:
+            if reader.poll(0.1):
+                try:
+                    text = reader.recv()
+                except EOFError:
+                    return None, ProcessExitError('Worker process exited while running the function'), None, []
+                if text is None:
+                    break
+                out_stream.write(text)
+            elif result.ready():
+                # the function did not start, e.g. because it could not be pickled
+                break
+            if on_poll is not None:
+                on_poll()
+        return result.get()
+    except Exception as err:
+        return None, err, None, []
+    finally:
+        reader.close()
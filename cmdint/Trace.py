@@ -0,0 +1,96 @@
+""" Conversion of the command spans logged by CmdInterface into trace formats.
+"""
+
+
+def get_spans(run_logs: list) -> list:
+    """
+    Return list of tuples (run id, span, command log) of all logged commands and their nested commands. Nested
+    commands share the command log of the enclosing command.
+    """
+    spans = []
+    for run_log in run_logs:
+        for cmd_log in run_log['commands']:
+            if cmd_log.get('span') is None or cmd_log['span']['end_ns'] is None:
+                continue
+            spans.append((run_log['run_id'], cmd_log['span'], cmd_log))
+            for span in cmd_log.get('nested_spans', []):
+                if span['end_ns'] is not None:
+                    spans.append((run_log['run_id'], span, cmd_log))
+    return spans
+
+
+def get_unix_times(span: dict) -> tuple:
+    """
+    Return tuple (start, end) of the span in nanoseconds since the epoch. The duration is taken from the monotonic
+    clock.
+    """
+    return span['start_unix_ns'], span['start_unix_ns'] + span['end_ns'] - span['start_ns']
+
+
+def to_chrome_trace(run_logs: list) -> dict:
+    """
+    Return the spans as Chrome Trace Event json (complete events). Every run is shown as separate process, every
+    thread of the run as separate track. Nested commands are drawn below the enclosing command.
+    """
+    events = []
+    named_processes = set()
+    for run_id, span, cmd_log in get_spans(run_logs):
+        pid = span['pid']
+        if pid not in named_processes:
+            named_processes.add(pid)
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                           'args': {'name': 'cmdint run ' + run_id}})
+        start, end = get_unix_times(span)
+        args = {'run_id': run_id,
+                'span_id': span['span_id'],
+                'parent_id': span['parent_id'],
+                'return_code': span['return_code']}
+        if span['parent_id'] is None:
+            args['run_string'] = cmd_log['run_string']
+        events.append({'name': str(span['name']),
+                       'cat': 'cmdint',
+                       'ph': 'X',
+                       'ts': start / 1000,
+                       'dur': (end - start) / 1000,
+                       'pid': pid,
+                       'tid': span['tid'],
+                       'args': args})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def _attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+def to_otlp(run_logs: list) -> dict:
+    """
+    Return the spans in the OpenTelemetry protocol json format (ExportTraceServiceRequest). Every run is one trace
+    with the run id as trace id.
+    """
+    otlp_spans = []
+    for run_id, span, cmd_log in get_spans(run_logs):
+        start, end = get_unix_times(span)
+        attributes = [_attribute('cmdint.run_id', run_id),
+                      _attribute('cmdint.return_code', span['return_code']),
+                      _attribute('process.pid', span['pid']),
+                      _attribute('thread.id', span['tid'])]
+        if span['parent_id'] is None:
+            attributes.append(_attribute('cmdint.run_string', cmd_log['run_string']))
+        otlp_span = {'traceId': run_id.replace('-', ''),
+                     'spanId': span['span_id'],
+                     'name': str(span['name']),
+                     'kind': 1,
+                     'startTimeUnixNano': str(start),
+                     'endTimeUnixNano': str(end),
+                     'attributes': attributes,
+                     'status': {'code': 1 if span['return_code'] is not None and span['return_code'] > 0 else 2}}
+        if span['parent_id'] is not None:
+            otlp_span['parentSpanId'] = span['parent_id']
+        otlp_spans.append(otlp_span)
+    return {'resourceSpans': [{'resource': {'attributes': [_attribute('service.name', 'cmdint')]},
+                               'scopeSpans': [{'scope': {'name': 'cmdint'},
+                                               'spans': otlp_spans}]}]}
@@ -1,18 +1,31 @@
 import copy
+import os
+import time
+from array import array
+import stat
 import threading
 import socket
 import platform
 import sys
 import math
+import re
+import io
+import contextlib
+import contextvars
+import json
+import pickle
+import hashlib
+import inspect
 import multiprocessing
 import cmdint
+import psutil
 from psutil import virtual_memory
 from enum import IntEnum
 
 try:
-    from pip._internal.operations import freeze
-except ImportError:  # pip < 10.0
-    from pip.operations import freeze
+    import resource
+except ImportError:  # not available on windows
+    resource = None
 
 
 class MessageLogLevel(IntEnum):
@@ -26,12 +39,27 @@ class MessageLogLevel(IntEnum):
     START_AND_END_MESSAGES = 3  # Send all messages: start, end and user defined.
 
 
+class LogWriteMode(IntEnum):
+    """
+    Defines how the logfile is written.
+    """
+
+    SINGLE_PROCESS = 0  # The logfile is rewritten in place. Only safe if a single process writes to the logfile.
+    FILE_LOCK = 1  # Each write is protected by an advisory file lock and atomically replaces the logfile.
+    SEGMENTS = 2  # Each process writes its run log to a separate segment file. Segments are merged when loading the log.
+
+
 class RunLog(dict):
     """
     Log dictionary used to store the a list of the individual command logs as well as additional information captured in CmdInterface.
     """
 
-    def __init__(self, run_id):
+    # local ip and installed packages, captured once per process (see capture_slow_environment)
+    __slow_environment = None
+    __slow_environment_thread = None
+    __slow_environment_lock = threading.Lock()
+
+    def __init__(self, run_id, wait_for_slow_environment: bool = True):
         super().__init__()
 
         self['run_id'] = run_id
@@ -55,7 +83,7 @@ class RunLog(dict):
         self['environment']['platform']['logical_cores'] = multiprocessing.cpu_count()
         self['environment']['platform']['memory_gb'] = virtual_memory().total / (1024 ** 3)
         self['environment']['platform']['node'] = platform.uname().node
-        self['environment']['platform']['ip'] = RunLog.get_local_ip()
+        self['environment']['platform']['ip'] = None
         self['environment']['python'] = dict()
         self['environment']['python']['version'] = platform.python_version()
         self['environment']['python']['build'] = platform.python_build()
@@ -68,11 +96,53 @@ class RunLog(dict):
             if hasattr(module, '__version__') and not str(module.__name__).__contains__('.'):
                 self['environment']['python']['imported_modules'][str(module.__name__)] = str(module.__version__)
 
-        self['environment']['python']['pip_freeze'] = dict()
+        self['environment']['python']['pip_freeze'] = None
+        RunLog.add_slow_environment(self, wait=wait_for_slow_environment)
+
+    @staticmethod
+    def capture_slow_environment(background: bool = True):
+        """
+        Capture the local ip and the installed python packages (pip freeze) once per process. Resolving the host name
+        can block for seconds with a slow DNS and importing pip and listing the packages takes several hundred
+        milliseconds, so the capture can run in a background thread while the first command is already running.
+        """
+        with RunLog.__slow_environment_lock:
+            if RunLog.__slow_environment_thread is None:
+                RunLog.__slow_environment_thread = threading.Thread(target=RunLog.__capture_slow_environment,
+                                                                    daemon=True)
+                RunLog.__slow_environment_thread.start()
+        if not background:
+            RunLog.__slow_environment_thread.join()
+
+    @staticmethod
+    def __capture_slow_environment():
+        try:
+            from pip._internal.operations import freeze
+        except ImportError:  # pip < 10.0
+            from pip.operations import freeze
+
+        pip_freeze = dict()
         for module in freeze.freeze():
             module = module.split('==')
             if len(module) > 1:
-                self['environment']['python']['pip_freeze'][module[0]] = module[1]
+                pip_freeze[module[0]] = module[1]
+        RunLog.__slow_environment = {'ip': RunLog.get_local_ip(), 'pip_freeze': pip_freeze}
+
+    @staticmethod
+    def add_slow_environment(run_log: dict, wait: bool = True) -> bool:
+        """
+        Add local ip and pip freeze to the run log. If wait is False and the capture is still running, the run log is
+        not changed and False is returned.
+        """
+        RunLog.capture_slow_environment(background=not wait)
+        if wait and RunLog.__slow_environment is None:  # the capture thread does not survive a fork
+            RunLog.__capture_slow_environment()
+        environment = RunLog.__slow_environment
+        if environment is None:
+            return False
+        run_log['environment']['platform']['ip'] = environment['ip']
+        run_log['environment']['python']['pip_freeze'] = environment['pip_freeze']
+        return True
 
     @staticmethod
     def get_local_ip():
@@ -97,19 +167,39 @@ class CmdLog(dict):
         self['is_py_function'] = False
         self['description'] = None
         self['run_string'] = None
+        self['version'] = None
         self['return_code'] = 0
         self['return_code_meaning'] = None
         self['call_stack'] = None
+        self['sweep'] = None
         self['text_output'] = list()
+        self['text_output_ms'] = None
         self['options'] = dict()
         self['options']['no_key'] = None
         self['options']['key_val'] = None
 
+        self['resources'] = dict()
+        self['resources']['cpu_user_s'] = None
+        self['resources']['cpu_system_s'] = None
+        self['resources']['max_rss_bytes'] = None
+        self['resources']['voluntary_context_switches'] = None
+        self['resources']['involuntary_context_switches'] = None
+        self['resources']['read_bytes'] = None
+        self['resources']['write_bytes'] = None
+
+        self['resource_samples'] = None
+        self['profile'] = None
+
         self['time'] = dict()
         self['time']['start'] = None
         self['time']['end'] = None
         self['time']['duration'] = None
+        self['time']['duration_s'] = None
         self['time']['utc_offset'] = None
+        self['time']['phases'] = dict()
+
+        self['span'] = None
+        self['nested_spans'] = list()
 
         self['input'] = dict()
         self['input']['expected'] = list()
@@ -122,6 +212,302 @@ class CmdLog(dict):
         self['output']['missing'] = list()
 
 
+class ResourceUsage:
+    """
+    Measures cpu times, peak memory, context switches and read/written bytes of a command (['resources']) without
+    polling. Command line tools are measured via the rusage of the child process tree obtained when waiting for the
+    child process (os.wait4). Python functions are measured as difference of the rusage of the own process and its
+    children before and after the function call. Read and written bytes are storage level I/O in both cases.
+    On Linux, the peak memory of a child process is at least the memory of the forking python process, since the
+    kernel keeps the peak value across exec.
+    """
+
+    @staticmethod
+    def __max_rss_bytes(usage) -> int:
+        if sys.platform == 'darwin':
+            return usage.ru_maxrss
+        return usage.ru_maxrss * 1024
+
+    @staticmethod
+    def wait(proc) -> dict:
+        """
+        Wait for the subprocess.Popen process, set its return code and return the resources used by the process and
+        all of its waited-for descendants. Returns None if the resource usage of child processes is not available.
+        """
+        if not hasattr(os, 'wait4') or proc.returncode is not None:
+            proc.wait()
+            return None
+        while True:
+            try:
+                pid, status, usage = os.wait4(proc.pid, 0)
+                break
+            except InterruptedError:
+                continue
+            except ChildProcessError:
+                proc.wait()
+                return None
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+
+        resources = dict()
+        resources['cpu_user_s'] = usage.ru_utime
+        resources['cpu_system_s'] = usage.ru_stime
+        resources['max_rss_bytes'] = ResourceUsage.__max_rss_bytes(usage)
+        resources['voluntary_context_switches'] = usage.ru_nvcsw
+        resources['involuntary_context_switches'] = usage.ru_nivcsw
+        resources['read_bytes'] = usage.ru_inblock * 512
+        resources['write_bytes'] = usage.ru_oublock * 512
+        return resources
+
+    def __init__(self):
+        """
+        Start measuring the resources used by the current process and its children.
+        """
+        self.__self_start = None
+        self.__children_start = None
+        self.__io_start = None
+        if resource is not None:
+            self.__self_start = resource.getrusage(resource.RUSAGE_SELF)
+            self.__children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            self.__io_start = psutil.Process().io_counters()
+        except (AttributeError, psutil.Error):
+            pass
+
+    def stop(self) -> dict:
+        """
+        Return the resources used by the current process and its children since the measurement was started.
+        The peak memory is the peak memory of the whole process.
+        """
+        resources = dict()
+        if self.__self_start is not None:
+            self_end = resource.getrusage(resource.RUSAGE_SELF)
+            children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+            def delta(field):
+                return getattr(self_end, field) - getattr(self.__self_start, field) + \
+                       getattr(children_end, field) - getattr(self.__children_start, field)
+
+            resources['cpu_user_s'] = delta('ru_utime')
+            resources['cpu_system_s'] = delta('ru_stime')
+            resources['max_rss_bytes'] = max(ResourceUsage.__max_rss_bytes(self_end),
+                                             ResourceUsage.__max_rss_bytes(children_end))
+            resources['voluntary_context_switches'] = delta('ru_nvcsw')
+            resources['involuntary_context_switches'] = delta('ru_nivcsw')
+        if self.__io_start is not None:
+            io_end = psutil.Process().io_counters()
+            resources['read_bytes'] = io_end.read_bytes - self.__io_start.read_bytes
+            resources['write_bytes'] = io_end.write_bytes - self.__io_start.write_bytes
+        return resources
+
+
+class ResourceSampler(threading.Thread):
+    """
+    Thread that periodically samples cpu usage (percent of one core), resident memory (MB) and storage read/write
+    rates (MB/s) of a process and all of its children. The samples are stored in typed arrays. If max_samples is
+    reached, neighbouring samples are merged (mean, maximum for memory) and the sampling interval is doubled. The
+    memory needed for the samples is therefore bounded, independent of the runtime of the process.
+    """
+
+    def __init__(self, pid: int, interval: float = 1.0, max_samples: int = 256):
+        threading.Thread.__init__(self, daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.max_samples = max(2, max_samples - max_samples % 2)
+        self.samples = dict()
+        for name in ['time_s', 'cpu_percent', 'rss_mb', 'read_mb_per_s', 'write_mb_per_s']:
+            self.samples[name] = array('f')
+        self.__stop_event = threading.Event()
+        self.__start = time.monotonic()
+        self.__last = None
+
+    def __measure(self) -> tuple:
+        """
+        Return tuple (cpu seconds, rss bytes, read bytes, written bytes) summed over the process tree.
+        """
+        cpu = rss = read_bytes = write_bytes = 0
+        try:
+            root = psutil.Process(self.pid)
+            processes = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return None
+        for proc in processes:
+            try:
+                with proc.oneshot():
+                    times = proc.cpu_times()
+                    cpu += times.user + times.system + times.children_user + times.children_system
+                    rss += proc.memory_info().rss
+                    if hasattr(proc, 'io_counters'):
+                        io_counters = proc.io_counters()
+                        read_bytes += io_counters.read_bytes
+                        write_bytes += io_counters.write_bytes
+            except (psutil.Error, AttributeError):
+                pass
+        return cpu, rss, read_bytes, write_bytes
+
+    def __sample(self):
+        now = time.monotonic()
+        measurement = self.__measure()
+        if measurement is None:
+            return
+        if self.__last is not None:
+            last_time, last_measurement = self.__last
+            dt = max(now - last_time, 1e-6)
+            mb = 1024 ** 2
+            self.samples['time_s'].append(now - self.__start)
+            self.samples['cpu_percent'].append(max(0.0, measurement[0] - last_measurement[0]) / dt * 100)
+            self.samples['rss_mb'].append(measurement[1] / mb)
+            self.samples['read_mb_per_s'].append(max(0, measurement[2] - last_measurement[2]) / mb / dt)
+            self.samples['write_mb_per_s'].append(max(0, measurement[3] - last_measurement[3]) / mb / dt)
+            if len(self.samples['time_s']) >= self.max_samples:
+                self.__downsample()
+        self.__last = (now, measurement)
+
+    def __downsample(self):
+        """
+        Merge pairs of neighbouring samples and double the sampling interval.
+        """
+        for name, values in self.samples.items():
+            merged = array('f')
+            for i in range(0, len(values) - 1, 2):
+                if name == 'rss_mb':
+                    merged.append(max(values[i], values[i + 1]))
+                else:
+                    merged.append((values[i] + values[i + 1]) / 2)
+            self.samples[name] = merged
+        self.interval *= 2
+
+    def run(self):
+        self.__sample()
+        while not self.__stop_event.wait(self.interval):
+            self.__sample()
+
+    def stop(self) -> dict:
+        """
+        Stop sampling and return the samples as dict of lists together with the final sampling interval (interval_s).
+        """
+        self.__stop_event.set()
+        self.join()
+        self.__sample()
+        out = dict()
+        out['interval_s'] = self.interval
+        for name, values in self.samples.items():
+            out[name] = [round(v, 3) for v in values]
+        return out
+
+
+class OverheadProfiler:
+    """
+    Measures the time spent in sections of cmdint itself (e.g. logfile access, hashing, environment capture) as
+    opposed to the time spent in the logged command (section "command"). Nested sections are timed exclusively, i.e.
+    the time of a nested section is not counted for the enclosing section. Times are accumulated per command and for
+    the whole run.
+    """
+
+    class __NullSection:
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            return False
+
+    class __Section:
+
+        def __init__(self, profiler, name: str):
+            self.profiler = profiler
+            self.name = name
+            self.start = 0.0
+            self.children = 0.0
+
+        def __enter__(self):
+            stack = self.profiler.get_stack()
+            stack.append(self)
+            self.start = time.perf_counter()
+            return self
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            total = time.perf_counter() - self.start
+            stack = self.profiler.get_stack()
+            stack.pop()
+            if len(stack) > 0:
+                stack[-1].children += total
+            self.profiler.add(self.name, total - self.children)
+            return False
+
+    __null_section = __NullSection()
+
+    def __init__(self):
+        self.enabled = False
+        self.command_times = dict()
+        self.run_times = dict()
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def get_stack(self) -> list:
+        if not hasattr(self.__local, 'stack'):
+            self.__local.stack = list()
+        return self.__local.stack
+
+    def section(self, name: str):
+        """
+        Return context manager measuring the time spent in the named section. Does nothing if profiling is disabled.
+        """
+        if not self.enabled:
+            return OverheadProfiler.__null_section
+        return OverheadProfiler.__Section(self, name)
+
+    def add(self, name: str, seconds: float):
+        with self.__lock:
+            self.command_times[name] = self.command_times.get(name, 0.0) + seconds
+            self.run_times[name] = self.run_times.get(name, 0.0) + seconds
+
+    @staticmethod
+    def summarize(times: dict) -> dict:
+        """
+        Return dict of section times (rounded) together with the total overhead (overhead_s, all sections except
+        "command") and the fraction of the overhead in the total time (overhead_fraction).
+        """
+        out = {name: round(seconds, 6) for name, seconds in sorted(times.items())}
+        overhead = sum(seconds for name, seconds in times.items() if name != 'command')
+        out['overhead_s'] = round(overhead, 6)
+        total = overhead + times.get('command', 0.0)
+        out['overhead_fraction'] = round(overhead / total, 4) if total > 0 else None
+        return out
+
+    def pop_command(self) -> dict:
+        """
+        Return summary of the times of the current command (see summarize) and start timing the next command.
+        """
+        with self.__lock:
+            times = self.command_times
+            self.command_times = dict()
+        return OverheadProfiler.summarize(times)
+
+    def get_run(self) -> dict:
+        """
+        Return summary of the times accumulated for the whole run (see summarize).
+        """
+        with self.__lock:
+            return OverheadProfiler.summarize(self.run_times)
+
+    def format_run(self) -> str:
+        """
+        Return the accumulated run times as text table.
+        """
+        summary = self.get_run()
+        lines = ['cmdint overhead profile:']
+        for name, seconds in summary.items():
+            if name not in ['overhead_s', 'overhead_fraction']:
+                lines.append('  %-22s %10.4fs' % (name, seconds))
+        lines.append('  %-22s %10.4fs' % ('total overhead', summary['overhead_s']))
+        if summary['overhead_fraction'] is not None:
+            lines.append('  %-22s %10.1f%%' % ('overhead fraction', 100 * summary['overhead_fraction']))
+        return '\n'.join(lines)
+
+
 class ProgressBar:
     """
     Helper class to print a simple progress bar to stdout.
@@ -174,20 +560,30 @@ class MissingOutputError(Exception):
         Exception.__init__(self, message)
 
 
+class ProcessExitError(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+
 class ThreadWithReturn(threading.Thread):
     """
-    Helper class to run python functions in a separate thread and return it's output.
+    Helper class to run python functions in a separate thread and return it's output. If context is given
+    (contextvars.Context), the function is run in this context.
     """
 
-    def __init__(self, group=None, target=None, name=None, args=(), kwargs=None):
+    def __init__(self, group=None, target=None, name=None, args=(), kwargs=None, context=None):
         threading.Thread.__init__(self, group=group, target=target, name=name, args=args, kwargs=kwargs)
         self._return = None
         self._exception = None
+        self._context = context
 
     def run(self):
         if self._target is not None:
             try:
-                self._return = self._target(*self._args, **self._kwargs)
+                if self._context is not None:
+                    self._return = self._context.run(self._target, *self._args, **self._kwargs)
+                else:
+                    self._return = self._target(*self._args, **self._kwargs)
             except Exception as err:
                 self._exception = err
 
@@ -196,3 +592,743 @@ class ThreadWithReturn(threading.Thread):
         return self._return, self._exception
 
 
+class FileSystemSnapshot:
+    """
+    Snapshot of the existence, type, size and modification time of a list of file and folder paths. The paths are
+    grouped by their parent folder. Folders containing many of the requested paths are listed only once (os.scandir),
+    all other paths are checked with a single os.stat call.
+    """
+
+    # number of requested paths in one folder from which on the folder is listed instead of checking each path
+    scandir_threshold: int = 16
+
+    def __init__(self, paths: list = None):
+        self.__cwd = os.getcwd()
+        self.__entries = dict()
+        if paths is not None:
+            self.add(paths)
+
+    def __key(self, path) -> str:
+        path = str(path)
+        if not os.path.isabs(path):
+            path = os.path.join(self.__cwd, path)
+        return os.path.normcase(os.path.normpath(path))
+
+    @staticmethod
+    def __stat(path: str):
+        try:
+            return os.stat(path)
+        except (OSError, ValueError):
+            return None
+
+    def add(self, paths: list):
+        """
+        Add (nested) list of paths to the snapshot. Paths that are already part of the snapshot are not checked again.
+        """
+        folders = dict()
+        stack = [paths]
+        while len(stack) > 0:
+            for p in stack.pop():
+                if isinstance(p, list):
+                    stack.append(p)
+                    continue
+                key = self.__key(p)
+                if key not in self.__entries:
+                    folders.setdefault(os.path.dirname(key), set()).add(key)
+
+        for folder, keys in folders.items():
+            if len(keys) < FileSystemSnapshot.scandir_threshold:
+                for key in keys:
+                    self.__entries[key] = FileSystemSnapshot.__stat(key)
+                continue
+
+            try:
+                with os.scandir(folder) as it:
+                    listing = {os.path.normcase(entry.name): entry for entry in it}
+            except (FileNotFoundError, NotADirectoryError):
+                listing = dict()
+            except OSError:
+                # folder not listable, e.g. missing read permission
+                for key in keys:
+                    self.__entries[key] = FileSystemSnapshot.__stat(key)
+                continue
+
+            for key in keys:
+                name = os.path.basename(key)
+                if len(name) == 0:
+                    self.__entries[key] = FileSystemSnapshot.__stat(key)
+                else:
+                    self.__entries[key] = listing.get(name, None)
+
+    def __entry(self, path):
+        key = self.__key(path)
+        if key not in self.__entries:
+            self.add([path])
+        return self.__entries[key]
+
+    def isfile(self, path) -> bool:
+        entry = self.__entry(path)
+        if entry is None:
+            return False
+        if isinstance(entry, os.stat_result):
+            return stat.S_ISREG(entry.st_mode)
+        try:
+            return entry.is_file()
+        except OSError:
+            return False
+
+    def isdir(self, path) -> bool:
+        entry = self.__entry(path)
+        if entry is None:
+            return False
+        if isinstance(entry, os.stat_result):
+            return stat.S_ISDIR(entry.st_mode)
+        try:
+            return entry.is_dir()
+        except OSError:
+            return False
+
+    def exists(self, path) -> bool:
+        return self.isfile(path) or self.isdir(path)
+
+    def stat(self, path) -> tuple:
+        """
+        Return tuple (size in bytes, modification time in nanoseconds) of the path or None if the path does not exist.
+        """
+        entry = self.__entry(path)
+        if entry is None:
+            return None
+        if not isinstance(entry, os.stat_result):
+            try:
+                entry = entry.stat()
+            except OSError:
+                return None
+        return entry.st_size, entry.st_mtime_ns
+
+    def missing(self, paths: list) -> list:
+        """
+        Return list of all paths in the (nested) input list that are neither an existing file nor an existing folder.
+        """
+        self.add(paths)
+        out = list()
+        for p in paths:
+            if isinstance(p, list):
+                out += self.missing(p)
+            elif not self.exists(p):
+                out.append(str(p))
+        return out
+
+
+class MetricsExporter:
+    """
+    Keeps counters of the commands run by CmdInterface in memory and writes them as Prometheus/OpenMetrics text file,
+    e.g. for the textfile collector of the node_exporter. The file is replaced atomically and written at most once per
+    min_interval seconds. Only the process that configured the exporter writes the file; forked worker processes do
+    not count their commands themselves.
+    """
+
+    duration_buckets = (0.1, 1.0, 10.0, 60.0, 300.0, 900.0, 3600.0, 4 * 3600.0, 24 * 3600.0)
+
+    def __init__(self, file: str = None, min_interval: float = 15.0):
+        self.file = file
+        self.min_interval = min_interval
+        self.pid = os.getpid()
+        self.commands = dict()  # (name, return code, meaning) -> count
+        self.durations = dict()  # name -> [bucket counts, sum, count]
+        self.hashed_bytes = 0
+        self.log_writes = 0
+        self.log_seconds = 0.0
+        self.__last_write = None
+        self.__lock = threading.Lock()
+
+    def enabled(self) -> bool:
+        return self.file is not None and self.pid == os.getpid()
+
+    def add_command(self, name: str, return_code: int, meaning: str, duration_s: float = None):
+        with self.__lock:
+            key = (str(name), return_code, meaning)
+            self.commands[key] = self.commands.get(key, 0) + 1
+            if duration_s is None:
+                return
+            if name not in self.durations:
+                self.durations[name] = [[0] * len(MetricsExporter.duration_buckets), 0.0, 0]
+            histogram = self.durations[name]
+            for i, bound in enumerate(MetricsExporter.duration_buckets):
+                if duration_s <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += duration_s
+            histogram[2] += 1
+
+    def add_hashed_bytes(self, num_bytes: int):
+        with self.__lock:
+            self.hashed_bytes += num_bytes
+
+    def add_log_write(self, seconds: float):
+        with self.__lock:
+            self.log_writes += 1
+            self.log_seconds += seconds
+
+    @staticmethod
+    def __labels(**labels) -> str:
+        escaped = []
+        for key, value in labels.items():
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(key + '="' + value + '"')
+        return '{' + ','.join(escaped) + '}'
+
+    def format(self) -> str:
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.__lock:
+            lines.append('# HELP cmdint_commands_total Number of finished commands by name and return code.')
+            lines.append('# TYPE cmdint_commands_total counter')
+            for (name, return_code, meaning), count in sorted(self.commands.items(), key=lambda item: str(item[0])):
+                labels = MetricsExporter.__labels(command=name, return_code=return_code, meaning=meaning)
+                lines.append('cmdint_commands_total' + labels + ' ' + str(count))
+
+            lines.append('# HELP cmdint_command_duration_seconds Duration of the commands run in this process.')
+            lines.append('# TYPE cmdint_command_duration_seconds histogram')
+            for name, (buckets, total, count) in sorted(self.durations.items()):
+                for bound, bucket_count in zip(MetricsExporter.duration_buckets, buckets):
+                    labels = MetricsExporter.__labels(command=name, le=bound)
+                    lines.append('cmdint_command_duration_seconds_bucket' + labels + ' ' + str(bucket_count))
+                labels = MetricsExporter.__labels(command=name, le='+Inf')
+                lines.append('cmdint_command_duration_seconds_bucket' + labels + ' ' + str(count))
+                labels = MetricsExporter.__labels(command=name)
+                lines.append('cmdint_command_duration_seconds_sum' + labels + ' ' + repr(total))
+                lines.append('cmdint_command_duration_seconds_count' + labels + ' ' + str(count))
+
+            lines.append('# HELP cmdint_hashed_bytes_total Bytes of input and output files hashed.')
+            lines.append('# TYPE cmdint_hashed_bytes_total counter')
+            lines.append('cmdint_hashed_bytes_total ' + str(self.hashed_bytes))
+            lines.append('# HELP cmdint_log_writes_total Number of logfile updates.')
+            lines.append('# TYPE cmdint_log_writes_total counter')
+            lines.append('cmdint_log_writes_total ' + str(self.log_writes))
+            lines.append('# HELP cmdint_log_write_seconds_total Time spent reading and writing the logfile.')
+            lines.append('# TYPE cmdint_log_write_seconds_total counter')
+            lines.append('cmdint_log_write_seconds_total ' + repr(self.log_seconds))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, force: bool = False):
+        """
+        Atomically replace the metrics file if the last write is at least min_interval seconds ago or if force is True.
+        """
+        if not self.enabled():
+            return
+        now = time.monotonic()
+        if not force and self.__last_write is not None and now - self.__last_write < self.min_interval:
+            return
+        self.__last_write = now
+        temp_file = self.file + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_file, 'w') as f:
+            f.write(self.format())
+        os.replace(temp_file, self.file)
+
+
+class LineAssembler:
+    """
+    Assembles streamed text output into lines the way a terminal displays them. "\\n" ends a line, "\\r" moves back to
+    the start of the line so that following characters overwrite it (progress bars), backspace moves back one
+    character and the ANSI erase sequences ESC[K, ESC[1K and ESC[2K erase (part of) the line. All other ANSI escape
+    sequences (e.g. colors) are removed. The assembled lines are appended to the given list, whose last element always
+    holds the current state of the unfinished line.
+
+    If progress_interval is set, the state of an overwritten line is additionally kept as separate line at most once
+    per progress_interval seconds, e.g. to see the progress over time. Otherwise only the final state is kept.
+
+    line_callback is called with every completed line (e.g. to stream the output to a live tail file).
+
+    If the list times is given, it is kept parallel to lines and holds the timestamp passed to feed() at which each
+    line was completed or last changed.
+    """
+
+    # a lone escape character does not consume a following line break, carriage return or backspace
+    __special = re.compile(r'\x1b\[[0-9;?]*[ -/]*[@-~]|\x1b\[[0-9;?]*[ -/]*$|\x1b[^\n\r\x08]?|[\n\r\x08]', re.DOTALL)
+
+    def __init__(self, lines: list, progress_interval: float = None, line_callback=None, times: list = None):
+        if len(lines) == 0:
+            lines.append('')
+        if times is not None:
+            times += [None] * (len(lines) - len(times))
+        self.lines = lines
+        self.progress_interval = progress_interval
+        self.line_callback = line_callback
+        self.times = times
+        self.__timestamp = None
+        self.__line = lines[-1]
+        self.__cursor = len(self.__line)
+        self.__pending = ''
+        self.__last_progress = None
+        self.__snapshot = None
+
+    def __write(self, text: str):
+        if self.__snapshot is not None:
+            # the line is overwritten after a carriage return, keep its previous state
+            self.lines.insert(len(self.lines) - 1, self.__snapshot)
+            if self.times is not None:
+                self.times.insert(len(self.times) - 1, self.__timestamp)
+            if self.line_callback is not None:
+                self.line_callback(self.__snapshot)
+            self.__snapshot = None
+        if self.__cursor == len(self.__line):
+            self.__line += text
+        else:
+            self.__line = self.__line[:self.__cursor] + text + self.__line[self.__cursor + len(text):]
+        self.__cursor += len(text)
+
+    def __carriage_return(self):
+        if self.progress_interval is not None and len(self.__line) > 0:
+            now = time.monotonic()
+            if self.__last_progress is None or now - self.__last_progress >= self.progress_interval:
+                self.__last_progress = now
+                self.__snapshot = self.__line
+        self.__cursor = 0
+
+    def __erase(self, mode: str):
+        if mode in ('', '0'):
+            self.__line = self.__line[:self.__cursor]
+        elif mode == '1':
+            self.__line = ' ' * self.__cursor + self.__line[self.__cursor:]
+        elif mode == '2':
+            self.__line = ' ' * self.__cursor
+
+    def feed(self, text: str, timestamp=None):
+        """
+        Add the next piece of output, produced at the given timestamp (see times). Escape sequences split between
+        two pieces are handled.
+        """
+        self.__timestamp = timestamp
+        text = self.__pending + text
+        self.__pending = ''
+        pos = 0
+        for match in LineAssembler.__special.finditer(text):
+            if match.start() > pos:
+                self.__write(text[pos:match.start()])
+            pos = match.end()
+            token = match.group()
+            if token == '\n':
+                self.lines[-1] = self.__line
+                if self.times is not None:
+                    self.times[-1] = timestamp
+                    self.times.append(None)
+                if self.line_callback is not None:
+                    self.line_callback(self.__line)
+                self.lines.append('')
+                self.__line = ''
+                self.__cursor = 0
+                self.__snapshot = None
+            elif token == '\r':
+                self.__carriage_return()
+            elif token == '\x08':
+                self.__cursor = max(0, self.__cursor - 1)
+            elif token[0] == '\x1b' and pos == len(text) and (len(token) == 1 or token[1] == '[') and \
+                    not ('@' <= token[-1] <= '~' and len(token) > 2):
+                self.__pending = token  # incomplete escape sequence, completed by the next piece
+            elif token.startswith('\x1b[') and token.endswith('K'):
+                self.__erase(token[2:-1])
+        if pos < len(text):
+            self.__write(text[pos:])
+        if self.times is not None and len(text) > 0 and not text.endswith('\n'):
+            self.times[-1] = timestamp
+        self.lines[-1] = self.__line
+
+    def close(self):
+        """
+        Pass the unfinished last line to the line callback if it is not empty.
+        """
+        if self.line_callback is not None and len(self.__line) > 0:
+            self.line_callback(self.__line)
+
+    @staticmethod
+    def assemble(text: str, progress_interval: float = None) -> list:
+        """
+        Return the complete text as list of assembled lines.
+        """
+        lines = []
+        LineAssembler(lines, progress_interval).feed(text)
+        return lines
+
+
+class AssemblingStream(io.TextIOBase):
+    """
+    Writable text stream that passes everything written to it to a LineAssembler, e.g. to capture the output of a
+    python function (sys.stdout) line by line while it is running. get_time is called on every write to get the
+    timestamp passed on to the assembler.
+    """
+
+    def __init__(self, assembler: LineAssembler, get_time=None):
+        super().__init__()
+        self.assembler = assembler
+        self.get_time = get_time
+        self.__lock = threading.Lock()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        with self.__lock:
+            self.assembler.feed(text, self.get_time() if self.get_time is not None else None)
+        return len(text)
+
+
+class OutputRouter:
+    """
+    Replacement of sys.stdout and sys.stderr that writes to the stream routed to in the current context (see route)
+    and to the original stream otherwise. Since the route is a context variable, the captured output of python
+    functions running concurrently in different threads is kept apart and the output of all other threads is not
+    captured. Threads started by a captured function inherit the route only if they are run in a copy of its context.
+    """
+
+    __target = contextvars.ContextVar('cmdint_output_target', default=None)
+
+    def __init__(self, original):
+        self.original = original
+
+    @staticmethod
+    def install():
+        """
+        Replace sys.stdout and sys.stderr by OutputRouters if not done yet.
+        """
+        if not isinstance(sys.stdout, OutputRouter):
+            sys.stdout = OutputRouter(sys.stdout)
+        if not isinstance(sys.stderr, OutputRouter):
+            sys.stderr = OutputRouter(sys.stderr)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def route(target):
+        """
+        Route sys.stdout and sys.stderr of the current context to the target stream within the with block.
+        """
+        OutputRouter.install()
+        token = OutputRouter.__target.set(target)
+        try:
+            yield target
+        finally:
+            OutputRouter.__target.reset(token)
+
+    def __stream(self):
+        target = OutputRouter.__target.get()
+        return target if target is not None else self.original
+
+    def write(self, text: str) -> int:
+        return self.__stream().write(text)
+
+    def flush(self):
+        self.__stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.original, name)
+
+
+class LiveTail:
+    """
+    Append-only json lines file with the start, output lines and end of the running commands. Every record is written
+    as one line with line buffering, so following the file (e.g. "tail -f") only costs the new
+    bytes, while the json logfile is rewritten completely on every update.
+
+    If no file is given, the tail file is placed next to the logfile (CmdInterface.json -> CmdInterface_tail.jsonl).
+    """
+
+    def __init__(self, file: str = None):
+        self.file = file
+        self.__lock = threading.Lock()
+        self.__stream = None
+        self.__stream_file = None
+        self.__pid = None
+
+    @staticmethod
+    def get_tail_file(logfile_name: str) -> str:
+        if logfile_name.endswith('.json'):
+            return logfile_name[:-len('.json')] + '_tail.jsonl'
+        return logfile_name + '_tail.jsonl'
+
+    def write(self, record: dict, logfile_name: str):
+        file = self.file if self.file is not None else LiveTail.get_tail_file(logfile_name)
+        with self.__lock:
+            if self.__stream is None or self.__stream_file != file or self.__pid != os.getpid():
+                # reopen if the logfile changed or in a forked worker process
+                if self.__stream is not None and self.__pid == os.getpid():
+                    self.__stream.close()
+                if os.path.dirname(file) != '':
+                    os.makedirs(os.path.dirname(file), exist_ok=True)
+                self.__stream = open(file, 'a', buffering=1)
+                self.__stream_file = file
+                self.__pid = os.getpid()
+            self.__stream.write(json.dumps(record) + '\n')
+
+    def close(self):
+        with self.__lock:
+            if self.__stream is not None and self.__pid == os.getpid():
+                self.__stream.close()
+            self.__stream = None
+
+
+class MemoCache:
+    """
+    Disk-backed cache of the pickled return values of python functions. The key of a call is the hash of the qualified
+    name and source code of the function, its arguments and the hashes of its input files. Every entry is a separate
+    file in the cache directory. If the total size exceeds max_bytes, the least recently used entries are removed.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def get_key(function, args: list, kwargs: dict, input_hashes: list) -> str:
+        """
+        Return the key of the function call. Arguments are serialized as json with sorted keys; objects without json
+        representation are represented by their type and ArgumentEncoder representation.
+        """
+        try:
+            source = inspect.getsource(function).encode()
+        except (OSError, TypeError):
+            source = function.__code__.co_code if hasattr(function, '__code__') else b''
+        hasher = hashlib.sha256()
+        hasher.update((getattr(function, '__module__', '') + '.' + getattr(function, '__qualname__', '')).encode())
+        hasher.update(hashlib.sha256(source).digest())
+        arguments = json.dumps([list(args), kwargs, input_hashes], sort_keys=True, default=MemoCache.__encode)
+        hasher.update(arguments.encode())
+        return hasher.hexdigest()
+
+    @staticmethod
+    def __encode(value) -> list:
+        # arrays and large values are represented by their content hash (see ArgumentEncoder)
+        return [ArgumentEncoder.get_type_name(value), ArgumentEncoder(inline_limit=None).encode(value)]
+
+    def __file(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.pickle')
+
+    def load(self, key: str) -> tuple:
+        """
+        Return tuple (True, return value) if the key is cached, (False, None) otherwise.
+        """
+        try:
+            with open(self.__file(key), 'rb') as f:
+                value = pickle.load(f)
+            os.utime(self.__file(key))  # mark as recently used
+            return True, value
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+
+    def store(self, key: str, value) -> bool:
+        """
+        Cache the return value. Return False if the value can not be pickled.
+        """
+        try:
+            data = pickle.dumps(value)
+        except Exception:
+            return False
+        os.makedirs(self.directory, exist_ok=True)
+        temp_file = self.__file(key) + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_file, 'wb') as f:
+            f.write(data)
+        os.replace(temp_file, self.__file(key))
+        self.evict(keep=key)
+        return True
+
+    def evict(self, keep: str = None):
+        """
+        Remove the least recently used entries, except the entry of the key keep, until the cache fits into max_bytes.
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.pickle') and entry.name != str(keep) + '.pickle':
+                    try:
+                        st = entry.stat()
+                        entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                    except OSError:
+                        pass
+        total = sum(size for mtime, size, path in entries)
+        if keep is not None:
+            try:
+                total += os.path.getsize(self.__file(keep))
+            except OSError:
+                pass
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class ArgumentEncoder:
+    """
+    Converts the arguments of commands into their logged json representation. Dicts and lists are converted
+    recursively, all other values are stringified. Large values are replaced by a compact summary (dict with type,
+    size and sha256 hash of the content) instead of their full text:
+    * arrays (objects with shape and dtype, e.g. numpy arrays) and buffers (bytes, array.array, ...) with more than
+      max_items elements
+    * lists, tuples and sets with more than max_items elements
+    * values whose text is longer than inline_limit characters (summary with the beginning of the text as preview)
+
+    Encoders for further types can be registered (see register).
+    """
+
+    def __init__(self, inline_limit: int = 1000, max_items: int = 100):
+        self.inline_limit = inline_limit
+        self.max_items = max_items
+        self.__encoders = list()
+
+    def register(self, value_type, encoder):
+        """
+        Encode values of the given type with the function encoder, which returns their json representation.
+        """
+        self.__encoders.append((value_type, encoder))
+
+    @staticmethod
+    def get_type_name(value) -> str:
+        value_type = type(value)
+        if value_type.__module__ == 'builtins':
+            return value_type.__qualname__
+        return value_type.__module__ + '.' + value_type.__qualname__
+
+    @staticmethod
+    def __hash_bytes(data) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def __summarize(self, value) -> dict:
+        """
+        Return the summary of the value or None if it is small enough to be logged completely.
+        """
+        if hasattr(value, 'shape') and hasattr(value, 'dtype') and hasattr(value, 'tobytes'):
+            size = 1
+            for n in value.shape:
+                size *= n
+            if size <= self.max_items:
+                return None
+            return {'type': ArgumentEncoder.get_type_name(value),
+                    'shape': [int(n) for n in value.shape],
+                    'dtype': str(value.dtype),
+                    'sha256': ArgumentEncoder.__hash_bytes(value.tobytes())}
+        if isinstance(value, (bytes, bytearray, memoryview, array)):
+            view = memoryview(value)
+            if view.nbytes <= self.max_items:
+                return None
+            return {'type': ArgumentEncoder.get_type_name(value),
+                    'shape': list(view.shape),
+                    'dtype': view.format,
+                    'sha256': ArgumentEncoder.__hash_bytes(view.cast('B') if view.c_contiguous else view.tobytes())}
+        if isinstance(value, (list, tuple, set, frozenset)):
+            if len(value) <= self.max_items:
+                return None
+            if isinstance(value, (set, frozenset)):
+                value = sorted(value, key=repr)
+            try:
+                data = pickle.dumps(value, protocol=4)
+            except Exception:
+                data = repr(value).encode()
+            return {'type': ArgumentEncoder.get_type_name(value),
+                    'length': len(value),
+                    'sha256': ArgumentEncoder.__hash_bytes(data)}
+        return None
+
+    def __summarize_text(self, value, text: str) -> dict:
+        if self.inline_limit is None or len(text) <= self.inline_limit:
+            return None
+        return {'type': ArgumentEncoder.get_type_name(value),
+                'length': len(text),
+                'sha256': ArgumentEncoder.__hash_bytes(text.encode('utf-8', errors='replace')),
+                'preview': text[:self.inline_limit]}
+
+    def encode(self, value):
+        """
+        Return the json representation of the value.
+        """
+        for value_type, encoder in self.__encoders:
+            if isinstance(value, value_type):
+                return encoder(value)
+        if isinstance(value, dict):
+            return {str(key): self.encode(el) for key, el in value.items()}
+        summary = self.__summarize(value)
+        if summary is not None:
+            return summary
+        if isinstance(value, list):
+            return [self.encode(el) for el in value]
+        text = str(value)
+        summary = self.__summarize_text(value, text)
+        return summary if summary is not None else text
+
+    def format(self, value) -> str:
+        """
+        Return the value as text for the logged call of a python function, e.g. "<numpy.ndarray shape=[1000, 3]
+        dtype=float64 sha256=...>" for large values.
+        """
+        for value_type, encoder in self.__encoders:
+            if isinstance(value, value_type):
+                return json.dumps(encoder(value))
+        summary = self.__summarize(value)
+        if summary is None:
+            text = str(value)
+            summary = self.__summarize_text(value, text)
+            if summary is None:
+                return text
+        return '<' + summary['type'] + ' ' + ' '.join(key + '=' + str(el) for key, el in summary.items()
+                                                      if key not in ('type', 'preview')) + '>'
+
+
+class VersionCache:
+    """
+    Cache of the version output of command line tools. Entries are keyed by the resolved path, size and modification
+    time of the executable and the version argument, so a tool is probed again after it has been replaced. If a file
+    is given, the cache is kept in this json file and shared by all processes using it.
+    """
+
+    def __init__(self, file: str = None):
+        self.file = file
+        self.__entries = dict()
+        self.__loaded = False
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def get_key(executable: str, version_arg: str, shell: bool = True) -> str:
+        """
+        Return the cache key of the version output or None if the executable is not found. Since the shell may run a
+        builtin instead of the executable (e.g. echo), probes with and without shell are cached separately.
+        """
+        if executable is None:
+            return None
+        try:
+            path = os.path.realpath(executable)
+            st = os.stat(path)
+        except OSError:
+            return None
+        return '|'.join([path, str(st.st_size), str(st.st_mtime_ns), str(version_arg), 'shell' if shell else 'argv'])
+
+    def __read_file(self) -> dict:
+        try:
+            with open(self.file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def get(self, key: str) -> list:
+        """
+        Return the cached output lines or None.
+        """
+        with self.__lock:
+            if self.file is not None and not self.__loaded:
+                self.__entries.update(self.__read_file())
+                self.__loaded = True
+            return self.__entries.get(key)
+
+    def put(self, key: str, lines: list):
+        with self.__lock:
+            self.__entries[key] = lines
+            if self.file is None:
+                return
+            entries = self.__read_file()
+            entries[key] = lines
+            if os.path.dirname(self.file) != '':
+                os.makedirs(os.path.dirname(self.file), exist_ok=True)
+            temp_file = self.file + '.' + str(os.getpid()) + '.tmp'
+            with open(temp_file, 'w') as f:
+                json.dump(entries, f, indent=2)
+            os.replace(temp_file, self.file)
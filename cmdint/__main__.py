@@ -0,0 +1,4 @@
+import sys
+from cmdint.Cli import main
+
+sys.exit(main())
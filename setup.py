@@ -9,6 +9,10 @@ setup(name='cmdint',
       author_email='p.neher@dkfz.de',
       license='Apache 2.0',
       packages=['cmdint'],
+      python_requires='>=3.7',
+      entry_points={
+          'console_scripts': ['cmdint=cmdint.Cli:main'],
+      },
       install_requires=[
           'xmltodict',
           'chardet',
@@ -1,8 +1,18 @@
 import unittest
+import json
+import sys
 import git
 import os
+import tempfile
+import time
+import multiprocessing
+import threading
+import io
+import contextlib
+from unittest import mock
 from pathlib import Path
-from cmdint import CmdInterface
+from array import array
+from cmdint import CmdInterface, Parallel, Analytics, Cli, Diff
 from cmdint.Utils import *
 
 
@@ -20,6 +30,91 @@ def dummy_exception():
     raise Exception('DUMMY ERROR')
 
 
+def log_dummy_funcs(logfile: str, mode: LogWriteMode):
+    CmdInterface.set_static_logfile(logfile)
+    CmdInterface.set_log_write_mode(mode)
+    for i in range(3):
+        CmdInterface(dummy_func).run()
+
+
+def print_slowly(pause: float):
+    print('before')
+    time.sleep(pause)
+    print('after')
+
+
+def print_marker(marker: str):
+    for i in range(5):
+        print(marker + str(i))
+        time.sleep(0.02)
+
+
+def run_marker(marker: str):
+    runner = CmdInterface(print_marker)
+    runner.add_arg(key='marker', arg=marker)
+    runner.run()
+
+
+def exit_in_process(hard: bool):
+    print('exiting')
+    if hard:
+        os._exit(3)
+    sys.exit(3)
+
+
+def count_in_process(out_file: str, n: int) -> int:
+    total = sum(range(n))
+    print('pid', os.getpid())
+    nest()
+    with open(out_file, 'w') as f:
+        f.write(str(total))
+    return os.getpid()
+
+
+def add_offset(in_file: str, counter_file: str, offset: int) -> int:
+    with open(counter_file, 'a') as f:
+        f.write('x')
+    with open(in_file, 'r') as f:
+        return int(f.read()) + offset
+
+
+def copy_with_offset(in_file: str, out_file: str, offset: int) -> int:
+    value = add_offset(in_file, out_file + '.counter', offset)
+    write_value(out_file, value)
+    return value
+
+
+def run_tool_twice():
+    for i in range(2):
+        CmdInterface('cmdint_test_tool').run(version_arg='--version')
+
+
+def sum_values(values: list) -> int:
+    return sum(values)
+
+
+class FakeArray:
+    def __init__(self, values: list):
+        self.values = values
+        self.shape = (len(values),)
+        self.dtype = 'int64'
+
+    def tobytes(self) -> bytes:
+        return array('q', self.values).tobytes()
+
+
+def write_value(out_file: str, value: int):
+    with open(out_file, 'w') as f:
+        f.write(str(value))
+
+
+def record_time(out_file: str):
+    start = time.time()
+    time.sleep(0.3)
+    with open(out_file, 'w') as f:
+        f.write(str(start) + ' ' + str(time.time()))
+
+
 class CmdInterfaceTests(unittest.TestCase):
 
     def setUp(self):
@@ -119,6 +214,814 @@ class CmdInterfaceTests(unittest.TestCase):
         os.remove('CmdInterface.json')
         print('Test 11 end')
 
+    def test12(self):
+        print('Test 12 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            existing = os.path.join(tmp, 'existing.txt')
+            Path(existing).touch()
+
+            step1 = CmdInterface('cp')
+            step1.add_arg(arg=existing, check_input=True)
+            step1.add_arg(arg=os.path.join(tmp, 'copy1.txt'), check_output=True)
+            step2 = CmdInterface('cp')
+            step2.add_arg(arg=os.path.join(tmp, 'copy1.txt'), check_input=True)
+            step2.add_arg(arg=os.path.join(tmp, 'copy2.txt'), check_output=True)
+            step3 = CmdInterface('cp')
+            step3.add_arg(arg=os.path.join(tmp, 'missing.txt'), check_input=True)
+            step3.add_arg(arg=os.path.join(tmp, 'copy3.txt'), check_output=True)
+            step4 = CmdInterface('cp')
+            step4.add_arg(arg=os.path.join(tmp, 'missing.txt'), check_input=True)
+            step4.add_arg(arg=existing, check_output=True)
+
+            plan = CmdInterface.plan_pipeline([step1, step2, step3, step4], print_table=True)
+            self.assertEqual([row['action'] for row in plan], ['run', 'run', 'fail', 'skip'])
+            self.assertEqual(plan[2]['missing_input'], [os.path.join(tmp, 'missing.txt')])
+            self.assertEqual(step2.plan()['action'], 'fail')
+            self.assertTrue(not os.path.isfile(os.path.join(tmp, 'copy1.txt')))
+        print('Test 12 end')
+
+    def test13(self):
+        print('Test 13 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            files = [os.path.join(tmp, 'file_' + str(i) + '.txt') for i in range(50)]
+            for f in files[:40]:
+                with open(f, 'w') as out:
+                    out.write('test')
+            os.makedirs(os.path.join(tmp, 'folder'))
+            paths = [files, os.path.join(tmp, 'folder'), os.path.join(tmp, 'not_there', 'file.txt')]
+
+            snapshot = FileSystemSnapshot(paths)
+            self.assertEqual(CmdInterface.check_exist(paths, snapshot), files[40:] + [os.path.join(tmp, 'not_there', 'file.txt')])
+            self.assertEqual(CmdInterface.check_exist(paths), CmdInterface.check_exist(paths, snapshot))
+            self.assertTrue(snapshot.isfile(files[0]))
+            self.assertTrue(snapshot.isdir(os.path.join(tmp, 'folder')))
+            self.assertTrue(snapshot.isdir(tmp))
+            self.assertEqual(snapshot.stat(files[0])[0], 4)
+            self.assertIsNone(snapshot.stat(files[-1]))
+            hashes = CmdInterface.get_file_hashes(paths, snapshot)
+            self.assertEqual(len(hashes), 41)
+
+            # unchanged files are not read again, changed files are
+            with mock.patch('builtins.open', side_effect=AssertionError('file read again')):
+                self.assertEqual(CmdInterface.get_file_hashes(paths), hashes)
+            with open(files[0], 'a') as f:
+                f.write('changed')
+            changed = CmdInterface.get_file_hashes(paths)
+            self.assertNotEqual(changed[0], hashes[0])
+            self.assertNotEqual(changed[1], hashes[1])
+        print('Test 13 end')
+
+    def test14(self):
+        print('Test 14 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            for mode in [LogWriteMode.FILE_LOCK, LogWriteMode.SEGMENTS]:
+                logfile = os.path.join(tmp, 'concurrent_' + str(int(mode)) + '.json')
+                processes = [multiprocessing.Process(target=log_dummy_funcs, args=(logfile, mode)) for i in range(4)]
+                for p in processes:
+                    p.start()
+                for p in processes:
+                    p.join()
+                    self.assertEqual(p.exitcode, 0)
+
+                run_logs = CmdInterface.load_log(logfile)
+                self.assertEqual(len(run_logs), 4)
+                self.assertEqual(len(set(run_log['run_id'] for run_log in run_logs)), 4)
+                for run_log in run_logs:
+                    self.assertEqual([cmd['return_code'] for cmd in run_log['commands']], [1, 1, 1])
+
+                if mode == LogWriteMode.SEGMENTS:
+                    self.assertTrue(not os.path.isfile(logfile))
+                    CmdInterface.merge_log_segments(logfile)
+                    self.assertEqual(os.listdir(CmdInterface.get_segment_folder(logfile)), [])
+                    self.assertEqual(len(CmdInterface.load_log(logfile, merge_segments=False)), 4)
+        print('Test 14 end')
+
+    def test15(self):
+        print('Test 15 start')
+        with mock.patch.dict(os.environ, {'SLURM_ARRAY_TASK_ID': '5', 'SLURM_ARRAY_TASK_MIN': '1',
+                                          'SLURM_ARRAY_TASK_STEP': '2', 'SLURM_ARRAY_TASK_COUNT': '4'}):
+            self.assertEqual(Parallel.get_shard_index_and_count(), (2, 4))
+            self.assertEqual(CmdInterface.get_shard(list(range(10))), [2, 6])
+        with self.assertRaises(ValueError):
+            Parallel.get_shard_index_and_count(3, 3)
+        grid = Parallel.expand_grid({'a': [1, 2], 'b': ['x', 'y', 'z']})
+        self.assertEqual(len(grid), 6)
+        self.assertEqual(grid[1], {'a': 1, 'b': 'y'})
+
+        with tempfile.TemporaryDirectory() as tmp:
+            commands = list()
+            for i in range(7):
+                runner = CmdInterface('touch')
+                runner.add_arg(arg=os.path.join(tmp, 'out_' + str(i) + '.txt'), check_output=True)
+                commands.append(runner)
+
+            logfile = os.path.join(tmp, 'sharded.json')
+            shard_logfiles = list()
+            for shard_index in range(3):
+                shard_logfiles.append(CmdInterface.get_shard_logfile(shard_index, 3, logfile))
+                return_codes = CmdInterface.run_shard(commands, shard_index, 3, num_workers=2,
+                                                      shard_logfile=shard_logfiles[-1])
+                self.assertEqual(return_codes, [1] * len(range(shard_index, 7, 3)))
+            self.assertEqual(CmdInterface.check_exist([os.path.join(tmp, 'out_' + str(i) + '.txt') for i in range(7)]), [])
+
+            CmdInterface.merge_logs(shard_logfiles, logfile)
+            run_logs = CmdInterface.load_log(logfile)
+            self.assertEqual(sum(len(run_log['commands']) for run_log in run_logs), 7)
+        print('Test 15 end')
+
+    def test16(self):
+        print('Test 16 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            CmdInterface.set_static_logfile(os.path.join(tmp, 'sweep.json'))
+            template = CmdInterface(write_value)
+            template.add_arg('out_file', os.path.join(tmp, 'out_{value}_{sweep_index}.txt'), check_output=True)
+            template.add_arg('value', 0)
+
+            zipped = CmdInterface.expand_sweep(template, {'value': [1, 2], 'out_file': ['a', 'b']}, zipped=True)
+            self.assertEqual([cmd.get_run_string() for cmd in zipped], ['write_value(out_file=a, value=1)',
+                                                                        'write_value(out_file=b, value=2)'])
+
+            return_codes = CmdInterface.sweep(template, {'value': [3, 4, 5]}, num_workers=2)
+            self.assertEqual(return_codes, [1, 1, 1])
+            for i, value in enumerate([3, 4, 5]):
+                self.assertTrue(os.path.isfile(os.path.join(tmp, 'out_' + str(value) + '_' + str(i) + '.txt')))
+
+            cmd_logs = CmdInterface.load_sweep()
+            self.assertEqual([cmd_log['sweep']['parameters']['value'] for cmd_log in cmd_logs], ['3', '4', '5'])
+            self.assertEqual(template.get_run_string(), 'write_value(out_file=' + os.path.join(tmp, 'out_{value}_{sweep_index}.txt') + ', value=0)')
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 16 end')
+
+    def test17(self):
+        print('Test 17 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            commands = list()
+            for i in range(5):
+                runner = CmdInterface(record_time)
+                runner.add_arg('out_file', os.path.join(tmp, 'time_' + str(i) + '.txt'), check_output=True)
+                runner.set_resources(cores=2 if i < 4 else 100, memory_gb=0.01)
+                commands.append(runner)
+            return_codes = CmdInterface.run_scheduled(commands, max_cores=4, reserved_memory_gb=0,
+                                                      logfile_name=os.path.join(tmp, 'scheduled.json'))
+            self.assertEqual(return_codes, [1] * 5)
+
+            intervals = list()
+            for i in range(5):
+                with open(os.path.join(tmp, 'time_' + str(i) + '.txt')) as f:
+                    intervals.append([float(t) for t in f.read().split()])
+            for start, end in intervals:
+                overlapping = [i for i, (s, e) in enumerate(intervals) if s < end and e > start]
+                self.assertLessEqual(len(overlapping), 2)
+            self.assertEqual(len([i for i, (s, e) in enumerate(intervals) if s < intervals[4][1] and e > intervals[4][0]]), 1)
+        print('Test 17 end')
+
+    def test18(self):
+        print('Test 18 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'resources.json')
+            CmdInterface.set_static_logfile(logfile)
+            runner = CmdInterface('dd')
+            runner.add_arg(arg='if=/dev/zero')
+            runner.add_arg(arg='of=' + os.path.join(tmp, 'zeros.bin'))
+            runner.add_arg(arg='bs=1M')
+            runner.add_arg(arg='count=20')
+            runner.run()
+            runner = CmdInterface(dummy_func)
+            runner.run()
+
+            cmd_logs = CmdInterface.load_log(logfile)[-1]['commands']
+            for cmd_log in cmd_logs:
+                resources = cmd_log['resources']
+                self.assertGreaterEqual(resources['cpu_user_s'] + resources['cpu_system_s'], 0)
+                self.assertGreater(resources['max_rss_bytes'], 0)
+                self.assertGreaterEqual(resources['voluntary_context_switches'], 0)
+
+            runner = CmdInterface(dummy_func)
+            self.assertEqual(runner.get_resources(), (1, 0.0))
+            CmdInterface.run_scheduled([runner], logfile_name=os.path.join(tmp, 'scheduled.json'))
+            self.assertAlmostEqual(runner.get_resources()[1], cmd_logs[1]['resources']['max_rss_bytes'] / 1024 ** 3)
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 18 end')
+
+    def test19(self):
+        print('Test 19 start')
+        sampler = ResourceSampler(os.getpid(), interval=0.01, max_samples=8)
+        sampler.start()
+        time.sleep(0.5)
+        samples = sampler.stop()
+        self.assertLess(len(samples['time_s']), 8)
+        self.assertGreater(samples['interval_s'], 0.01)
+        self.assertEqual(len(samples['time_s']), len(samples['rss_mb']))
+        self.assertGreater(max(samples['rss_mb']), 0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'samples.json')
+            CmdInterface.set_static_logfile(logfile)
+            CmdInterface.set_resource_sampling(interval=0.05)
+            runner = CmdInterface('sleep')
+            runner.add_arg(arg='0.3')
+            runner.run()
+            CmdInterface.set_resource_sampling(None)
+            samples = CmdInterface.load_log(logfile)[-1]['commands'][-1]['resource_samples']
+            self.assertGreater(len(samples['cpu_percent']), 1)
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 19 end')
+
+    def test20(self):
+        print('Test 20 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'profile.json')
+            CmdInterface.set_static_logfile(logfile)
+            CmdInterface.set_profiling(True, print_at_exit=False)
+            runner = CmdInterface(write_value)
+            runner.add_arg('out_file', os.path.join(tmp, 'out.txt'), check_output=True)
+            runner.add_arg('value', 1)
+            runner.run()
+            CmdInterface.set_profiling(False)
+            run_log = CmdInterface.load_log(logfile)[-1]
+            profile = run_log['commands'][-1]['profile']
+            self.assertIn('command', profile)
+            self.assertIn('check_input', profile)
+            self.assertIn('check_output', profile)
+            self.assertGreaterEqual(profile['overhead_s'], 0)
+            self.assertIn('overhead_fraction', run_log['cmdint']['profile'])
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 20 end')
+
+    def test21(self):
+        print('Test 21 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'trace.json')
+            CmdInterface.set_static_logfile(logfile)
+            CmdInterface(nest).run()
+            cmd_log = CmdInterface.load_log(logfile)[-1]['commands'][-1]
+            span = cmd_log['span']
+            self.assertEqual(len(cmd_log['nested_spans']), 1)
+            nested_span = cmd_log['nested_spans'][0]
+            self.assertEqual(nested_span['parent_id'], span['span_id'])
+            self.assertEqual(nested_span['name'], 'dummy_func')
+            self.assertLessEqual(span['start_ns'], nested_span['start_ns'])
+            self.assertLessEqual(nested_span['end_ns'], span['end_ns'])
+
+            CmdInterface.export_trace(os.path.join(tmp, 'chrome.json'))
+            with open(os.path.join(tmp, 'chrome.json')) as f:
+                events = [event for event in json.load(f)['traceEvents'] if event['ph'] == 'X']
+            self.assertEqual([event['name'] for event in events], ['nest', 'dummy_func'])
+            self.assertLessEqual(events[0]['ts'], events[1]['ts'])
+
+            CmdInterface.export_trace(os.path.join(tmp, 'otlp.json'), trace_format='otlp')
+            with open(os.path.join(tmp, 'otlp.json')) as f:
+                spans = json.load(f)['resourceSpans'][0]['scopeSpans'][0]['spans']
+            self.assertEqual(spans[1]['parentSpanId'], spans[0]['spanId'])
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 21 end')
+
+    def test22(self):
+        print('Test 22 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'phases.json')
+            CmdInterface.set_static_logfile(logfile)
+            Path(os.path.join(tmp, 'in.txt')).touch()
+            runner = CmdInterface('touch')
+            runner.add_arg(arg=os.path.join(tmp, 'in.txt'), check_input=True)
+            runner.add_arg(arg=os.path.join(tmp, 'out.txt'), check_output=True)
+            runner.run(version_arg='--version', pre_command='sleep 0.2')
+            times = CmdInterface.load_log(logfile)[-1]['commands'][-1]['time']
+            self.assertEqual(times['duration'], '0:00:00')
+            self.assertGreaterEqual(times['duration_s'], 0.2)
+            self.assertLess(times['duration_s'], 5)
+            self.assertEqual(sorted(times['phases'].keys()),
+                             ['check_input', 'check_output', 'execution', 'hash_input', 'hash_output', 'version_probe'])
+            self.assertGreaterEqual(times['phases']['execution'], 0.2)
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 22 end')
+
+    def test23(self):
+        print('Test 23 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            metrics_file = os.path.join(tmp, 'cmdint.prom')
+            CmdInterface.set_static_logfile(os.path.join(tmp, 'metrics.json'))
+            CmdInterface.set_metrics_file(metrics_file, min_interval=3600)
+            for value in range(2):
+                runner = CmdInterface(write_value)
+                runner.add_arg('out_file', os.path.join(tmp, 'out_' + str(value) + '.txt'), check_output=True)
+                runner.add_arg('value', value)
+                runner.run()
+            CmdInterface.set_throw_on_error(False)
+            CmdInterface.run_parallel([CmdInterface(dummy_exception)], num_workers=1)
+            CmdInterface.set_throw_on_error(True)
+
+            # only the first command triggers a write within min_interval
+            with open(metrics_file) as f:
+                self.assertIn('cmdint_commands_total{command="write_value",return_code="1",meaning="run successful"} 1',
+                              f.read())
+            CmdInterface.write_metrics()
+            with open(metrics_file) as f:
+                metrics = f.read()
+            self.assertIn('cmdint_commands_total{command="write_value",return_code="1",meaning="run successful"} 2',
+                          metrics)
+            self.assertIn('cmdint_commands_total{command="dummy_exception",return_code="-3",meaning="exception"} 1',
+                          metrics)
+            self.assertIn('cmdint_command_duration_seconds_count{command="write_value"} 2', metrics)
+            self.assertIn('cmdint_hashed_bytes_total 2', metrics)
+            CmdInterface.set_metrics_file(None)
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 23 end')
+
+    def test24(self):
+        print('Test 24 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'stats.json')
+            run_logs = []
+            for revision, durations in [('aaaa1111', [1.0, 1.1, 0.9, 1.0, 1.2, 1.05]),
+                                        ('bbbb2222', [2.0, 2.1, 1.9, 2.2, 2.0, 2.05])]:
+                run_log = {'run_id': revision, 'tracked_repositories': {'/repo': {'hash': revision}}, 'commands': []}
+                for i, duration in enumerate(durations):
+                    cmd_log = CmdLog()
+                    cmd_log['name'] = 'MitkTool'
+                    cmd_log['text_output'] = ['MITK Diffusion git commit hash: 1234', '', 'done: 1.5e-3']
+                    cmd_log['return_code'] = 1 if i > 0 else -3
+                    cmd_log['time']['start'] = '2020-01-0' + ('1' if revision == 'aaaa1111' else '2') + ' 12:00:00'
+                    cmd_log['time']['duration_s'] = duration
+                    run_log['commands'].append(cmd_log)
+                run_logs.append(run_log)
+            with open(logfile, 'w') as f:
+                json.dump(run_logs, f, indent=2)
+
+            streamed = [cmd_log for header, cmd_log in Analytics.JsonStreamReader(logfile, chunk_size=7)]
+            self.assertEqual(streamed, run_logs[0]['commands'] + run_logs[1]['commands'])
+
+            stats = Analytics.aggregate([logfile])
+            self.assertEqual(list(stats.keys()), [(None, 'MitkTool', 'MITK Diffusion git commit hash: 1234')])
+            row = list(stats.values())[0].to_dict()
+            self.assertEqual(row['count'], 12)
+            self.assertEqual(row['failed'], 2)
+
+            self.assertEqual(Cli.main(['stats', logfile, '--baseline-git', 'aaaa', '--candidate-git', 'bbbb']), 1)
+            self.assertEqual(Cli.main(['stats', logfile, '--split', '2020-01-02', '--min-slowdown', '2.0']), 0)
+
+            # slowdown after a tool update: the baseline only contains the old, the candidate only the new version
+            for run_log in run_logs:
+                for cmd_log in run_log['commands']:
+                    version = '1.0' if run_log['run_id'] == 'aaaa1111' else '2.0'
+                    cmd_log['text_output'] = ['MITK Diffusion version ' + version, '', 'done: 1.5e-3']
+            with open(logfile, 'w') as f:
+                json.dump(run_logs, f, indent=2)
+            stats = Analytics.aggregate([logfile], get_window=lambda header, cmd_log:
+                                        'baseline' if header['run_id'] == 'aaaa1111' else 'candidate')
+            self.assertEqual(len(stats), 2)
+            regressions = Analytics.detect_regressions(stats)
+            self.assertEqual(len(regressions), 1)
+            self.assertEqual(regressions[0]['baseline_versions'], ['MITK Diffusion version 1.0'])
+            self.assertEqual(regressions[0]['candidate_versions'], ['MITK Diffusion version 2.0'])
+            self.assertIn('(MITK Diffusion version 1.0 -> MITK Diffusion version 2.0)',
+                          Analytics.format_regressions(regressions))
+            self.assertEqual(Cli.main(['stats', logfile, '--split', '2020-01-02']), 1)
+
+            self.assertLess(Analytics.mann_whitney_greater([1, 2, 3, 4, 5], [6, 7, 8, 9, 10]), 0.01)
+            self.assertGreater(Analytics.mann_whitney_greater([6, 7, 8, 9, 10], [1, 2, 3, 4, 5]), 0.5)
+        print('Test 24 end')
+
+    def test25(self):
+        print('Test 25 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'diff.json')
+            run_logs = []
+            for run_id, value, pip_version in [('run-a', 1, '1.0'), ('run-b', 2, '1.1'), ('run-c', 3, '1.1')]:
+                run_log = {'run_id': run_id, 'commands': [],
+                           'environment': {'python': {'pip_freeze': {'numpy': pip_version}}}}
+                for name in ['prepare', 'train', 'evaluate'][:2 if run_id == 'run-a' else 3]:
+                    cmd_log = CmdLog()
+                    cmd_log['name'] = name
+                    cmd_log['options']['key_val'] = {'value': value if name == 'train' else 0}
+                    cmd_log['output']['found'] = [[name + '.txt', 'hash' + str(value if name == 'train' else 0)]]
+                    cmd_log['time']['duration_s'] = 1.0
+                    run_log['commands'].append(cmd_log)
+                run_logs.append(run_log)
+            with open(logfile, 'w') as f:
+                json.dump(run_logs, f)
+
+            run_a, run_b = Diff.load_runs(logfile, ['run-a', '-2'])
+            self.assertEqual((run_a['run_id'], run_b['run_id']), ('run-a', 'run-b'))
+            self.assertEqual(Diff.load_runs(logfile, [0])[0]['commands'], run_logs[0]['commands'])
+            with self.assertRaises(ValueError):
+                Diff.load_runs(logfile, ['run-'])
+
+            # all-digit run id prefixes are matched against the run ids before they are used as index
+            digit_logfile = os.path.join(tmp, 'digits.json')
+            with open(digit_logfile, 'w') as f:
+                json.dump([{'run_id': '2a6b', 'commands': []}, {'run_id': '0913', 'commands': []},
+                           {'run_id': '1f00', 'commands': []}], f)
+            self.assertEqual([r['run_id'] for r in Diff.load_runs(digit_logfile, ['0913', '1', '@1', '-1'])],
+                             ['0913', '1f00', '0913', '1f00'])
+            self.assertEqual(Diff.load_runs(digit_logfile, ['2'])[0]['run_id'], '2a6b')
+            self.assertEqual(Diff.load_runs(digit_logfile, ['0'])[0]['run_id'], '0913')
+            self.assertEqual(Diff.load_runs(digit_logfile, ['@0'])[0]['run_id'], '2a6b')
+            with self.assertRaises(ValueError):
+                Diff.load_runs(digit_logfile, ['5'])
+
+            run_diff = CmdInterface.diff_runs('run-a', 'run-b', logfile_name=logfile)
+            self.assertEqual(run_diff['run'], [('environment/python/pip_freeze/numpy', '1.0', '1.1')])
+            self.assertEqual([(c['name'], c['index_a'], c['index_b']) for c in run_diff['commands']],
+                             [('train', 1, 1), ('evaluate', None, 2)])
+            self.assertEqual([d[0] for d in run_diff['commands'][0]['differences']],
+                             ['options/key_val/value', 'output/train.txt'])
+            print(Diff.format_diff(run_diff))
+
+            self.assertEqual(Cli.main(['diff', '-l', logfile, 'run-b', '-1', '--match', 'output']), 1)
+            self.assertEqual(Cli.main(['diff', '-l', logfile, 'run-c', 'run-c']), 0)
+        print('Test 25 end')
+
+    def test26(self):
+        print('Test 26 start')
+        self.assertEqual(LineAssembler.assemble('progress 10%\rprogress 50%\rdone\x1b[K\r\nnext\n'),
+                         ['done', 'next', ''])
+        self.assertEqual(LineAssembler.assemble('\x1b[31mred\x1b[0m abc\x08\x08X\rY\x1b[2K'), [' '])
+        self.assertEqual(LineAssembler.assemble('a\rb\rc\n', progress_interval=0), ['a', 'b', 'c', ''])
+        self.assertEqual(LineAssembler.assemble('abc\x1b\ndef\n'), ['abc', 'def', ''])
+
+        lines = []
+        assembler = LineAssembler(lines)
+        for piece in ['10%', '\r\x1b', '[2', 'K100%', ' ok\n', 'end']:
+            assembler.feed(piece)
+        self.assertEqual(lines, ['100% ok', 'end'])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'progress.json')
+            CmdInterface.set_static_logfile(logfile)
+            runner = CmdInterface('printf')
+            runner.add_arg(arg='"1/3\\r2/3\\r3/3\\nfinished\\n"')
+            runner.run()
+            text_output = CmdInterface.load_log(logfile)[-1]['commands'][-1]['text_output']
+            self.assertIn('3/3', text_output)
+            self.assertIn('finished', text_output)
+            self.assertNotIn('1/3', text_output)
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 26 end')
+
+    def test27(self):
+        print('Test 27 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'tail.json')
+            CmdInterface.set_static_logfile(logfile)
+            CmdInterface.set_live_tail()
+            runner = CmdInterface('printf')
+            runner.add_arg(arg='"first\\nsec\\r2nd\\nlast"')
+            runner.run()
+            CmdInterface(dummy_func).run()
+            CmdInterface.set_live_tail(False)
+
+            with open(os.path.join(tmp, 'tail_tail.jsonl'), 'r') as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual([r['event'] for r in records],
+                             ['start', 'output', 'output', 'output', 'end', 'start', 'output', 'end'])
+            self.assertEqual([r['text'] for r in records if r['event'] == 'output'], ['first', '2nd', 'last', 'dummy'])
+            self.assertEqual(records[4]['return_code'], 1)
+            run_logs = CmdInterface.load_log(logfile)
+            self.assertEqual(records[0]['span_id'], run_logs[-1]['commands'][0]['span']['span_id'])
+            self.assertEqual(len(set(r['run_id'] for r in records)), 1)
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 27 end')
+
+    def test28(self):
+        print('Test 28 start')
+        lines = []
+        times = []
+        assembler = LineAssembler(lines, times=times)
+        assembler.feed('a\nb', 10)
+        assembler.feed('c\n', 20)
+        assembler.feed('d', 30)
+        self.assertEqual(lines, ['a', 'bc', 'd'])
+        self.assertEqual(times, [10, 20, 30])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'timestamps.json')
+            CmdInterface.set_static_logfile(logfile)
+            CmdInterface.set_output_timestamps()
+            runner = CmdInterface('sh')
+            runner.add_arg(key='-c', arg='"echo before; sleep 0.3; echo after"')
+            runner.run()
+            runner = CmdInterface(print_slowly)
+            runner.add_arg(key='pause', arg=0.3)
+            runner.run()
+            CmdInterface.set_output_timestamps(False)
+            CmdInterface(dummy_func).run()
+
+            commands = CmdInterface.load_log(logfile)[-1]['commands']
+            for cmd_log in commands[:2]:
+                self.assertEqual(len(cmd_log['text_output_ms']), len(cmd_log['text_output']))
+                before = cmd_log['text_output_ms'][cmd_log['text_output'].index('before')]
+                after = cmd_log['text_output_ms'][cmd_log['text_output'].index('after')]
+                self.assertGreaterEqual(after - before, 250)
+            self.assertIsNone(commands[2]['text_output_ms'])
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 28 end')
+
+    def test29(self):
+        print('Test 29 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'threads.json')
+            CmdInterface.set_static_logfile(logfile)
+            threads = [threading.Thread(target=run_marker, args=(marker,)) for marker in ['a', 'b']]
+            threads.append(threading.Thread(target=print_marker, args=('other',)))
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            commands = CmdInterface.load_log(logfile)[-1]['commands']
+            self.assertEqual(len(commands), 2)
+            for cmd_log in commands:
+                marker = cmd_log['options']['key_val']['marker']
+                self.assertEqual(cmd_log['text_output'], [marker + str(i) for i in range(5)] + [''])
+                self.assertIsNone(cmd_log['span']['parent_id'])
+
+            runner = CmdInterface(nest)
+            runner.run()
+            cmd_log = CmdInterface.load_log(logfile)[-1]['commands'][-1]
+            self.assertEqual(cmd_log['text_output'][0], 'TOPLEVEL NEST')
+            self.assertIn('dummy', cmd_log['text_output'])
+            self.assertEqual(len(cmd_log['nested_spans']), 1)
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 29 end')
+
+    def test30(self):
+        print('Test 30 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'process.json')
+            CmdInterface.set_static_logfile(logfile)
+            CmdInterface.set_process_pool_size(2)
+            out_file = os.path.join(tmp, 'count.txt')
+            runner = CmdInterface(count_in_process)
+            runner.add_arg(key='out_file', arg=out_file, check_output=True)
+            runner.add_arg(key='n', arg=1000)
+            runner.set_run_in_process()
+            self.assertEqual(runner.run(), 1)
+            worker_pid = runner.get_py_function_return()
+            self.assertNotEqual(worker_pid, os.getpid())
+            with open(out_file, 'r') as f:
+                self.assertEqual(f.read(), str(sum(range(1000))))
+
+            cmd_log = CmdInterface.load_log(logfile)[-1]['commands'][-1]
+            self.assertEqual(cmd_log['text_output'][0], 'pid ' + str(worker_pid))
+            self.assertIn('TOPLEVEL NEST', cmd_log['text_output'])
+            self.assertIn('dummy', cmd_log['text_output'])
+            self.assertIsNotNone(cmd_log['resources']['cpu_user_s'])
+            # the span of the command nested in the worker is logged as child of the calling command
+            self.assertEqual([span['name'] for span in cmd_log['nested_spans']], ['dummy_func'])
+            self.assertEqual(cmd_log['nested_spans'][0]['parent_id'], cmd_log['span']['span_id'])
+            self.assertEqual(cmd_log['nested_spans'][0]['pid'], worker_pid)
+
+            runner = CmdInterface(dummy_exception)
+            runner.set_run_in_process()
+            with self.assertRaises(Exception):
+                runner.run()
+            self.assertEqual(CmdInterface.load_log(logfile)[-1]['commands'][-1]['return_code'], -3)
+
+            # exiting functions and workers fail the command instead of blocking or ending this process
+            for hard in [False, True]:
+                runner = CmdInterface(exit_in_process)
+                runner.add_arg(key='hard', arg=hard)
+                runner.set_run_in_process()
+                with self.assertRaises(ProcessExitError):
+                    runner.run()
+                self.assertEqual(CmdInterface.load_log(logfile)[-1]['commands'][-1]['return_code'], -1)
+            runner = CmdInterface(count_in_process)
+            runner.add_arg(key='out_file', arg=os.path.join(tmp, 'count2.txt'))
+            runner.add_arg(key='n', arg=10)
+            runner.set_run_in_process()
+            self.assertEqual(runner.run(), 1)
+            Parallel.shutdown_function_pool()
+            CmdInterface.set_process_pool_size()
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 30 end')
+
+    def test31(self):
+        print('Test 31 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            CmdInterface.set_static_logfile(os.path.join(tmp, 'memo.json'))
+            CmdInterface.set_memo_cache(os.path.join(tmp, 'cache'))
+            in_file = os.path.join(tmp, 'in.txt')
+            counter_file = os.path.join(tmp, 'counter.txt')
+            write_value(in_file, 5)
+
+            def run(offset: int) -> tuple:
+                runner = CmdInterface(add_offset)
+                runner.add_arg(key='in_file', arg=in_file, check_input=True)
+                runner.add_arg(key='counter_file', arg=counter_file)
+                runner.add_arg(key='offset', arg=offset)
+                return runner.run(), runner.get_py_function_return()
+
+            self.assertEqual(run(1), (1, 6))
+            self.assertEqual(run(1), (3, 6))
+            self.assertEqual(run(2), (1, 7))
+            write_value(in_file, 10)
+            self.assertEqual(run(1), (1, 11))
+            self.assertEqual(run(2), (1, 12))
+            self.assertEqual(run(2), (3, 12))
+            with open(counter_file, 'r') as f:
+                self.assertEqual(f.read(), 'xxxx')
+            commands = CmdInterface.load_log(os.path.join(tmp, 'memo.json'))[-1]['commands']
+            self.assertEqual(commands[1]['return_code_meaning'], 'cached result')
+
+            out_file = os.path.join(tmp, 'out.txt')
+            for expected in [1, 3, 3]:
+                runner = CmdInterface(copy_with_offset)
+                runner.add_arg(key='in_file', arg=in_file, check_input=True)
+                runner.add_arg(key='out_file', arg=out_file, check_output=True)
+                runner.add_arg(key='offset', arg=3)
+                self.assertEqual(runner.run(), expected)
+                self.assertEqual(runner.get_py_function_return(), 13)
+            with open(out_file + '.counter', 'r') as f:
+                self.assertEqual(f.read(), 'x')
+
+            cache = MemoCache(os.path.join(tmp, 'lru'), max_bytes=12)
+            for i in range(3):
+                self.assertTrue(cache.store('key' + str(i), i))
+            self.assertFalse(cache.store('lambda', lambda x: x))
+            self.assertEqual(cache.load('key0'), (False, None))
+            self.assertEqual(cache.load('key2'), (True, 2))
+            CmdInterface.set_memo_cache()
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 31 end')
+
+    def test32(self):
+        print('Test 32 start')
+        encoder = ArgumentEncoder(inline_limit=20, max_items=10)
+        self.assertEqual(encoder.encode({'a': [1, 'b', (2, 3)], 3: None}), {'a': ['1', 'b', '(2, 3)'], '3': 'None'})
+        summary = encoder.encode(list(range(11)))
+        self.assertEqual((summary['type'], summary['length']), ('list', 11))
+        self.assertNotEqual(summary['sha256'], encoder.encode(list(range(1, 12)))['sha256'])
+        summary = encoder.encode(array('d', range(100)))
+        self.assertEqual((summary['type'], summary['shape'], summary['dtype']), ('array.array', [100], 'd'))
+        summary = encoder.encode(FakeArray(list(range(20))))
+        self.assertEqual((summary['shape'], summary['dtype']), ([20], 'int64'))
+        self.assertEqual(encoder.encode('x' * 30)['preview'], 'x' * 20)
+        self.assertEqual(encoder.format('short'), 'short')
+        self.assertTrue(encoder.format(list(range(11))).startswith('<list length=11 sha256='))
+        encoder.register(FakeArray, lambda value: 'fake')
+        self.assertEqual(encoder.encode([FakeArray([1])]), ['fake'])
+        self.assertNotEqual(MemoCache.get_key(sum_values, [], {'values': FakeArray(list(range(200)))}, []),
+                            MemoCache.get_key(sum_values, [], {'values': FakeArray(list(range(1, 201)))}, []))
+        self.assertNotEqual(MemoCache.get_key(sum_values, [], {'values': 5}, []),
+                            MemoCache.get_key(sum_values, [], {'values': '5'}, []))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'encoder.json')
+            CmdInterface.set_static_logfile(logfile)
+            runner = CmdInterface(sum_values)
+            runner.add_arg(key='values', arg=list(range(100000)))
+            runner.run()
+            self.assertEqual(runner.get_py_function_return(), sum(range(100000)))
+            cmd_log = CmdInterface.load_log(logfile)[-1]['commands'][-1]
+            self.assertEqual(cmd_log['options']['key_val']['values']['length'], 100000)
+            self.assertTrue(cmd_log['run_string'].startswith('sum_values(values=<list length=100000 sha256='))
+            self.assertLess(os.path.getsize(logfile), 100000)
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 32 end')
+
+    def test33(self):
+        print('Test 33 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'argv.json')
+            CmdInterface.set_static_logfile(logfile)
+            CmdInterface.set_use_shell(False)
+            runner = CmdInterface('echo')
+            runner.add_arg(arg='a  b $HOME')
+            runner.add_arg(key='-n', arg=['x', 'y'])
+            self.assertEqual(runner.get_argv(), ['echo', 'a  b $HOME', '-n', 'x', 'y'])
+            runner.run(version_arg='--version')
+            cmd_log = CmdInterface.load_log(logfile)[-1]['commands'][-1]
+            self.assertEqual(cmd_log['run_string'], "echo 'a  b $HOME' -n x y")
+            self.assertIn('a  b $HOME -n x y', cmd_log['text_output'])
+            self.assertIsNotNone(cmd_log['version'])
+
+            out_file = os.path.join(tmp, 'out.txt')
+            runner = CmdInterface('echo')
+            runner.add_arg(arg='redirected')
+            runner.add_arg(key='>', arg=out_file, check_output=True)
+            self.assertIsNone(runner.get_argv())
+            self.assertEqual(runner.run(), 1)
+            with open(out_file, 'r') as f:
+                self.assertEqual(f.read(), 'redirected\n')
+            CmdInterface.set_use_shell()
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 33 end')
+
+    def test34(self):
+        print('Test 34 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'versions.json')
+            counter_file = os.path.join(tmp, 'probes.txt')
+            tool = os.path.join(tmp, 'cmdint_test_tool')
+
+            def write_tool(version: str):
+                with open(tool, 'w') as f:
+                    f.write('#!/bin/sh\nif [ "$1" = "--version" ]; then echo probe >> ' + counter_file +
+                            '; echo "tool ' + version + '"; fi\n')
+                os.chmod(tool, 0o755)
+
+            def run_tool() -> dict:
+                CmdInterface('cmdint_test_tool').run(version_arg='--version')
+                return CmdInterface.load_log(logfile)[-1]['commands'][-1]
+
+            write_tool('1.0')
+            CmdInterface.set_static_logfile(logfile)
+            CmdInterface.set_version_cache(file=os.path.join(tmp, 'version_cache.json'))
+            with mock.patch.dict(os.environ, {'PATH': tmp + os.pathsep + os.environ['PATH']}):
+                for i in range(3):
+                    cmd_log = run_tool()
+                    self.assertEqual(cmd_log['version'], 'tool 1.0')
+                    self.assertEqual(cmd_log['text_output'][0], 'tool 1.0')
+                write_tool('2.00')
+                self.assertEqual(run_tool()['version'], 'tool 2.00')
+                with open(counter_file, 'r') as f:
+                    self.assertEqual(len(f.readlines()), 2)
+
+                # the cache file is shared with new processes
+                CmdInterface.set_version_cache(file=os.path.join(tmp, 'version_cache.json'))
+                self.assertEqual(run_tool()['version'], 'tool 2.00')
+                with open(counter_file, 'r') as f:
+                    self.assertEqual(len(f.readlines()), 2)
+
+                # failing probes are not cached
+                with open(tool, 'w') as f:
+                    f.write('#!/bin/sh\nif [ "$1" = "--version" ]; then echo probe >> ' + counter_file +
+                            '; echo "license error"; exit 1; fi\n')
+                for i in range(2):
+                    self.assertEqual(run_tool()['version'], 'license error')
+                with open(counter_file, 'r') as f:
+                    self.assertEqual(len(f.readlines()), 4)
+
+                # nested runs print cached versions like probed ones
+                def run_nested() -> list:
+                    CmdInterface(run_tool_twice).run()
+                    return [line for line in CmdInterface.load_log(logfile)[-1]['commands'][-1]['text_output']
+                            if ' >> ' not in line]
+
+                write_tool('3.0')
+                probed = run_nested()
+                run_tool()
+                self.assertEqual(run_nested(), probed)
+                self.assertEqual(probed, ['tool 3.0', 'tool 3.0', ''])
+                with open(counter_file, 'r') as f:
+                    self.assertEqual(len(f.readlines()), 7)
+            CmdInterface.set_version_cache()
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 34 end')
+
+    def test35(self):
+        print('Test 35 start')
+        with tempfile.TemporaryDirectory() as tmp:
+            logfile = os.path.join(tmp, 'cli.json')
+            in_file = os.path.join(tmp, 'in file.txt')
+            out_file = os.path.join(tmp, 'out file.txt')
+            with open(in_file, 'w') as f:
+                f.write('data')
+
+            def cli(*argv) -> str:
+                out = io.StringIO()
+                with contextlib.redirect_stdout(out):
+                    self.assertEqual(Cli.main(list(argv)), 0)
+                return out.getvalue()
+
+            cli('run', '--log', logfile, '--tail', '--in', in_file, '--out', out_file, '--', 'cp', in_file, out_file)
+            self.assertTrue(os.path.isfile(out_file))
+            run_log = CmdInterface.load_log(logfile)[-1]
+            self.assertEqual(run_log['commands'][0]['input']['found'][0][0], in_file)
+            self.assertEqual(run_log['commands'][0]['output']['found'][0][0], out_file)
+            self.assertIsInstance(run_log['environment']['python']['pip_freeze'], dict)
+
+            # the exit code of a failing tool is passed on
+            self.assertEqual(Cli.main(['run', '-l', logfile, '--', 'sh', '-c', 'exit 7']), 7)
+            self.assertEqual(Cli.main(['run', '-l', logfile, '--', 'cmdint_missing_tool']), 127)
+
+            # both commands were run by this process and belong to the same run
+            text = cli('show', '-l', logfile)
+            self.assertIn('run successful', text)
+            self.assertIn("'" + in_file + "'", text)
+            self.assertIn("sh -c 'exit 7'", cli('show', '-l', logfile, '-1'))
+            run_logs = json.loads(cli('show', '-l', logfile, '--json'))
+            self.assertEqual(len(run_logs), 1)
+            self.assertEqual(len(run_logs[0]['commands']), 2)
+            self.assertEqual(Cli.main(['show', '-l', os.path.join(tmp, 'missing.json')]), 2)
+
+            text = cli('tail', '-l', logfile)
+            self.assertIn('cp START', text)
+            self.assertIn('cp END run successful', text)
+            CmdInterface.set_live_tail(False)
+
+            # with --shell the command line can be given as one argument
+            shell_log = os.path.join(tmp, 'shell.json')
+            cli('run', '-l', shell_log, '--shell', '--out', out_file + '.count', '--',
+                'wc -l < "' + in_file + '" > "' + out_file + '.count"')
+            self.assertTrue(os.path.isfile(out_file + '.count'))
+            self.assertEqual(CmdInterface.load_log(shell_log)[-1]['commands'][0]['name'], 'wc')
+        CmdInterface.set_use_shell(True)
+        CmdInterface.set_background_environment_capture(False)
+        CmdInterface.set_static_logfile('CmdInterface.json')
+        print('Test 35 end')
+
     # TODO: check logfile contents
 
 